@@ -2,56 +2,92 @@ import os
 
 from flask import Flask
 
-from flask_babel import Babel
-
-from flask_bootstrap import Bootstrap
-
 from flask_login import LoginManager
 
-from flask_migrate import Migrate, MigrateCommand
-
-from flask_script import Manager
-
-from flask_session import Session
-
 from flask_sqlalchemy import SQLAlchemy
 
 
 __all__ = [
-    'app', 'db', 'lm', 'manager', 'models', 'views',
+    'api', 'app', 'create_session_table', 'db', 'init_babel', 'init_web', 'lm', 'manager', 'models', 'views',
 ]
 
 # Setup app
+#
+# Only the core (the app, its config and the database) is set up on import,
+# so that the chat bot and scripts can use the models without loading the
+# web stack. The web process calls init_web() to load everything else.
 app = Flask(__name__)
 app.config.from_object(os.environ.get("FLASK_CONFIG", "config.DevConfig"))
-Bootstrap(app)
-
-babel = Babel(app)
-
-session = Session(app)
-session.app.session_interface.db.create_all()
-
-
-@babel.timezoneselector
-def _timezone():
-    return 'Australia/Sydney'  # There exist other places in the world?
-
-
-@babel.localeselector
-def _local():
-    return 'en_AU'
-
 
 db = SQLAlchemy(app)
 
-migrate = Migrate(app, db)
-
-manager = Manager(app)
-manager.add_command('db', MigrateCommand)
-
 lm = LoginManager()
-lm.init_app(app)
 lm.login_view = "login"
 
-# This import is needed to register the Flask views.
-import application.views  # noqa: E402,F401,I100
+_web_ready = False
+
+
+def init_babel():
+    """Set up Flask-Babel (used for formatting times and money)."""
+    if 'babel' in app.extensions:
+        return
+    from flask_babel import Babel
+    babel = Babel(app)
+
+    @babel.timezoneselector
+    def _timezone():
+        return 'Australia/Sydney'  # There exist other places in the world?
+
+    @babel.localeselector
+    def _local():
+        return 'en_AU'
+
+
+def init_web():
+    """Set up the web app: its extensions, views and API.
+
+    The server side session table is not created here. Run
+    `python manage.py create_session_table` once per database.
+    """
+    global _web_ready
+    if not _web_ready:
+        from flask_bootstrap import Bootstrap
+        from application.sessions import init_sessions
+        Bootstrap(app)
+        init_babel()
+        init_sessions(app)
+        lm.init_app(app)
+        _web_ready = True
+
+    # These imports are needed to register the Flask views.
+    import application.views  # noqa: F401
+    import application.api  # noqa: F401
+    return app
+
+
+def create_session_table():
+    """Create the server side session table, if it does not exist yet."""
+    init_web()
+    # Cookie sessions do not need a table.
+    if hasattr(app.session_interface, 'db'):
+        app.session_interface.db.create_all()
+
+
+def _create_manager():
+    from flask_migrate import Migrate, MigrateCommand
+    from flask_script import Manager
+
+    Migrate(app, db)
+    manager = Manager(app)
+    manager.add_command('db', MigrateCommand)
+    return manager
+
+
+def __getattr__(name):
+    # The command line manager (and alembic, via Flask-Migrate) is only
+    # loaded by manage.py.
+    if name == 'manager':
+        global manager
+        manager = _create_manager()
+        return manager
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,413 @@
+'''
+A JSON API for runs, coffees, cafes and balances.
+
+Everything is under /api/, and needs the same login as the web pages.
+
+  - Lists are newest first. They are paginated with ?limit= (at most
+    MAX_LIMIT) and ?cursor= (the next_cursor from the previous page, which is
+    null on the last page).
+  - ?fields=id,time picks which fields are returned (all of them by default).
+  - ?include=runner,cafe embeds related objects. Each include is loaded with
+    one query for the whole page, rather than one per object.
+  - Writes take a JSON body (Content-Type: application/json). Errors are
+    returned as {"error": "..."} with a 4xx status.
+'''
+import collections
+import datetime
+import json
+import logging
+
+from application import app, db, events, views
+from application.models import Cafe, Coffee, Price, Run, User, record_event, sydney_timezone_now
+
+import coffeespecs
+
+from flask import Response, request
+
+from flask_login import current_user, login_required
+
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@app.errorhandler(ApiError)
+def _api_error(e):
+    return _json({'error': e.message}, e.status)
+
+
+def _json(data, status=200):
+    # Compact, and never pretty printed (jsonify indents in debug mode).
+    return Response(
+            json.dumps(data, separators=(',', ':')),
+            status=status, mimetype='application/json')
+
+
+def _iso(time):
+    return time.isoformat() if time is not None else None
+
+
+def _description(coffee):
+    try:
+        return coffee.pretty_print()
+    except coffeespecs.JavaException:
+        return None
+
+
+Resource = collections.namedtuple('Resource', ['model', 'fields', 'includes'])
+
+
+def _serialize(obj, fields, names=None):
+    if obj is None:
+        return None
+    return {name: fields[name](obj) for name in (names or fields)}
+
+
+def _to_one(model, fields, foreign_key):
+    '''An include of the object that `foreign_key` refers to.'''
+    def load(items):
+        ids = {getattr(item, foreign_key) for item in items} - {None}
+        objects = {}
+        if ids:
+            objects = {obj.id: obj for obj in model.query.filter(model.id.in_(ids))}
+        return lambda item: _serialize(objects.get(getattr(item, foreign_key)), fields)
+    return load
+
+
+def _to_many(model, fields, back_key):
+    '''An include of the objects whose `back_key` refers to the item.'''
+    def load(items):
+        grouped = collections.defaultdict(list)
+        ids = [item.id for item in items]
+        if ids:
+            column = getattr(model, back_key)
+            for obj in model.query.filter(column.in_(ids)).order_by(model.id):
+                grouped[getattr(obj, back_key)].append(_serialize(obj, fields))
+        return lambda item: grouped.get(item.id, [])
+    return load
+
+
+def _cafe_prices(cafes):
+    prices = collections.defaultdict(dict)
+    ids = [cafe.id for cafe in cafes]
+    if ids:
+        for cafeid, price_key, amount in db.session.query(
+                Price.cafeid, Price.price_key, Price.amount).filter(Price.cafeid.in_(ids)):
+            prices[cafeid][price_key] = amount
+    return lambda cafe: prices.get(cafe.id, {})
+
+
+USER_FIELDS = {
+    'id': lambda user: user.id,
+    'name': lambda user: user.name,
+}
+
+CAFE_FIELDS = {
+    'id': lambda cafe: cafe.id,
+    'name': lambda cafe: cafe.name,
+    'location': lambda cafe: cafe.location,
+    'price_version': lambda cafe: cafe.price_version,
+}
+
+RUN_FIELDS = {
+    'id': lambda run: run.id,
+    'runner_id': lambda run: run.person,
+    'cafe_id': lambda run: run.cafeid,
+    'time': lambda run: _iso(run.time),
+    'pickup': lambda run: run.pickup,
+    'is_open': lambda run: run.is_open,
+    'modified': lambda run: _iso(run.modified),
+}
+
+COFFEE_FIELDS = {
+    'id': lambda coffee: coffee.id,
+    'addict_id': lambda coffee: coffee.person,
+    'run_id': lambda coffee: coffee.runid,
+    'description': _description,
+    'specs': lambda coffee: json.loads(coffee.coffee),
+    'price': lambda coffee: coffee.price,
+    'modified': lambda coffee: _iso(coffee.modified),
+}
+
+USERS = Resource(User, USER_FIELDS, {})
+CAFES = Resource(Cafe, CAFE_FIELDS, {
+    'prices': _cafe_prices,
+})
+RUNS = Resource(Run, RUN_FIELDS, {
+    'runner': _to_one(User, USER_FIELDS, 'person'),
+    'cafe': _to_one(Cafe, CAFE_FIELDS, 'cafeid'),
+    'coffees': _to_many(Coffee, COFFEE_FIELDS, 'runid'),
+})
+COFFEES = Resource(Coffee, COFFEE_FIELDS, {
+    'addict': _to_one(User, USER_FIELDS, 'person'),
+    'run': _to_one(Run, RUN_FIELDS, 'runid'),
+})
+
+
+def _requested(arg, allowed):
+    value = request.args.get(arg)
+    if not value:
+        return []
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ApiError('Unknown {}: {}. Expected some of: {}'.format(
+                arg, ', '.join(unknown), ', '.join(sorted(allowed))))
+    return names
+
+
+def _render(resource, items):
+    '''Serialize items, with the fields and includes asked for.'''
+    names = _requested('fields', resource.fields) or list(resource.fields)
+    includes = {
+        name: resource.includes[name](items)
+        for name in _requested('include', resource.includes)
+    }
+    result = []
+    for item in items:
+        data = _serialize(item, resource.fields, names)
+        for name, include in includes.items():
+            data[name] = include(item)
+        result.append(data)
+    return result
+
+
+def _page(resource, query, name):
+    limit = min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+    model = resource.model
+    cursor = request.args.get('cursor')
+    if cursor:
+        if not cursor.isdigit():
+            raise ApiError('Bad cursor: {}'.format(cursor))
+        query = query.filter(model.id < int(cursor))
+    # One extra, to find out if there is another page.
+    items = query.order_by(model.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = str(items[-1].id)
+    return _json({name: _render(resource, items), 'next_cursor': next_cursor})
+
+
+def _one(resource, obj_id):
+    obj = resource.model.query.get(obj_id)
+    if obj is None:
+        raise ApiError('Not found', 404)
+    return _json(_render(resource, [obj])[0])
+
+
+def _body():
+    if not request.is_json:
+        # Also stops other sites posting forms to the API.
+        raise ApiError('Expected a JSON body (Content-Type: application/json)', 415)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ApiError('Expected a JSON object')
+    return body
+
+
+def _find(model, body, key, default=None):
+    '''The `model` whose id is body[key] (or `default`), or a 400 if there is none.'''
+    obj_id = body.get(key, default)
+    if isinstance(obj_id, str) and obj_id.isdigit():
+        obj_id = int(obj_id)
+    # Anything else would reach the database as a bad id (bool is an int,
+    # but is not an id).
+    if not isinstance(obj_id, int) or isinstance(obj_id, bool):
+        raise ApiError('Bad {}: {!r}. Expected an id.'.format(key, obj_id))
+    obj = model.query.get(obj_id)
+    if obj is None:
+        raise ApiError('Unknown {}: {!r}'.format(key, obj_id))
+    return obj
+
+
+def _string(body, key, default=''):
+    value = body.get(key, default)
+    if not isinstance(value, str):
+        raise ApiError('Bad {}: {!r}. Expected a string.'.format(key, value))
+    return value
+
+
+def _parse_time(value):
+    try:
+        time = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise ApiError('Bad time: {!r}. Expected an ISO 8601 time with a UTC offset.'.format(value))
+    if time.tzinfo is None:
+        raise ApiError('Bad time: {!r}. The time needs a UTC offset.'.format(value))
+    return time
+
+
+def _notify(notification, *args):
+    try:
+        notification(*args)
+    except Exception:
+        # The change has been saved, so still report success.
+        logging.exception('Error while trying to send notifications.')
+
+
+@app.route("/api/runs/", methods=["GET"])
+@login_required
+def api_list_runs():
+    query = Run.query
+    if 'is_open' in request.args:
+        query = query.filter(Run.is_open == (request.args['is_open'].lower() in ('1', 'true')))
+    return _page(RUNS, query, 'runs')
+
+
+@app.route("/api/runs/<int:runid>/", methods=["GET"])
+@login_required
+def api_get_run(runid):
+    return _one(RUNS, runid)
+
+
+@app.route("/api/runs/", methods=["POST"])
+@login_required
+def api_create_run():
+    body = _body()
+    cafe = _find(Cafe, body, 'cafe_id')
+    runner = _find(User, body, 'runner_id', current_user.id)
+
+    run = Run(_parse_time(body.get('time')))
+    run.person = runner.id
+    run.cafeid = cafe.id
+    run.pickup = _string(body, 'pickup')
+    run.is_open = bool(body.get('is_open', True))
+    run.modified = sydney_timezone_now()
+    db.session.add(run)
+    db.session.flush()  # Assigns run.id
+    record_event(current_user.id, "created", "run", run.id)
+    db.session.commit()
+    _notify(events.run_created, run.id)
+    return _json(_render(RUNS, [run])[0], 201)
+
+
+@app.route("/api/runs/<int:runid>/", methods=["PATCH"])
+@login_required
+def api_update_run(runid):
+    run = Run.query.get(runid)
+    if run is None:
+        raise ApiError('Not found', 404)
+    body = _body()
+    was_open = run.is_open
+    if 'time' in body:
+        run.time = _parse_time(body['time'])
+    if 'pickup' in body:
+        run.pickup = _string(body, 'pickup')
+    if 'is_open' in body:
+        run.is_open = bool(body['is_open'])
+    run.modified = sydney_timezone_now()
+    record_event(current_user.id, "updated", "run", run.id)
+    db.session.commit()
+    if was_open and not run.is_open:
+        _notify(events.run_closed, run.id)
+    return _json(_render(RUNS, [run])[0])
+
+
+@app.route("/api/coffees/", methods=["GET"])
+@login_required
+def api_list_coffees():
+    query = Coffee.query
+    run_id = request.args.get('run_id', type=int)
+    if run_id is not None:
+        query = query.filter(Coffee.runid == run_id)
+    addict_id = request.args.get('addict_id', type=int)
+    if addict_id is not None:
+        query = query.filter(Coffee.person == addict_id)
+    return _page(COFFEES, query, 'coffees')
+
+
+@app.route("/api/coffees/<int:coffeeid>/", methods=["GET"])
+@login_required
+def api_get_coffee(coffeeid):
+    return _one(COFFEES, coffeeid)
+
+
+@app.route("/api/coffees/", methods=["POST"])
+@login_required
+def api_create_coffee():
+    body = _body()
+    run = _find(Run, body, 'run_id')
+    if not run.is_open:
+        raise ApiError('Run {} is closed'.format(run.id), 409)
+    addict = _find(User, body, 'addict_id', current_user.id)
+
+    request_text = _string(body, 'coffee')
+    try:
+        c = coffeespecs.Coffee(request_text)
+    except (coffeespecs.JavaException, KeyError):
+        # KeyError: the parser can trip over some repeated words.
+        raise ApiError('Could not understand the coffee: {!r}'.format(request_text))
+    missing = [spec.name for spec in c.validation_errors()]
+    if missing:
+        raise ApiError('The coffee is missing the {}'.format(', '.join(missing)))
+    try:
+        price = float(body.get('price', 0))
+    except (TypeError, ValueError):
+        raise ApiError('Bad price: {!r}'.format(body.get('price')))
+
+    coffee = Coffee(c, price, run.id)
+    coffee.person = addict.id
+    coffee.modified = sydney_timezone_now()
+    db.session.add(coffee)
+    db.session.flush()  # Assigns coffee.id
+    record_event(current_user.id, "created", "coffee", coffee.id)
+    db.session.commit()
+    _notify(events.coffee_added, run.id, coffee.id)
+    return _json(_render(COFFEES, [coffee])[0], 201)
+
+
+@app.route("/api/coffees/<int:coffeeid>/", methods=["DELETE"])
+@login_required
+def api_delete_coffee(coffeeid):
+    coffee = Coffee.query.get(coffeeid)
+    if coffee is None:
+        raise ApiError('Not found', 404)
+    db.session.delete(coffee)
+    record_event(current_user.id, "deleted", "coffee", coffeeid)
+    db.session.commit()
+    return Response(status=204)
+
+
+@app.route("/api/cafes/", methods=["GET"])
+@login_required
+def api_list_cafes():
+    return _page(CAFES, Cafe.query, 'cafes')
+
+
+@app.route("/api/cafes/<int:cafeid>/", methods=["GET"])
+@login_required
+def api_get_cafe(cafeid):
+    return _one(CAFES, cafeid)
+
+
+@app.route("/api/users/<int:userid>/", methods=["GET"])
+@login_required
+def api_get_user(userid):
+    return _one(USERS, userid)
+
+
+@app.route("/api/balances/", methods=["GET"])
+@login_required
+def api_balances():
+    # One row per user, from the same query as the reconciliation page.
+    balances = [
+        {
+            'user_id': row.personid,
+            'name': row.name,
+            'balance': row.summary,
+            'owed_by_system': row.owed_by_system,
+            'owed_to_system': row.owed_to_system,
+            'runs': row.num_runs_performed,
+            'coffees': row.num_coffees_ordered,
+        }
+        for row in db.engine.execute(views.reconciliation_query())
+    ]
+    return _json({'balances': balances})
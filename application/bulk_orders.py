@@ -0,0 +1,120 @@
+'''
+Adding many coffees to a run at once (e.g. for a whole group).
+
+Orders are written one per line, as "<name>: <coffee>". Every line is
+parsed and priced before anything is written. The coffees are then added
+with a single INSERT, along with one batch of activity log entries, so that
+the runner can be sent one notification for the whole group.
+'''
+import collections
+
+from application import db
+from application.models import Coffee, Price, User, coffee_spec_ids, price_from_table, record_event, record_events, sydney_timezone_now
+
+import coffeespecs
+
+import sqlalchemy
+
+
+Order = collections.namedtuple('Order', ['line', 'name', 'coffee'])
+
+
+class BulkOrderError(Exception):
+    '''Some of the orders could not be understood, so none were added.'''
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def parse_orders(text):
+    '''Parse "<name>: <coffee>" lines into a list of Orders.
+
+    Raises BulkOrderError (listing every bad line) if any line is not a valid
+    order.
+    '''
+    orders = []
+    errors = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        name, sep, request = line.partition(':')
+        name = name.strip()
+        request = request.strip()
+        if not sep or not name or not request:
+            errors.append('Line {}: expected "name: coffee", got "{}"'.format(number, line))
+            continue
+        try:
+            coffee = coffeespecs.Coffee(request)
+        except (coffeespecs.JavaException, KeyError):
+            errors.append('Line {}: could not understand "{}"'.format(number, request))
+            continue
+        missing = [spec.name for spec in coffee.validation_errors()]
+        if missing:
+            errors.append('Line {}: "{}" is missing the {}'.format(number, request, ', '.join(missing)))
+            continue
+        orders.append(Order(number, name, coffee))
+    if errors:
+        raise BulkOrderError(errors)
+    if not orders:
+        raise BulkOrderError(['No orders were given'])
+    return orders
+
+
+def find_or_create_users(names):
+    '''Map each lower cased name to its User, creating any that are missing.
+
+    Names are matched case insensitively, like views.get_person. New users
+    are added to the current unit of work.
+    '''
+    wanted = {name.lower(): name for name in names}
+    users = {}
+    for user in User.query.filter(sqlalchemy.func.lower(User.name).in_(list(wanted))).order_by(User.id):
+        users.setdefault(user.name.lower(), user)
+    new_users = [User(name) for key, name in wanted.items() if key not in users]
+    if new_users:
+        db.session.add_all(new_users)
+        db.session.flush()  # Assigns the ids
+        for user in new_users:
+            record_event(user.id, 'created', 'user', user.id)
+            users[user.name.lower()] = user
+    return users
+
+
+def add_orders(run, orders, userid):
+    '''Add `orders` to `run` as part of the current unit of work.
+
+    The caller commits, and then sends events.coffees_added with the returned
+    coffee ids.
+    '''
+    prices = dict(db.session.query(Price.price_key, Price.amount).filter(Price.cafeid == run.cafeid))
+    users = find_or_create_users(order.name for order in orders)
+
+    # The mapper events that set spec_id do not run for Core inserts.
+    spec_ids = coffee_spec_ids(db.session.connection(), {order.coffee.toJSON() for order in orders})
+
+    time = sydney_timezone_now()
+    rows = [
+        {
+            'person': users[order.name.lower()].id,
+            'coffee': order.coffee.toJSON(),
+            'spec_id': spec_ids[order.coffee.toJSON()],
+            'runid': run.id,
+            'price': price_from_table(prices, order.coffee),
+            'modified': time,
+            'starttime': time,
+            'endtime': time,
+        }
+        for order in orders
+    ]
+    table = Coffee.__table__
+    if db.session.connection().dialect.name == 'postgresql':
+        # One statement, which returns the new ids.
+        result = db.session.execute(table.insert().values(rows).returning(table.c.id))
+        coffee_ids = sorted(coffee_id for coffee_id, in result)
+    else:
+        # Elsewhere (i.e. sqlite) only single row inserts give back their id.
+        coffee_ids = [db.session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+    record_events(userid, 'created', 'coffee', coffee_ids)
+    return coffee_ids
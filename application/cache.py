@@ -0,0 +1,63 @@
+"""Small in-process caches.
+
+These live in a single process, so anything cached here is only as fresh
+as its expiry time (or explicit invalidation) allows.
+"""
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    """A thread-safe, size bounded mapping whose entries expire.
+
+    Args:
+        ttl: seconds an entry stays valid for (None for no expiry).
+        maxsize: the most entries to keep. The least recently used entry is
+            evicted to make room.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, ttl=None, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
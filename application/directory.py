@@ -0,0 +1,102 @@
+'''
+Looking up users and cafes by name, for the typeahead form fields.
+
+Each directory keeps a sorted list of name prefixes in memory, so a search
+is a binary search rather than a query. The list is rebuilt (with one query
+for just the ids and names) the next time it is needed after a user or cafe
+changes in this process, or after `ttl` seconds to pick up changes made by
+other processes (e.g. users created by the chat bot).
+'''
+import bisect
+import threading
+import time
+
+from application import db
+from application.models import Cafe, User
+
+import sqlalchemy
+
+
+class Directory:
+    '''The names of every row of a model, searchable by prefix.
+
+    Names are matched case insensitively, on the start of the whole name or
+    of any word in it ("rei" finds "Maddy Reid").
+    '''
+
+    def __init__(self, model, ttl=300):
+        self.model = model
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._keys = []
+        self._entries = []
+        self._names = {}
+        self._built = None
+
+    def invalidate(self):
+        self._built = None
+
+    def _index(self):
+        with self._lock:
+            built = self._built
+            if built is None or time.monotonic() - built > self.ttl:
+                rows = db.session.query(self.model.id, self.model.name).all()
+                entries = []
+                for id, name in rows:
+                    name = name or ''
+                    words = name.lower().split()
+                    keys = {name.lower()}
+                    keys.update(' '.join(words[i:]) for i in range(len(words)))
+                    entries.extend((key, name.lower(), id) for key in keys)
+                entries.sort()
+                self._keys = [key for key, _, _ in entries]
+                self._entries = [id for _, _, id in entries]
+                self._names = {id: name or '' for id, name in rows}
+                self._built = time.monotonic()
+            return self._keys, self._entries, self._names
+
+    def __len__(self):
+        return len(self._index()[2])
+
+    def search(self, prefix, limit=10):
+        '''Up to `limit` (id, name) pairs whose name starts with `prefix`.'''
+        keys, entries, names = self._index()
+        prefix = prefix.strip().lower()
+        results = []
+        seen = set()
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix) or len(results) == limit:
+                break
+            id = entries[i]
+            if id not in seen:
+                seen.add(id)
+                results.append((id, names[id]))
+        return results
+
+    def name(self, id):
+        '''The name of the row with this id, or None if there is no such row.'''
+        name = self._index()[2].get(id)
+        if name is None:
+            # It may have been added by another process since we last looked.
+            name = db.session.query(self.model.name).filter(self.model.id == id).scalar()
+            if name is not None:
+                self.invalidate()
+        return name
+
+
+users = Directory(User)
+cafes = Directory(Cafe)
+
+
+@sqlalchemy.event.listens_for(User, "after_insert")
+@sqlalchemy.event.listens_for(User, "after_update")
+@sqlalchemy.event.listens_for(User, "after_delete")
+def _invalidate_users(mapper, connection, target):
+    users.invalidate()
+
+
+@sqlalchemy.event.listens_for(Cafe, "after_insert")
+@sqlalchemy.event.listens_for(Cafe, "after_update")
+@sqlalchemy.event.listens_for(Cafe, "after_delete")
+def _invalidate_cafes(mapper, connection, target):
+    cafes.invalidate()
@@ -0,0 +1,124 @@
+'''
+Reading and archiving the activity log.
+
+The Events table is append only, and partitioned into monthly buckets (the
+`bucket` column, see models.event_bucket). This is a logical partitioning
+that works the same way on sqlite and Postgres: every read goes through the
+(bucket, id) index, and starts from the newest bucket.
+
+Old buckets can be archived: their events are written to a gzipped JSON
+lines file (one per bucket) in EVENT_ARCHIVE_DIR, then deleted from the
+database.
+'''
+import datetime
+import gzip
+import json
+import logging
+import os
+
+from application import db
+from application.models import Event, event_bucket, sydney_timezone_now
+
+import sqlalchemy
+
+
+logger = logging.getLogger('event-store')
+
+
+def newest_bucket(before=None):
+    '''The newest bucket with any events in it (optionally, before `before`).'''
+    q = db.session.query(sqlalchemy.sql.functions.max(Event.bucket))
+    if before is not None:
+        q = q.filter(Event.bucket < before)
+    return q.scalar()
+
+
+def recent_events(limit):
+    '''The `limit` newest events, newest first.
+
+    This normally only reads the newest bucket. Older buckets are only read if
+    the newest one does not have enough events in it (e.g. at the start of a
+    month).
+    '''
+    events = []
+    bucket = newest_bucket()
+    while bucket is not None and len(events) < limit:
+        events.extend(
+                Event.query
+                .filter(Event.bucket == bucket)
+                .order_by(Event.id.desc())
+                .limit(limit - len(events)))
+        bucket = newest_bucket(before=bucket)
+    return events
+
+
+def all_events():
+    '''A query for every event that has not been archived, newest first.'''
+    return Event.query.order_by(Event.bucket.desc(), Event.id.desc())
+
+
+def retention_cutoff(months, now=None):
+    '''The oldest bucket to keep, if we keep `months` months of events.
+
+    The current month is always kept, so `months` must be at least 1.
+    '''
+    if months < 1:
+        raise ValueError('Must keep at least 1 month of events, not {}'.format(months))
+    if now is None:
+        now = sydney_timezone_now()
+    current = event_bucket(now)
+    year, month = divmod(current, 100)
+    # Count back (months - 1) months from the current one.
+    month_index = year * 12 + (month - 1) - (months - 1)
+    return (month_index // 12) * 100 + month_index % 12 + 1
+
+
+def _event_to_json(event):
+    return json.dumps({
+        'id': event.id,
+        'userid': event.userid,
+        'action': event.action,
+        'objtype': event.objtype,
+        'objid': event.objid,
+        'time': event.time.astimezone(datetime.timezone.utc).isoformat(),
+    }, sort_keys=True)
+
+
+def archive_bucket(bucket, archive_dir):
+    '''Move every event in `bucket` into a compressed archive file.
+
+    Returns the number of events archived. If the archive file already exists
+    (e.g. the bucket was archived before, and late events arrived), the new
+    events are appended to it.
+    '''
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, 'events-{}.jsonl.gz'.format(bucket))
+
+    query = Event.query.filter(Event.bucket == bucket).order_by(Event.id)
+    count = 0
+    # Appending to a gzip file adds a new member to it, which gzip readers
+    # treat as a continuation of the same file.
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        for event in query.yield_per(1000):
+            f.write(_event_to_json(event) + '\n')
+            count += 1
+
+    # Only delete the events once they are safely on disk.
+    Event.query.filter(Event.bucket == bucket).delete(synchronize_session=False)
+    db.session.commit()
+    logger.info('Archived %d events from bucket %s to %s', count, bucket, path)
+    return count
+
+
+def archive_old_events(months, archive_dir):
+    '''Archive every bucket older than the newest `months` months.
+
+    Returns the total number of events archived.
+    '''
+    cutoff = retention_cutoff(months)
+    total = 0
+    bucket = newest_bucket(before=cutoff)
+    while bucket is not None:
+        total += archive_bucket(bucket, archive_dir)
+        bucket = newest_bucket(before=cutoff)
+    return total
@@ -1,12 +1,20 @@
 '''
 Set of event types for the purpose of notifications.
 '''
+import logging
+
 __all__ = [
     'EventType',
-    'coffee_added',
+    'add_listener',
+    'activity_recorded',
+    'coffee_added', 'coffees_added',
     'run_created', 'run_closed', 'run_delivered',
 ]
 
+# Functions called (in this process) with the payload of every event, before
+# any notifications are sent. Used to invalidate caches.
+_listeners = []
+
 
 class EventType:
     NONE = 0
@@ -14,6 +22,10 @@ class EventType:
     RUN_CLOSED = 2
     RUN_DELIVERED = 3
     COFFEE_ADDED = 4
+    # Something was written to the activity log. Only sent to listeners.
+    ACTIVITY_RECORDED = 5
+    # Many coffees were added to a run at once (see bulk_orders).
+    COFFEES_ADDED = 6
 
 
 def run_created(run_id):
@@ -32,6 +44,29 @@ def coffee_added(run_id, coffee_id):
     dispatch_event({'type': EventType.COFFEE_ADDED, 'run_id': run_id, 'coffee_id': coffee_id})
 
 
+def coffees_added(run_id, coffee_ids):
+    dispatch_event({'type': EventType.COFFEES_ADDED, 'run_id': run_id, 'coffee_ids': list(coffee_ids)})
+
+
+def activity_recorded():
+    notify_listeners({'type': EventType.ACTIVITY_RECORDED})
+
+
+def add_listener(listener):
+    _listeners.append(listener)
+    return listener
+
+
+def notify_listeners(payload):
+    for listener in _listeners:
+        try:
+            listener(payload)
+        except Exception:
+            # A broken listener must not stop notifications being sent.
+            logging.exception('Error in event listener %s', listener)
+
+
 def dispatch_event(payload):
+    notify_listeners(payload)
     from application.slack_notifications import process_event
     process_event(payload)
@@ -8,21 +8,64 @@ See: http://flask.pocoo.org/docs/patterns/wtforms/
 
 """
 
+from application import directory
+
+from flask import url_for
+
 from flask_wtf import FlaskForm
 
-from wtforms import BooleanField, DecimalField, SelectField, TextField, validators
+from wtforms import BooleanField, DecimalField, SelectField, TextAreaField, TextField, validators
 from wtforms.ext.dateutil.fields import DateTimeField
 
 
+class LookupField(SelectField):
+    """Pick one user or cafe, by id, with a typeahead.
+
+    Only the chosen option is rendered. The browser (see typeahead.js) finds
+    others by asking the `endpoint` view as the user types. Validation only
+    looks up the chosen id, rather than loading every option.
+
+    Setting `choices` limits the field to those, like a SelectField.
+    """
+
+    def __init__(self, label=None, validators=None, directory=None, endpoint=None, **kwargs):
+        super(LookupField, self).__init__(label, validators, coerce=int, **kwargs)
+        self.directory = directory
+        self.endpoint = endpoint
+
+    def iter_choices(self):
+        if self.choices is not None:
+            yield from super(LookupField, self).iter_choices()
+        elif self.data is not None:
+            name = self.directory.name(self.data)
+            if name is not None:
+                yield (self.data, name, True)
+
+    def pre_validate(self, form):
+        if self.choices is not None:
+            super(LookupField, self).pre_validate(form)
+        elif self.data is None or self.directory.name(self.data) is None:
+            raise ValueError(self.gettext('Not a valid choice'))
+
+    def __call__(self, **kwargs):
+        if self.choices is None:
+            kwargs.setdefault('data-search-url', url_for(self.endpoint))
+        return super(LookupField, self).__call__(**kwargs)
+
+
 class CoffeeForm(FlaskForm):
-    person = SelectField("Addict", coerce=int)
+    person = LookupField("Addict", directory=directory.users, endpoint="search_users")
     coffee = TextField("Coffee", [validators.Required()])
     price = DecimalField("Price", default=0)
     runid = SelectField("Run", coerce=int)
 
 
+class BulkCoffeeForm(FlaskForm):
+    orders = TextAreaField("Orders (one per line, as name: coffee)", [validators.Required()])
+
+
 class RunForm(FlaskForm):
-    person = SelectField("Person", coerce=int)
+    person = LookupField("Person", directory=directory.users, endpoint="search_users")
     time = DateTimeField(
         "Time of Run",
         [validators.Required()],
@@ -30,7 +73,7 @@ class RunForm(FlaskForm):
         # works, the name does not).
         display_format="%Y/%m/%d %H:%M %z")
 
-    cafeid = SelectField("Cafe", coerce=int)
+    cafeid = LookupField("Cafe", directory=directory.cafes, endpoint="search_cafes")
     pickup = TextField("Pickup Location")
     is_open = BooleanField("Currently accepting coffees")
 
@@ -41,6 +84,6 @@ class CafeForm(FlaskForm):
 
 
 class PriceForm(FlaskForm):
-    cafeid = SelectField("Cafe", coerce=int)
+    cafeid = LookupField("Cafe", directory=directory.cafes, endpoint="search_cafes")
     price_key = TextField("Coffee (e.g. large cap)")
     amount = DecimalField("Amount", [validators.Required()])
@@ -0,0 +1,303 @@
+'''
+Pushing run updates to browsers as they happen.
+
+Changes to a run (coffees added, run closed or delivered) are published to a
+broker, and the /run/<id>/stream/ endpoint forwards them to any browsers
+looking at that run as server-sent events.
+
+There are two brokers:
+  - LocalBroker only delivers messages within this process. This is fine
+    for a single web process.
+  - PostgresBroker sends messages through Postgres' LISTEN/NOTIFY, so they
+    reach every web worker (and messages published by the chat bot reach
+    the web workers too).
+
+Pick one with the LIVE_UPDATES_BROKER config option ('local' or 'postgres').
+
+Each message gets an id when it is published. Brokers keep the last few
+messages for each channel, so a browser that reconnects (sending the id of
+the last message it saw) is sent anything it missed in between. Ids are
+times, so a browser that has seen no messages yet is given the current id
+(from current_id) to reconnect with instead.
+'''
+import collections
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+from application import events
+
+
+logger = logging.getLogger('live-updates')
+
+
+class Subscription:
+    '''Messages published to a single channel, for one reader.'''
+
+    def __init__(self, broker, channel, maxsize=100):
+        self.broker = broker
+        self.channel = channel
+        # The id this reader has seen everything up to, once the messages
+        # queued for it are read.
+        self.last_id = None
+        self._queue = queue.Queue(maxsize)
+
+    def deliver(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            # The reader has stopped reading (or is very slow). Drop the
+            # message rather than holding up the publisher.
+            logger.warning('Dropping message for slow subscriber on %s', self.channel)
+
+    def get(self, timeout=None):
+        '''The next message, or None if there was none within `timeout` seconds.'''
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    '''Publish/subscribe between threads in this process.
+
+    The last `recent_size` messages for each of the last `recent_channels`
+    channels are kept for `recent_seconds`, to be replayed to subscribers
+    that missed them.
+    '''
+
+    def __init__(self, recent_size=50, recent_channels=256, recent_seconds=300):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._recent = collections.OrderedDict()
+        self._recent_size = recent_size
+        self._recent_channels = recent_channels
+        self._recent_seconds = recent_seconds
+        self._last_id = 0
+
+    def next_id(self):
+        '''A new message id. Ids are times (in ns), so increase across processes too.'''
+        with self._lock:
+            self._last_id = max(self._last_id + 1, time.time_ns())
+            return self._last_id
+
+    def current_id(self):
+        '''An id that every message published from now on will be after.'''
+        with self._lock:
+            return self._current_id()
+
+    def _current_id(self):
+        return max(self._last_id, time.time_ns())
+
+    def subscribe(self, channel, last_id=None):
+        '''Subscribe to a channel.
+
+        If `last_id` is given, any recent messages published after it are
+        delivered first.
+        '''
+        subscription = Subscription(self, channel)
+        with self._lock:
+            if last_id is not None:
+                cutoff = time.monotonic() - self._recent_seconds
+                for received, message in self._recent.get(channel, ()):
+                    if received >= cutoff and message.get('id', 0) > last_id:
+                        subscription.deliver(message)
+                        subscription.last_id = last_id
+            if subscription.last_id is None:
+                # Nothing to catch up on.
+                subscription.last_id = self._current_id()
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.channel, None)
+
+    def publish(self, channel, message):
+        self.deliver(channel, dict(message, id=self.next_id()))
+
+    def deliver(self, channel, message):
+        '''Hand a message to the subscribers in this process.'''
+        with self._lock:
+            # Messages from other processes may be stamped ahead of this
+            # process's clock.
+            self._last_id = max(self._last_id, message.get('id', 0))
+            recent = self._recent.pop(channel, None)
+            if recent is None:
+                recent = collections.deque(maxlen=self._recent_size)
+            recent.append((time.monotonic(), message))
+            # Most recently used last, so the oldest channel is dropped first.
+            self._recent[channel] = recent
+            while len(self._recent) > self._recent_channels:
+                self._recent.popitem(last=False)
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+
+class PostgresBroker(LocalBroker):
+    '''Publish/subscribe between processes, using Postgres LISTEN/NOTIFY.
+
+    Published messages are sent to Postgres. A background thread (started
+    when the first browser subscribes) listens for them, and hands them to
+    the subscribers in this process.
+    '''
+
+    PG_CHANNEL = 'coffeerun_live_updates'
+
+    def __init__(self, dsn):
+        super().__init__()
+        self._dsn = dsn
+        self._publish_lock = threading.Lock()
+        self._publish_conn = None
+        self._listener = None
+
+    def _connect(self):
+        # psycopg2 is only installed in production.
+        import psycopg2
+        import psycopg2.extensions
+        conn = psycopg2.connect(self._dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def _start_listener(self):
+        # Messages are only kept once the listener is running, so it is
+        # started as soon as a page hands out an id to catch up from.
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                        target=self._listen, name='live-updates-listener', daemon=True)
+                self._listener.start()
+
+    def current_id(self):
+        self._start_listener()
+        return super().current_id()
+
+    def subscribe(self, channel, last_id=None):
+        self._start_listener()
+        return super().subscribe(channel, last_id)
+
+    def publish(self, channel, message):
+        payload = json.dumps({'channel': channel, 'message': dict(message, id=self.next_id())})
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publish_conn is None or self._publish_conn.closed:
+                        self._publish_conn = self._connect()
+                    with self._publish_conn.cursor() as cursor:
+                        cursor.execute('SELECT pg_notify(%s, %s)', (self.PG_CHANNEL, payload))
+                    return
+                except Exception:
+                    # The connection may have gone away. Reconnect once.
+                    logger.exception('Failed to publish to %s', channel)
+                    self._publish_conn = None
+
+    def _listen(self):
+        while True:
+            try:
+                conn = self._connect()
+                with conn.cursor() as cursor:
+                    cursor.execute('LISTEN {}'.format(self.PG_CHANNEL))
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        data = json.loads(notify.payload)
+                        self.deliver(data['channel'], data['message'])
+            except Exception:
+                logger.exception('Lost connection to Postgres, reconnecting.')
+                time.sleep(5)
+
+
+def run_channel(run_id):
+    return 'run:{}'.format(run_id)
+
+
+class StreamSlots:
+    '''Counts the streams open in this process, so that there can be a limit.
+
+    Each open stream ties up a web worker thread, so only some of them can
+    be streams.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+
+    def acquire(self, limit):
+        '''Take a slot, returning False if `limit` streams are already open.'''
+        with self._lock:
+            if self.open >= limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+
+stream_slots = StreamSlots()
+
+
+broker = None
+
+
+def init_broker(config):
+    '''Create the broker for this process, and start publishing run events.'''
+    global broker
+    kind = config.get('LIVE_UPDATES_BROKER', 'local')
+    if kind == 'local':
+        broker = LocalBroker()
+    elif kind == 'postgres':
+        broker = PostgresBroker(config['SQLALCHEMY_DATABASE_URI'])
+    else:
+        raise ValueError('Unknown LIVE_UPDATES_BROKER: {}'.format(kind))
+    events.add_listener(_publish_run_event)
+    return broker
+
+
+def _coffee_message(coffee, run_time):
+    return {
+        'type': 'coffee_added',
+        'coffee_id': coffee.id,
+        'addict_id': coffee.person,
+        'addict_name': coffee.addict.name if coffee.addict else '',
+        'description': coffee.pretty_print(),
+        'price': coffee.price,
+        'run_time': run_time,
+    }
+
+
+def _publish_run_event(payload):
+    # Imported here, as the models import this package's events module.
+    from application.models import Coffee, Run, sydney_timezone
+
+    event_type = payload['type']
+    if event_type in (events.EventType.COFFEE_ADDED, events.EventType.COFFEES_ADDED):
+        coffee_ids = payload.get('coffee_ids') or [payload['coffee_id']]
+        run = Run.query.get(payload['run_id'])
+        if run is None:
+            return
+        run_time = sydney_timezone(run.time).strftime("%I:%M %p %a %d %b")
+        coffees = Coffee.query.filter(Coffee.id.in_(coffee_ids)).order_by(Coffee.id)
+        messages = [_coffee_message(coffee, run_time) for coffee in coffees]
+    elif event_type == events.EventType.RUN_CLOSED:
+        messages = [{'type': 'run_closed'}]
+    elif event_type == events.EventType.RUN_DELIVERED:
+        messages = [{'type': 'run_delivered'}]
+    else:
+        return
+    for message in messages:
+        broker.publish(run_channel(payload['run_id']), message)
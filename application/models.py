@@ -2,9 +2,10 @@
 DB models for the ncss-coffeerun app
 Maddy Reid 2014
 """
+import json
 from datetime import datetime
 
-from application import db
+from application import db, events
 
 import coffeespecs
 
@@ -13,6 +14,11 @@ import pytz
 import sqlalchemy
 
 
+# Looked up once. pytz.timezone() is a lot slower than it looks, and this is
+# used for every datetime column of every row loaded.
+SYDNEY_TZ = pytz.timezone("Australia/Sydney")
+
+
 class UTCOnlyDateTime(sqlalchemy.types.TypeDecorator):
     """A wrapper around the sqlachemy DateTime class that stores stuff in UTC.
 
@@ -28,38 +34,56 @@ class UTCOnlyDateTime(sqlalchemy.types.TypeDecorator):
 
     def process_bind_param(self, value, dialect):
         """Convert from a tz aware object to a nieve object [in UTC]."""
+        if value is None:
+            return None
         assert value.tzinfo is not None, (
                 "Time should be tz aware, but is nieve")
-        return value.astimezone(pytz.utc).replace(tzinfo=None)
+        return value.replace(tzinfo=None) - value.utcoffset()
 
     def process_result_value(self, value, dialect):
         """Convert from a tz nieve object [in UTC] to a tz aware object."""
+        if value is None:
+            return None
         assert value.tzinfo is None, (
                 'Time should be nieve, but had timezone: %s' % value.tzinfo)
-        tz_ = pytz.timezone("Australia/Sydney")
-        return value.replace(tzinfo=pytz.utc).astimezone(tz_)
+        # fromutc takes the nieve UTC time directly, skipping the round trip
+        # through pytz.utc that astimezone would make.
+        return SYDNEY_TZ.fromutc(value)
 
 
 def sydney_timezone_now():
-    localtz = pytz.timezone("Australia/Sydney")
-    localdt = datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(localtz)
-    return localdt
+    return SYDNEY_TZ.fromutc(datetime.utcnow())
 
 
 def sydney_timezone(time):
-    localtz = pytz.timezone("Australia/Sydney")
-    localdt = time.astimezone(localtz)
-    return localdt
+    return time.astimezone(SYDNEY_TZ)
 
 
 def add_sydney_timezone(time):
-    localtz = pytz.timezone("Australia/Sydney")
-    localdt = localtz.localize(time)
-    return localdt
+    return SYDNEY_TZ.localize(time)
+
+
+def event_bucket(time):
+    """The partition (a UTC month, as YYYYMM) that an event at `time` goes in."""
+    time = time.astimezone(pytz.utc)
+    return time.year * 100 + time.month
+
+
+def _default_event_bucket(context):
+    time = context.get_current_parameters().get("time")
+    if time is None:
+        return event_bucket(sydney_timezone_now())
+    # These are the values as given (tz aware, usually in Sydney time), not
+    # yet converted to nieve UTC by UTCOnlyDateTime.
+    return event_bucket(time)
 
 
 class User(db.Model):
     __tablename__ = "Users"
+    __table_args__ = (
+        # There must only be one user per slack identity.
+        db.Index("ix_Users_slack_identity", "slack_team_id", "slack_user_id", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     slack_team_id = db.Column(db.String)
@@ -194,23 +218,102 @@ class Run(db.Model):
             "id": self.id,
             "person": self.fetcher.name,
             "time": self.jsondatetime("time"),
-            "cafe": self.cafe,
+            "cafe": self.cafe.name if self.cafe else None,
+            "cafeid": self.cafeid,
             "pickup": self.pickup,
             "is_open": self.is_open,
             "modified": self.jsondatetime("modified")
         }
 
 
+class CoffeeSpec(db.Model):
+    """A distinct coffee, as ordered.
+
+    There are far fewer of these than coffees, so coffees refer to them by
+    id (Coffee.spec_id). They also keep the coffee's description and price
+    keys, so that these can be grouped and joined on in SQL rather than
+    worked out from each coffee's JSON.
+    """
+    __tablename__ = "CoffeeSpecs"
+    id = db.Column(db.Integer, primary_key=True)
+    spec = db.Column(db.String, nullable=False, unique=True)  # json, as in Coffee.coffee
+    # These are NULL if the spec is not a valid coffee.
+    description = db.Column(db.String)
+    # From most to least specific, like coffeespecs.Coffee.get_ordered_price_keys.
+    price_key = db.Column(db.String)
+    price_key_fuzzy_type = db.Column(db.String)
+    price_key_fuzzy_size = db.Column(db.String)
+    price_key_fuzzy_strength = db.Column(db.String)
+
+    def __repr__(self):
+        return "<CoffeeSpec(%s,'%s')>" % (self.id, self.spec)
+
+
+def coffee_spec_values(spec):
+    """The CoffeeSpecs row for a coffee's JSON (Coffee.coffee)."""
+    price_key_columns = ["price_key", "price_key_fuzzy_type", "price_key_fuzzy_size", "price_key_fuzzy_strength"]
+    try:
+        c = coffeespecs.Coffee.fromJSON(spec)
+    except (coffeespecs.JavaException, ValueError, TypeError, AttributeError):
+        # Every row has every column, so that rows can be inserted together.
+        return dict({"spec": spec, "description": None}, **dict.fromkeys(price_key_columns))
+    return dict({"spec": spec, "description": str(c)}, **dict(zip(price_key_columns, c.get_ordered_price_keys())))
+
+
+# Spec ids, by spec. The rows never change, so this only needs clearing when
+# the table is dropped (i.e. in tests). Ids looked up in a transaction are
+# only added once it commits, as they may be for rows it added.
+_spec_ids = {}
+
+
+@sqlalchemy.event.listens_for(CoffeeSpec.__table__, "after_drop")
+def _forget_spec_ids(target, connection, **kwargs):
+    _spec_ids.clear()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, "commit")
+def _remember_spec_ids(connection):
+    _spec_ids.update(connection.info.pop("coffee_spec_ids", {}))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, "rollback")
+def _forget_pending_spec_ids(connection):
+    connection.info.pop("coffee_spec_ids", None)
+
+
+def coffee_spec_ids(connection, specs):
+    """Map each coffee JSON in `specs` to its CoffeeSpecs id, adding any new ones."""
+    pending = connection.info.setdefault("coffee_spec_ids", {})
+    missing = {spec for spec in specs if spec not in _spec_ids and spec not in pending}
+    if missing:
+        table = CoffeeSpec.__table__
+        values = [coffee_spec_values(spec) for spec in sorted(missing)]
+        # Another process may add the same spec at the same time. The unique
+        # index on spec means only one of us does.
+        if connection.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+            connection.execute(insert(table).on_conflict_do_nothing(index_elements=["spec"]), values)
+        else:
+            connection.execute(table.insert().prefix_with("OR IGNORE"), values)
+        rows = connection.execute(
+                sqlalchemy.select([table.c.spec, table.c.id]).where(table.c.spec.in_(missing)))
+        pending.update((spec, spec_id) for spec, spec_id in rows)
+    return {spec: _spec_ids[spec] if spec in _spec_ids else pending[spec] for spec in specs}
+
+
 class Coffee(db.Model):
     __tablename__ = "Coffees"
     id = db.Column(db.Integer, primary_key=True)
     person = db.Column(db.Integer, db.ForeignKey("Users.id"))
     coffee = db.Column(db.String)  # json field
+    # Set from `coffee` whenever it is saved.
+    spec_id = db.Column(db.Integer, db.ForeignKey("CoffeeSpecs.id"), index=True)
     runid = db.Column(db.Integer, db.ForeignKey("Runs.id"))
     modified = db.Column(UTCOnlyDateTime(timezone=False), default=sydney_timezone_now)
 
     run = db.relationship("Run", backref=db.backref("coffees"))
     addict = db.relationship("User", backref=db.backref("coffees", order_by="Coffee.id"))
+    spec = db.relationship("CoffeeSpec")
 
     price = db.Column(db.Float)  # In Dollars
 
@@ -245,21 +348,12 @@ class Coffee(db.Model):
             return 0
 
         # Lookup all prices at the same time, then determine which one to use.
-        price_keys = coffeespecs.Coffee.fromJSON(self.coffee).get_ordered_price_keys()
+        c = coffeespecs.Coffee.fromJSON(self.coffee)
         prices = Price.query.filter(
                 sqlalchemy.sql.and_(
-                    Price.price_key.in_(price_keys),
+                    Price.price_key.in_(c.get_ordered_price_keys()),
                     Price.cafeid == run.cafeid)).all()
-
-        if not prices:
-            return default_price
-        result_map = {price.price_key: price for price in prices}
-        for price_key in price_keys:
-            if price_key not in result_map:
-                continue
-            return result_map[price_key].amount
-        else:
-            assert False
+        return price_from_table({price.price_key: price.amount for price in prices}, c, default_price)
 
     def pretty_print(self):
         return str(coffeespecs.Coffee.fromJSON(self.coffee))
@@ -268,19 +362,60 @@ class Coffee(db.Model):
         return {
             "id": self.id,
             "person": self.addict.name,
-            "coffeetype": self.coffeetype,
-            "size": self.size,
-            "sugar": self.sugar,
-            "runid": self.run,
+            "coffee": self.pretty_print(),
+            "specs": json.loads(self.coffee),
+            "price": self.price,
+            "runid": self.runid,
             "modified": self.jsondatetime("modified")
         }
 
 
+@sqlalchemy.event.listens_for(Coffee, "before_insert")
+@sqlalchemy.event.listens_for(Coffee, "before_update")
+def _set_spec_id(mapper, connection, coffee):
+    if coffee.coffee is None:
+        coffee.spec_id = None
+    elif coffee.spec_id is None or sqlalchemy.inspect(coffee).attrs.coffee.history.has_changes():
+        coffee.spec_id = coffee_spec_ids(connection, [coffee.coffee])[coffee.coffee]
+
+
+def price_from_table(prices, coffee, default_price=4.0):
+    """The price of a coffeespecs.Coffee, from a {price_key: amount} table."""
+    for price_key in coffee.get_ordered_price_keys():
+        if price_key in prices:
+            return prices[price_key]
+    return default_price
+
+
+def spec_price(cafeid, default_price=None):
+    """SQL for the price of a CoffeeSpec at a cafe, like price_from_table.
+
+    `cafeid` is usually a column (e.g. Run.cafeid). Use it in a query that
+    joins CoffeeSpec.
+    """
+    prices = Price.__table__
+    return sqlalchemy.func.coalesce(*[
+        sqlalchemy.select([prices.c.amount])
+        .where(prices.c.cafeid == cafeid)
+        .where(prices.c.price_key == price_key)
+        .limit(1)
+        .as_scalar()
+        for price_key in (
+            CoffeeSpec.price_key,
+            CoffeeSpec.price_key_fuzzy_type,
+            CoffeeSpec.price_key_fuzzy_size,
+            CoffeeSpec.price_key_fuzzy_strength)
+    ], default_price)
+
+
 class Cafe(db.Model):
     __tablename__ = "Cafes"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     location = db.Column(db.String)
+    # Bumped whenever one of the cafe's prices changes. Browsers cache each
+    # version of the price list forever (see views.cafe_prices).
+    price_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     def __init__(self, name="", location=""):
         self.name = name
@@ -308,14 +443,39 @@ class Price(db.Model):
         return "<Price(%d,'%s','%f')>" % (self.cafeid, self.price_key, self.amount)
 
 
+@sqlalchemy.event.listens_for(Price, "after_insert")
+@sqlalchemy.event.listens_for(Price, "after_update")
+@sqlalchemy.event.listens_for(Price, "after_delete")
+def _bump_price_version(mapper, connection, price):
+    # Catches every way a price can change, and also the cafe a price was
+    # moved away from.
+    cafeids = {price.cafeid}
+    cafeids.update(sqlalchemy.inspect(price).attrs.cafeid.history.deleted)
+    cafes = Cafe.__table__
+    connection.execute(
+            cafes.update()
+            .where(cafes.c.id.in_(cafeid for cafeid in cafeids if cafeid is not None))
+            .values(price_version=cafes.c.price_version + 1))
+
+
 class Event(db.Model):
+    """An entry in the activity log.
+
+    Events are only ever appended (and eventually archived, see
+    application.event_store). They are partitioned by month into buckets, so
+    that reading recent activity only touches the newest bucket.
+    """
     __tablename__ = "Events"
+    __table_args__ = (
+        db.Index("ix_Events_bucket_id", "bucket", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     userid = db.Column(db.Integer, db.ForeignKey("Users.id"))
     action = db.Column(db.String)
     objtype = db.Column(db.String)
     objid = db.Column(db.Integer)
     time = db.Column(UTCOnlyDateTime(timezone=False), default=sydney_timezone_now)
+    bucket = db.Column(db.Integer, default=_default_event_bucket)
 
     user = db.relationship("User", backref=db.backref("events", order_by=id.desc()))
 
@@ -347,3 +507,47 @@ class Event(db.Model):
             else:
                 return ""
         return ""
+
+
+def record_event(userid, action, objtype, objid):
+    """Add an Event to the current session, without committing it.
+
+    Events are written in the same transaction as the change they describe, so
+    the activity log can not disagree with the data.
+    """
+    event = Event(userid, action, objtype, objid)
+    event.time = sydney_timezone_now()
+    event.bucket = event_bucket(event.time)
+    db.session.add(event)
+    db.session.info["activity_recorded"] = True
+    return event
+
+
+def record_events(userid, action, objtype, objids):
+    """Like record_event, for many objects at once, in a single INSERT."""
+    if not objids:
+        return
+    time = sydney_timezone_now()
+    db.session.execute(Event.__table__.insert(), [
+        {
+            "userid": userid,
+            "action": action,
+            "objtype": objtype,
+            "objid": objid,
+            "time": time,
+            "bucket": event_bucket(time),
+        }
+        for objid in objids
+    ])
+    db.session.info["activity_recorded"] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _after_commit(session):
+    if session.info.pop("activity_recorded", False):
+        events.activity_recorded()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("activity_recorded", None)
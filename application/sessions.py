@@ -0,0 +1,208 @@
+'''
+Where logins (and the rest of the Flask session) are kept.
+
+The SESSION_TYPE config option picks one of:
+  - 'sqlalchemy': sessions are stored in the database, and read through an
+    in-process cache (see CachedSqlAlchemySessionInterface).
+  - 'cookie': Flask's own sessions, kept in a signed cookie. These need no
+    storage at all, but anyone holding the cookie can read what is in it
+    (including the Slack token).
+  - anything else is handed to Flask-Session.
+'''
+import collections
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+from application.cache import TTLCache
+
+from flask_session import Session
+from flask_session.sessions import SqlAlchemySessionInterface
+
+from itsdangerous import BadSignature, want_bytes
+
+import sqlalchemy
+
+
+logger = logging.getLogger('sessions')
+
+# A session as it was last read from (or written to) the database.
+StoredSession = collections.namedtuple('StoredSession', ['data', 'expiry', 'version'])
+
+
+def _version(data):
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+class CachedSqlAlchemySessionInterface(SqlAlchemySessionInterface):
+    '''Flask-Session's database sessions, with fewer database round trips.
+
+    Flask-Session reads the session row twice and writes it once on every
+    request. Instead:
+      - Sessions are read from a per-process cache. The cookie holds the
+        session id and a version (a hash of the session's data), so a
+        cached session is only used if it is the version the browser last
+        saw. A session changed by another worker has a new version, and is
+        read from the database again.
+      - Sessions are only written when they change, or when their expiry
+        time needs to be pushed back (at most every `refresh_seconds`).
+      - Expired sessions are deleted by sweep_expired(), which is run every
+        `sweep_seconds` in a background thread, rather than when they are
+        next read.
+
+    A session deleted by another worker (e.g. logging out) can still be used
+    with the old cookie in this worker for up to `cache_ttl` seconds.
+    '''
+
+    def __init__(self, app, db, table, key_prefix, use_signer=False, permanent=True,
+                 cache_ttl=300, cache_size=1024, refresh_seconds=3600, sweep_seconds=3600):
+        super().__init__(app, db, table, key_prefix, use_signer, permanent)
+        self.cache = TTLCache(ttl=cache_ttl, maxsize=cache_size)
+        self.refresh = datetime.timedelta(seconds=refresh_seconds)
+        self.sweep_seconds = sweep_seconds
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+
+    def _parse_cookie(self, app, value):
+        '''The session id and version in a cookie, or None if it is not valid.'''
+        if self.use_signer:
+            signer = self._get_signer(app)
+            if signer is None:
+                return None
+            try:
+                value = signer.unsign(value).decode()
+            except BadSignature:
+                return None
+        # Cookies set before versions were added only hold the session id.
+        sid, _, version = value.partition('.')
+        return sid, version
+
+    def _make_cookie(self, app, sid, version):
+        value = '{}.{}'.format(sid, version)
+        if self.use_signer:
+            return self._get_signer(app).sign(want_bytes(value)).decode()
+        return value
+
+    def _load(self, store_id, version):
+        stored = self.cache.get(store_id)
+        if stored is not None and version and stored.version == version:
+            return stored
+
+        table = self.sql_session_model.__table__
+        with self.db.engine.connect() as conn:
+            row = conn.execute(
+                    sqlalchemy.select([table.c.data, table.c.expiry])
+                    .where(table.c.session_id == store_id)).first()
+        if row is None:
+            self.cache.pop(store_id)
+            return None
+        stored = StoredSession(row.data, row.expiry, _version(row.data))
+        self.cache.set(store_id, stored)
+        return stored
+
+    def open_session(self, app, request):
+        self._start_sweeper()
+        cookie = request.cookies.get(app.session_cookie_name)
+        parsed = self._parse_cookie(app, cookie) if cookie else None
+        if not parsed:
+            return self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+
+        sid, version = parsed
+        stored = self._load(self.key_prefix + sid, version)
+        if stored is None or (stored.expiry is not None and stored.expiry <= datetime.datetime.utcnow()):
+            # Expired sessions are left for the sweeper to delete.
+            return self.session_class(sid=sid, permanent=self.permanent)
+        try:
+            data = self.serializer.loads(want_bytes(stored.data))
+        except Exception:
+            return self.session_class(sid=sid, permanent=self.permanent)
+        session = self.session_class(data, sid=sid)
+        session.stored = stored
+        return session
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        store_id = self.key_prefix + session.sid
+        stored = getattr(session, 'stored', None)
+        table = self.sql_session_model.__table__
+
+        if not session:
+            if session.modified:
+                if stored is not None:
+                    with self.db.engine.begin() as conn:
+                        conn.execute(table.delete().where(table.c.session_id == store_id))
+                self.cache.pop(store_id)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        expires = self.get_expiration_time(app, session)
+        data = self.serializer.dumps(dict(session))
+        unchanged = stored is not None and stored.data == data
+        if unchanged and (expires is None or stored.expiry is None or expires - stored.expiry < self.refresh):
+            # Nothing to write. The cookie keeps the expiry time the database
+            # has.
+            expires = stored.expiry
+        else:
+            values = {'data': data, 'expiry': expires}
+            with self.db.engine.begin() as conn:
+                result = conn.execute(
+                        table.update().where(table.c.session_id == store_id).values(**values))
+                if result.rowcount == 0:
+                    conn.execute(table.insert().values(session_id=store_id, **values))
+            stored = StoredSession(data, expires, _version(data))
+            self.cache.set(store_id, stored)
+
+        response.set_cookie(app.session_cookie_name, self._make_cookie(app, session.sid, stored.version),
+                            expires=expires, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app))
+
+    def sweep_expired(self):
+        '''Delete every expired session. Returns how many were deleted.'''
+        table = self.sql_session_model.__table__
+        with self.db.engine.begin() as conn:
+            result = conn.execute(table.delete().where(table.c.expiry <= datetime.datetime.utcnow()))
+        return result.rowcount
+
+    def _start_sweeper(self):
+        if self._sweeper is not None or not self.sweep_seconds:
+            return
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_forever, name='session-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_seconds)
+            try:
+                count = self.sweep_expired()
+                logger.info('Deleted %d expired sessions', count)
+            except Exception:
+                logger.exception('Failed to delete expired sessions')
+
+
+def init_sessions(app):
+    '''Set up the session interface picked by the SESSION_TYPE config option.'''
+    kind = app.config.get('SESSION_TYPE')
+    if kind == 'cookie':
+        # Flask's default session interface.
+        return app.session_interface
+    if kind != 'sqlalchemy':
+        Session(app)
+        return app.session_interface
+
+    config = app.config
+    app.session_interface = CachedSqlAlchemySessionInterface(
+            app,
+            config.get('SESSION_SQLALCHEMY'),
+            config.get('SESSION_SQLALCHEMY_TABLE', 'sessions'),
+            config.get('SESSION_KEY_PREFIX', 'session:'),
+            use_signer=config.get('SESSION_USE_SIGNER', False),
+            permanent=config.get('SESSION_PERMANENT', True),
+            cache_ttl=config.get('SESSION_CACHE_TTL', 300),
+            refresh_seconds=config.get('SESSION_REFRESH_SECONDS', 3600),
+            sweep_seconds=config.get('SESSION_SWEEP_SECONDS', 3600))
+    return app.session_interface
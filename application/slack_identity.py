@@ -0,0 +1,118 @@
+'''
+Finding out who a Slack OAuth token belongs to.
+
+Logging in asks Slack who the user is (users.identity). The answer for a
+token does not change, so it is cached, and all of our calls to Slack share
+a pool of HTTPS connections rather than opening a new one each time.
+'''
+import collections
+import json
+import logging
+
+from application.cache import TTLCache
+
+import requests
+
+
+logger = logging.getLogger('slack-identity')
+
+IDENTITY_URL = 'https://slack.com/api/users.identity'
+REQUEST_TIMEOUT = 10
+
+# Shared by every request this process makes to Slack, so that connections
+# (and their TLS sessions) are reused.
+http_session = requests.Session()
+
+
+class SlackIdentityError(Exception):
+    pass
+
+
+class SlackIdentity(collections.namedtuple('SlackIdentity', ['user_id', 'name', 'team_id'])):
+    pass
+
+
+class _OAuthResponse:
+    '''The parts of a urllib response that flask_oauthlib looks at.'''
+
+    def __init__(self, resp):
+        self.code = resp.status_code
+        self.headers = resp.headers
+
+
+def http_request(uri, headers=None, data=None, method=None):
+    '''Drop in replacement for flask_oauthlib's OAuthRemoteApp.http_request.
+
+    flask_oauthlib opens a new connection with urllib for every token
+    exchange. This sends them over our pooled HTTPS session instead.
+    '''
+    if method is None:
+        method = 'POST' if data else 'GET'
+    resp = http_session.request(method, uri, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+    return _OAuthResponse(resp), resp.content
+
+
+class SlackIdentityProvider:
+    '''Looks up identities with the Slack API, caching them per token.'''
+
+    def __init__(self, ttl=300, maxsize=1024):
+        self._cache = TTLCache(ttl=ttl, maxsize=maxsize)
+
+    def lookup(self, token):
+        identity = self._cache.get(token)
+        if identity is None:
+            identity = self.fetch(token)
+            self._cache.set(token, identity)
+        return identity
+
+    def forget(self, token):
+        self._cache.pop(token)
+
+    def fetch(self, token):
+        resp = http_session.get(IDENTITY_URL, params={'token': token}, timeout=REQUEST_TIMEOUT)
+        if resp.status_code != 200:
+            logger.info('Failed to get user from slack: %s', resp)
+            raise SlackIdentityError('Error retrieving user info')
+
+        content = json.loads(resp.content.decode('utf-8'))
+        if not content['ok']:
+            logger.info('Failed to get user from slack: %s', content)
+            raise SlackIdentityError('Error retrieving user info: ' + content['error'])
+
+        return SlackIdentity(
+                user_id=content['user']['id'],
+                name=content['user']['name'],
+                team_id=content['team']['id'])
+
+
+class StubIdentityProvider:
+    '''An identity provider for tests, which never talks to Slack.
+
+    Identities are registered with `add`. Unknown tokens are rejected the
+    same way Slack rejects them.
+    '''
+
+    def __init__(self, identities=None):
+        self.identities = dict(identities or {})
+
+    def add(self, token, identity):
+        self.identities[token] = identity
+
+    def lookup(self, token):
+        try:
+            return self.identities[token]
+        except KeyError:
+            raise SlackIdentityError('Error retrieving user info: invalid_auth')
+
+    def forget(self, token):
+        pass
+
+
+def create_provider(config):
+    '''Create the identity provider selected by SLACK_IDENTITY_PROVIDER.'''
+    kind = config.get('SLACK_IDENTITY_PROVIDER', 'slack')
+    if kind == 'stub':
+        return StubIdentityProvider()
+    if kind == 'slack':
+        return SlackIdentityProvider(ttl=config.get('SLACK_IDENTITY_CACHE_TTL', 300))
+    raise ValueError('Unknown SLACK_IDENTITY_PROVIDER: {}'.format(kind))
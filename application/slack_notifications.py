@@ -8,6 +8,8 @@ from application.models import Coffee, Run, SlackTeamAccessToken, User
 
 import requests
 
+import sqlalchemy
+
 
 logger = logging.getLogger('slack-integration')
 
@@ -18,6 +20,10 @@ DEFAULT_PARAMS = {
     'parse': 'none',
     'username': 'coffeebot',
 }
+# Seconds to wait for Slack before giving up on a notification. This bounds
+# how long a slow Slack API can hold up the request (or bot message) that
+# triggered the notification.
+REQUEST_TIMEOUT = 10
 
 
 class SlackNotificationException(Exception):
@@ -53,7 +59,7 @@ class SlackNotifier:
     def notify_channel(self, message: typing.Text, team_id: typing.Text):
         params = self.get_params_for_workspace(team_id)
         params['text'] = message.encode('utf-8')
-        resp = requests.get(API_URL, params=params)
+        resp = requests.get(API_URL, params=params, timeout=REQUEST_TIMEOUT)
         content = json.loads(resp.content.decode('utf-8'))
         logger.info('Posted to channel: response:%s, content:%s', resp.status_code, content)
 
@@ -66,7 +72,7 @@ class SlackNotifier:
         params = self.get_params_for_workspace(user.slack_team_id)
         params['text'] = message.encode('utf-8')
         params['channel'] = user.slack_user_id
-        resp = requests.get(API_URL, params=params)
+        resp = requests.get(API_URL, params=params, timeout=REQUEST_TIMEOUT)
         content = json.loads(resp.content.decode('utf-8'))
         logger.info('Posted to user %s: response:%s, content:%s', user.id, resp.status_code, content)
 
@@ -105,3 +111,18 @@ def process_event(event):
         msg = u'{} added a {} to your run.'.format(coffee.addict.name, coffee.pretty_print())
 
         notifier.notify_single_user(msg, run.fetcher)
+
+    elif event_type == EventType.COFFEES_ADDED:
+        # One message for the whole group, rather than one per coffee.
+        run = Run.query.get(event['run_id'])
+        coffees = (
+                Coffee.query
+                .options(sqlalchemy.orm.joinedload(Coffee.addict))
+                .filter(Coffee.id.in_(event['coffee_ids']))
+                .order_by(Coffee.id)
+                .all())
+        msg = u'{} coffees were added to your run:\n{}'.format(
+                len(coffees),
+                '\n'.join(u'{}: {}'.format(coffee.addict.name, coffee.pretty_print()) for coffee in coffees))
+
+        notifier.notify_single_user(msg, run.fetcher)
@@ -7,21 +7,55 @@ $(document).ready(function() {
         var size = $("#size option:selected").text();
         $("#price").val(sizes[size]).number(true, 2);
     });
-    //$("#runid").change(function() {
-    //    $.getJSON($SCRIPT_ROOT + "/_prices_for_run/", {
-    //        runid: $(this).val()
-    //    }, function(data) {
-    //        sizes = {};
-    //        $("#size").find("option").remove();
-    //        $.each(data, function(key, val) {
-    //            sizes[key] = val;
-    //            var optStr = '<option value="' + key + '">' + key + '</option>';
-    //            $("#size").append(optStr);
-    //        });
-    //        $("#size").val(origsize);
-    //        $("#size").change();
-    //    });
-    //});
+    // Price lists, by URL. The URLs include the price list's version, so the
+    // browser only ever downloads each version once.
+    var priceLists = {};
+    function withPrices(runid, callback) {
+        var url = $PRICE_URLS[runid];
+        if (!url) {
+            return;
+        }
+        if (priceLists[url]) {
+            callback(priceLists[url]);
+            return;
+        }
+        $.getJSON(url, function(data) {
+            priceLists[url] = data.prices;
+            callback(data.prices);
+        });
+    }
+    $("#runid").change(function() {
+        var runid = $(this).val();
+        $("#cafe-prices").text("");
+        withPrices(runid, function(prices) {
+            // The run may have changed while we were waiting.
+            if ($("#runid").val() !== runid) {
+                return;
+            }
+            var items = $.map(prices, function(amount, priceKey) {
+                return priceKey + " $" + amount.toFixed(2);
+            });
+            $("#cafe-prices").text(items.length ? "Prices: " + items.join(", ") : "");
+        });
+    });
+    // Show how the coffee will be understood (and what it will cost) as it
+    // is typed. This is only a preview: the server parses it again on save.
+    function previewCoffee() {
+        var coffee = CoffeeParser.parse($("#coffee").val());
+        if (!coffee.validate()) {
+            $("#coffee-preview").text("");
+            return;
+        }
+        $("#coffee-preview").text(coffee.toString());
+        withPrices($("#runid").val(), function(prices) {
+            var price = coffee.lookupPrice(prices, null);
+            if (price !== null && $("#coffee-preview").text() === coffee.toString()) {
+                $("#coffee-preview").text(coffee.toString() + " (about $" + price.toFixed(2) + ")");
+            }
+        });
+    }
+    $("#coffee").on("input", previewCoffee);
+    $("#runid").change(previewCoffee);
     $("#recurring").change(function() {
         if ($(this).is(":checked")) {
             $(".recurringFields").show();
@@ -30,8 +64,7 @@ $(document).ready(function() {
         }
     });
 
-    //$("#runid").val(origrun);
-    //$("#runid").change();
+    $("#runid").change();
     $("#size").change();
     $("#recurring").change();
 
@@ -0,0 +1,232 @@
+// A port of the coffee parser in coffeespecs.py, so that orders can be
+// previewed and priced in the browser. The vocabulary comes from
+// coffeespecs-data.js, which is generated by export_coffeespecs.py.
+// test_coffeeparser.py checks that this agrees with the Python parser, so
+// change both together.
+var CoffeeParser = (function() {
+    "use strict";
+
+    function has(object, key) {
+        return Object.prototype.hasOwnProperty.call(object, key);
+    }
+
+    function Coffee(tables, request) {
+        this.tables = tables;
+        this.specs = {};
+
+        request = request.toLowerCase().trim();
+        // Strip punctuation except for '-' which is used in some tokens.
+        // Most get replaced with space but apostrophes are just removed.
+        request = request.replace(/'/g, "");
+        request = request.replace(/["!#$%&()*+,./:;<=>?@[\]\\^_`{|}~]/g, " ");
+
+        var requestTokens = request.split(/\s+/).filter(function(token) {
+            return token.length > 0;
+        });
+        var wordTokens = {};
+        tables.word_tokens.forEach(function(token) {
+            wordTokens[token] = true;
+        });
+
+        // A Set iterates in insertion order, which matches the Python
+        // parser's ordering of tokens.
+        var unparsed = new Set(requestTokens);
+        for (var i = 0; i + 1 < requestTokens.length; i++) {
+            var bigram = requestTokens[i] + " " + requestTokens[i + 1];
+            if (has(wordTokens, bigram)) {
+                this.addToken(bigram);
+                if (!unparsed.delete(requestTokens[i]) || !unparsed.delete(requestTokens[i + 1])) {
+                    throw new Error("Could not parse: " + bigram);
+                }
+            }
+        }
+
+        var self = this;
+        Array.from(unparsed).forEach(function(token) {
+            if (has(wordTokens, token)) {
+                self.addToken(token);
+                unparsed.delete(token);
+            }
+        });
+
+        Array.from(unparsed).forEach(function(token) {
+            var result = parseAbbreviation(tables.abbreviation_tokens, token, tables.precedence);
+            if (result) {
+                result.forEach(function(match) {
+                    self.addSpec(match[0], match[1]);
+                });
+                unparsed.delete(token);
+            }
+        });
+    }
+
+    Coffee.prototype.optionValue = function(spec, value) {
+        var tables = this.tables.specs[spec];
+        value = value.toLowerCase();
+        if (has(tables.words, value)) {
+            return tables.words[value];
+        }
+        if (has(tables.abbreviations, value)) {
+            return tables.abbreviations[value];
+        }
+        return null;
+    };
+
+    Coffee.prototype.addToken = function(token) {
+        var precedence = this.tables.precedence;
+        for (var i = 0; i < precedence.length; i++) {
+            var spec = precedence[i];
+            if (this.optionValue(spec, token) !== null && !has(this.specs, spec)) {
+                this.addSpec(spec, token);
+                return;
+            }
+        }
+    };
+
+    Coffee.prototype.addSpec = function(spec, value) {
+        var option = this.optionValue(spec, value);
+        if (option === null) {
+            return false;
+        }
+        this.specs[spec] = option;
+        return true;
+    };
+
+    Coffee.prototype.validate = function() {
+        var specs = this.tables.specs;
+        for (var spec in specs) {
+            if (has(specs, spec) && specs[spec].required && !has(this.specs, spec)) {
+                return false;
+            }
+        }
+        return true;
+    };
+
+    Coffee.prototype.getPriceKey = function(fuzzyFields) {
+        fuzzyFields = fuzzyFields || [];
+        var fuzzy = function(spec) {
+            return fuzzyFields.indexOf(spec) !== -1;
+        };
+        var tokens = [];
+        var specs = this.specs;
+        var tables = this.tables;
+        tables.out_order.forEach(function(spec) {
+            if (spec === "type" && fuzzy(spec) && tables.cappuccino_equiv.indexOf(specs[spec]) !== -1) {
+                tokens.push("Cappuccino");
+                return;
+            }
+            if (spec === "size") {
+                // Default to regular size if not specified.
+                var size = has(specs, spec) ? specs[spec] : "Regular";
+                // If fuzzy matching, consider small and regular to be the same.
+                if (fuzzy(spec) && size === "Small") {
+                    size = "Regular";
+                }
+                tokens.push(size);
+                return;
+            }
+            if (spec === "strength") {
+                var strength = has(specs, spec) ? specs[spec] : "Normal";
+                if (fuzzy(spec) && strength === "Weak") {
+                    strength = "Normal";
+                }
+                if (strength !== "Normal") {
+                    tokens.push(strength);
+                }
+                return;
+            }
+            if (has(specs, spec)) {
+                if (spec === "sugar") {
+                    // Assume no one charges for sugar
+                    return;
+                }
+                if (spec === "milk") {
+                    // Only output the milk if it's soy
+                    if (tables.soy_milks.indexOf(specs[spec]) !== -1) {
+                        tokens.push("Soy");
+                    }
+                    return;
+                }
+                tokens.push(specs[spec]);
+            }
+        });
+        return tokens.join(" ");
+    };
+
+    // The most specific price key first, then less specific ones.
+    Coffee.prototype.getOrderedPriceKeys = function() {
+        return [
+            this.getPriceKey(),
+            this.getPriceKey(["type"]),
+            this.getPriceKey(["type", "size"]),
+            this.getPriceKey(["type", "size", "strength"]),
+        ];
+    };
+
+    // The price of this coffee from a cafe's price list, like
+    // models.Coffee.lookup_price.
+    Coffee.prototype.lookupPrice = function(prices, defaultPrice) {
+        var keys = this.getOrderedPriceKeys();
+        for (var i = 0; i < keys.length; i++) {
+            if (has(prices, keys[i])) {
+                return prices[keys[i]];
+            }
+        }
+        return defaultPrice;
+    };
+
+    Coffee.prototype.toString = function() {
+        var tokens = [];
+        var specs = this.specs;
+        this.tables.out_order.forEach(function(spec) {
+            if (spec === "size" && !has(specs, spec)) {
+                tokens.push("Regular");
+            }
+            if (has(specs, spec)) {
+                if (spec === "sugar") {
+                    tokens.push("with");
+                }
+                tokens.push(specs[spec]);
+            }
+        });
+        return tokens.join(" ");
+    };
+
+    function parseAbbreviation(abbreviationTokens, tokenInput, remainingSpecs) {
+        var i, j, spec;
+        for (i = 0; i < remainingSpecs.length; i++) {
+            spec = remainingSpecs[i];
+            if (abbreviationTokens[spec].indexOf(tokenInput) !== -1) {
+                return [[spec, tokenInput]];
+            }
+        }
+
+        for (i = 0; i < remainingSpecs.length; i++) {
+            spec = remainingSpecs[i];
+            var tokens = abbreviationTokens[spec];
+            for (j = 0; j < tokens.length; j++) {
+                var token = tokens[j];
+                if (tokenInput.indexOf(token) === 0) {
+                    var otherSpecs = remainingSpecs.filter(function(other) {
+                        return other !== spec;
+                    });
+                    var remainderResult = parseAbbreviation(abbreviationTokens, tokenInput.slice(token.length), otherSpecs);
+                    if (remainderResult !== null) {
+                        return [[spec, token]].concat(remainderResult);
+                    }
+                }
+            }
+        }
+        return null;
+    }
+
+    return {
+        parse: function(request, tables) {
+            return new Coffee(tables || COFFEE_SPECS_DATA, request);
+        },
+    };
+})();
+
+if (typeof module !== "undefined") {
+    module.exports = CoffeeParser;
+}
@@ -0,0 +1,2 @@
+// Generated from coffeespecs.py by export_coffeespecs.py. Do not edit.
+var COFFEE_SPECS_DATA = {"abbreviation_tokens":{"decaf":[],"iced":[],"milk":["sk","lf","y"],"size":["sm","lg","s","r","l"],"strength":["xx","st","x","w"],"sugar":["11s","10s","+11","+10","9s","8s","7s","6s","5s","4s","3s","2s","1s","11","10","0s","+9","+8","+7","+6","+5","+4","+3","+2","+1","+0","9","8","7","6","5","4","3","2","1"],"type":["lat","cap","sb","lb","hc","fw","es","cd","cb","af","l","c"]},"cappuccino_equiv":["Cappuccino","Chai Latte","Flat White","Hot Chocolate","Latte","Long Black","Macchiato","Mocha","Piccolo Latte","Short Black"],"out_order":["size","iced","milk","strength","decaf","type","sugar"],"precedence":["type","size","milk","strength","iced","decaf","sugar"],"soy_milks":["Lactose Free","Soy"],"specs":{"decaf":{"abbreviations":{},"required":false,"words":{"dec":"Decaf","decaf":"Decaf"}},"iced":{"abbreviations":{},"required":false,"words":{"hot":"normal","ice":"Iced","iced":"Iced","icey":"Iced","icy":"Iced","normal":"normal"}},"milk":{"abbreviations":{"lf":"Lactose Free","sk":"Skim","y":"Soy"},"required":false,"words":{"fullcream":"Fullcream","lactose free":"Lactose Free","light":"Skim","lite":"Skim","normal":"Fullcream","sk":"Skim","skim":"Skim","skinny":"Skim","soy":"Soy"}},"size":{"abbreviations":{"l":"Large","lg":"Large","r":"Regular","s":"Small","sm":"Small"},"required":false,"words":{"large":"Large","lg":"Large","lge":"Large","lrg":"Large","reg":"Regular","regular":"Regular","small":"Small","smol":"Small"}},"strength":{"abbreviations":{"st":"Extra-shot","w":"Weak","x":"Extra-shot","xx":"2 Extra-shots"},"required":false,"words":{"2 extra-shots":"2 Extra-shots","double":"Extra-shot","double-shot":"Extra-shot","doubleshot":"Extra-shot","extra-shot":"Extra-shot","half":"Weak","half-strength":"Weak","normal":"Normal","standard":"Normal","strong":"Extra-shot","triple":"2 Extra-shots","triple-shot":"2 Extra-shots","tripleshot":"2 Extra-shots","weak":"Weak"}},"sugar":{"abbreviations":{"+0":"No sugar","+1":"1 Sugar","+10":"10 Sugars","+11":"11 Sugars","+2":"2 Sugars","+3":"3 Sugars","+4":"4 Sugars","+5":"5 Sugars","+6":"6 Sugars","+7":"7 Sugars","+8":"8 Sugars","+9":"9 Sugars","0s":"No sugar","1":"1 Sugar","10":"10 Sugars","10s":"10 Sugars","11":"11 Sugars","11s":"11 Sugars","1s":"1 Sugar","2":"2 Sugars","2s":"2 Sugars","3":"3 Sugars","3s":"3 Sugars","4":"4 Sugars","4s":"4 Sugars","5":"5 Sugars","5s":"5 Sugars","6":"6 Sugars","6s":"6 Sugars","7":"7 Sugars","7s":"7 Sugars","8":"8 Sugars","8s":"8 Sugars","9":"9 Sugars","9s":"9 Sugars"},"required":false,"words":{"0sugar":"No sugar","1 sugar":"1 Sugar","10 sugars":"10 Sugars","10sugar":"10 Sugars","11 sugars":"11 Sugars","11sugar":"11 Sugars","1sugar":"1 Sugar","2 sugars":"2 Sugars","2sugar":"2 Sugars","3 sugars":"3 Sugars","3sugar":"3 Sugars","4 sugars":"4 Sugars","4sugar":"4 Sugars","5 sugars":"5 Sugars","5sugar":"5 Sugars","6 sugars":"6 Sugars","6sugar":"6 Sugars","7 sugars":"7 Sugars","7sugar":"7 Sugars","8 sugars":"8 Sugars","8sugar":"8 Sugars","9 sugars":"9 Sugars","9sugar":"9 Sugars","no sugar":"No sugar","sugar":"1 Sugar","with 1":"1 Sugar"}},"type":{"abbreviations":{"af":"Affogato","c":"Cappuccino","cap":"Cappuccino","cb":"Cold Drip","cd":"Cold Drip","es":"Espresso","fw":"Flat White","hc":"Hot Chocolate","l":"Latte","lat":"Latte","lb":"Long Black","sb":"Short Black"},"required":true,"words":{"affogato":"Affogato","babyccino":"Babyccino","babycino":"Babyccino","cap":"Cappuccino","capp":"Cappuccino","cappuccino":"Cappuccino","chai":"Chai Latte","chai latte":"Chai Latte","choc":"Hot Chocolate","chocolate":"Hot Chocolate","cold brew":"Cold Drip","cold drip":"Cold Drip","espresso":"Espresso","filtered":"Filtered","flat white":"Flat White","frothaccino":"Babyccino","hot c":"Hot Chocolate","hot choc":"Hot Chocolate","hot chocc":"Hot Chocolate","hot choccie":"Hot Chocolate","hot chocco":"Hot Chocolate","hot choccy":"Hot Chocolate","hot chocie":"Hot Chocolate","hot chockie":"Hot Chocolate","hot chocky":"Hot Chocolate","hot chocolate":"Hot Chocolate","iced choc":"Iced Chocolate","iced chocc":"Iced Chocolate","iced choccie":"Iced Chocolate","iced chocco":"Iced Chocolate","iced choccy":"Iced Chocolate","iced chocie":"Iced Chocolate","iced chockie":"Iced Chocolate","iced chocky":"Iced Chocolate","iced chocolate":"Iced Chocolate","iced coffee":"Iced Coffee","icey choc":"Iced Chocolate","icey chocc":"Iced Chocolate","icey choccie":"Iced Chocolate","icey chocco":"Iced Chocolate","icey choccy":"Iced Chocolate","icey chocie":"Iced Chocolate","icey chockie":"Iced Chocolate","icey chocky":"Iced Chocolate","icy choc":"Iced Chocolate","icy chocc":"Iced Chocolate","icy choccie":"Iced Chocolate","icy chocco":"Iced Chocolate","icy choccy":"Iced Chocolate","icy chocie":"Iced Chocolate","icy chockie":"Iced Chocolate","icy chocky":"Iced Chocolate","lat":"Latte","latte":"Latte","lattee":"Latte","long black":"Long Black","mac":"Macchiato","macc":"Macchiato","macchiato":"Macchiato","moch":"Mocha","mocha":"Mocha","piccolo":"Piccolo Latte","piccolo latte":"Piccolo Latte","short black":"Short Black","tea":"Tea"}}},"word_tokens":["iced chocolate","piccolo latte","hot chocolate","half-strength","2 extra-shots","lactose free","icey chockie","icey choccie","iced chockie","iced choccie","triple-shot","short black","icy chockie","icy choccie","icey chocky","icey chocie","icey choccy","icey chocco","iced coffee","iced chocky","iced chocie","iced choccy","iced chocco","hot chockie","hot choccie","frothaccino","double-shot","tripleshot","long black","icy chocky","icy chocie","icy choccy","icy chocco","icey chocc","iced chocc","hot chocky","hot chocie","hot choccy","hot chocco","flat white","extra-shot","doubleshot","chai latte","cappuccino","macchiato","icy chocc","icey choc","iced choc","hot chocc","fullcream","cold drip","cold brew","chocolate","babyccino","11 sugars","10 sugars","standard","no sugar","icy choc","hot choc","filtered","espresso","babycino","affogato","9 sugars","8 sugars","7 sugars","6 sugars","5 sugars","4 sugars","3 sugars","2 sugars","regular","piccolo","11sugar","10sugar","1 sugar","with 1","triple","strong","skinny","normal","lattee","double","9sugar","8sugar","7sugar","6sugar","5sugar","4sugar","3sugar","2sugar","1sugar","0sugar","sugar","small","mocha","light","latte","large","hot c","decaf","weak","smol","skim","moch","macc","lite","icey","iced","half","choc","chai","capp","tea","soy","reg","mac","lrg","lge","lat","icy","ice","hot","dec","cap","sk","lg"]};
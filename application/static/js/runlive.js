@@ -0,0 +1,46 @@
+// Live updates for a run, pushed by the server from /run/<id>/stream/.
+$(document).ready(function() {
+    var $live = $("[data-live-run]");
+    if (!$live.length || !window.EventSource) {
+        return;
+    }
+    var runid = $live.data("live-run");
+    // Catch up on anything published since the page was made.
+    var source = new EventSource($SCRIPT_ROOT + "/run/" + runid + "/stream/?last_id=" + $live.data("live-last-id"));
+
+    function showStatus(html) {
+        $("#run-live-status").html('<div class="alert alert-info">' + html + '</div>');
+    }
+
+    function addCoffeeRow(coffee) {
+        var $rows = $live.find(".coffee-rows");
+        var $row = $("<tr>");
+        $row.append($("<td>").append($("<a>").attr("href", "/coffee/" + coffee.coffee_id + "/").text(coffee.coffee_id)));
+        $row.append($("<td>").append($("<a>").attr("href", "/user/" + coffee.addict_id).text(coffee.addict_name)));
+        $row.append($("<td>").text(coffee.description));
+        // Coffees with no price at the cafe have a null price.
+        $row.append($("<td>").text(coffee.price === null ? "\u2014" : "$" + coffee.price.toFixed(2)));
+        $row.append($("<td>").append($("<a>").attr("href", "/run/" + runid + "/").text(coffee.run_time)));
+        $rows.append($row);
+
+        var $total = $live.find(".coffee-total");
+        var total = parseFloat($total.text().replace("$", "")) + (coffee.price || 0);
+        $total.text("$" + total.toFixed(2));
+    }
+
+    source.addEventListener("coffee_added", function(e) {
+        var coffee = JSON.parse(e.data);
+        if ($live.data("live-mode") === "rows") {
+            addCoffeeRow(coffee);
+        } else {
+            showStatus('New coffees have been added to this run. <a href="">Refresh</a> to see them.');
+        }
+    });
+    source.addEventListener("run_closed", function() {
+        showStatus("This run has been closed. No more coffees can be added.");
+        $(".run-open-only").hide();
+    });
+    source.addEventListener("run_delivered", function() {
+        showStatus("The coffees in this run have been delivered.");
+    });
+});
@@ -0,0 +1,45 @@
+// Typeahead for forms.LookupField: a select that only has the chosen user or
+// cafe in it. Typing in the search box above it fills it with the matching
+// ones, from the field's data-search-url.
+$(document).ready(function() {
+    $("select[data-search-url]").each(function() {
+        var select = $(this);
+        var url = select.data("search-url");
+        var search = $('<input type="search" class="form-control" placeholder="Type to search" autocomplete="off">');
+        var pending = null;
+        var latest = "";
+        select.before(search);
+
+        function showResults(results) {
+            var chosen = select.val();
+            select.empty();
+            $.each(results, function(i, result) {
+                select.append($("<option>").val(result.id).text(result.name));
+            });
+            // Keep the current choice if it is still there, otherwise pick
+            // the best match.
+            if (chosen !== null && select.find("option[value='" + chosen + "']").length) {
+                select.val(chosen);
+            }
+            select.change();
+        }
+
+        search.on("input", function() {
+            var query = $.trim(search.val());
+            clearTimeout(pending);
+            if (!query) {
+                return;
+            }
+            // Wait for a pause in typing before asking the server.
+            pending = setTimeout(function() {
+                latest = query;
+                $.getJSON(url, {q: query}, function(data) {
+                    // Ignore answers to older searches.
+                    if (query === latest) {
+                        showResults(data.results);
+                    }
+                });
+            }, 150);
+        });
+    });
+});
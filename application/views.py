@@ -1,35 +1,40 @@
 # vim: set et nosi ai ts=4 sts=4 sw=4:
 
 import cgi
+import collections
 import csv
 import datetime
+import hashlib
 import io
-import itertools
 import json
 import logging
+import time
 
-from application import app, db, events, lm
-from application.forms import CafeForm, CoffeeForm, PriceForm, RunForm
-from application.models import Cafe, Coffee, Event, Price, Run, SlackTeamAccessToken, User, sydney_timezone, sydney_timezone_now
+from application import app, bulk_orders, db, directory, event_store, events, live_updates, lm, slack_identity
+from application.cache import TTLCache
+from application.forms import BulkCoffeeForm, CafeForm, CoffeeForm, PriceForm, RunForm
+from application.models import Cafe, Coffee, CoffeeSpec, Price, Run, SlackTeamAccessToken, User, record_event, sydney_timezone, sydney_timezone_now
 
 import coffeespecs
 
-from flask import Response, flash, jsonify, redirect, render_template, request, session, url_for
+from flask import Response, flash, jsonify, make_response, redirect, render_template, request, session, url_for
 
 from flask_babel import numbers
 
-from flask_login import current_user, login_required, login_user, logout_user
+from flask_login import UserMixin, current_user, login_required, login_user, logout_user
 
 from flask_oauthlib.client import OAuth
 
-import pytz
+from markupsafe import Markup
 
-import requests
+import pytz
 
 import sqlalchemy
 
 import utils
 
+from werkzeug.http import is_resource_modified
+
 
 oauth = OAuth(app)
 
@@ -60,31 +65,79 @@ slack_team_auth = oauth.remote_app(
     authorize_url='https://slack.com/oauth/authorize'
 )
 
+# Exchange OAuth codes over our pooled HTTPS connections.
+slack_user_auth.http_request = slack_identity.http_request
+slack_team_auth.http_request = slack_identity.http_request
+
+identity_provider = slack_identity.create_provider(app.config)
+
+live_updates.init_broker(app.config)
+
+
+class LoggedInUser(UserMixin):
+    """The logged in user, with just what is needed to show who they are.
+
+    This is not attached to a database session, so it can be kept between
+    requests. Load the User for anything else (e.g. their coffees).
+    """
+
+    def __init__(self, id, name, slack_user_id, slack_team_id):
+        self.id = id
+        self.name = name
+        self.slack_user_id = slack_user_id
+        self.slack_team_id = slack_team_id
+
+    def __repr__(self):
+        return "<LoggedInUser(%d,%s)>" % (self.id, self.name)
+
+    def __eq__(self, other):
+        # Also equal to the User it came from.
+        if isinstance(other, (LoggedInUser, User)):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = UserMixin.__hash__
+
+
+# The users who have logged in recently, by id. Entries are thrown away when
+# the user changes in this process, and expire so that changes made by other
+# processes are picked up.
+logged_in_users = TTLCache(ttl=app.config['USER_CACHE_TTL'], maxsize=1024)
+
+
+@sqlalchemy.event.listens_for(User, "after_update")
+@sqlalchemy.event.listens_for(User, "after_delete")
+def _forget_logged_in_user(mapper, connection, target):
+    logged_in_users.pop(str(target.id))
+
 
 @lm.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    user = logged_in_users.get(user_id)
+    if user is None:
+        row = db.session.query(User.id, User.name, User.slack_user_id, User.slack_team_id) \
+            .filter(User.id == user_id) \
+            .first()
+        if row is None:
+            return None
+        user = LoggedInUser(*row)
+        logged_in_users.set(user_id, user)
+    return user
 
 
 def get_user_from_slack_token():
-    logger = logging.getLogger('views.get_user_from_slack_token')
     token = session.get('slack_token')[0]
-    resp = requests.get('http://slack.com/api/users.identity', params={'token': token})
-    if resp.status_code != 200:
-        logger.info('Failed to get user from slack: %s', resp)
-        flash('Error retrieving user info')
-        return None
-
-    content = json.loads(resp.content.decode('utf-8'))
-    if not content['ok']:
-        logger.info('Failed to get user from slack: %s', content)
-        flash('Error retrieving user info: ' + content['error'])
+    try:
+        identity = identity_provider.lookup(token)
+    except slack_identity.SlackIdentityError as e:
+        flash(str(e))
         return None
 
-    name = content['user']['name']
-    slack_id = content['user']['id']
-    slack_team = content['team']['id']
-    user = utils.get_or_create_user(slack_id, slack_team, name)
+    user = utils.get_or_create_user(identity.user_id, identity.team_id, identity.name)
     return user
 
 
@@ -99,31 +152,64 @@ def _format_time(t):
     return t.strftime("%I:%M %p %a %d %b")
 
 
-@app.template_filter('sort_and_group_coffees')
-def _sort_coffees(coffees):
-    # This is a giant hack to group the coffees together, sorted by the
-    # arbitary ordering below.
-    coffees = list(coffees)
-
-    def _normalize_coffee_spec(coffee_model):
-        coffee_spec = json.loads(coffee_model.coffee)
-        coffee_spec['size'] = coffee_spec.get('size', 'Regular')
-        return coffee_spec
-
-    def _key_for_coffee(coffee_model):
-        coffee_spec = _normalize_coffee_spec(coffee_model)
-        # XXX: Giant hack to deal with the fact that some caffes only have 2 sizes.
-        if coffee_spec['size'] == 'Small':
-            coffee_spec['size'] = 'Regular'
-        SPEC_ORDERING = ['size', 'iced', 'type', 'decaf', 'strength', 'milk', 'sugar']
-        spec_result = tuple(coffee_spec.get(spec, '') for spec in SPEC_ORDERING)
-        return spec_result
-
-    coffees.sort(key=_key_for_coffee)
+# The order coffees are listed in for the barista.
+SPEC_ORDERING = ['size', 'iced', 'type', 'decaf', 'strength', 'milk', 'sugar']
+
+# A line of a run's order: `count` coffees of the same kind, and who they are
+# for.
+OrderLine = collections.namedtuple('OrderLine', ['description', 'count', 'names', 'min_price', 'max_price', 'subtotal'])
+
+
+def _spec_order(spec):
+    coffee_spec = json.loads(spec)
+    coffee_spec['size'] = coffee_spec.get('size', 'Regular')
+    # XXX: Giant hack to deal with the fact that some caffes only have 2 sizes.
+    if coffee_spec['size'] == 'Small':
+        coffee_spec['size'] = 'Regular'
+    return tuple(coffee_spec.get(spec, '') for spec in SPEC_ORDERING)
+
+
+def _names(column):
+    """SQL to join the names in a group together."""
+    if db.engine.dialect.name == 'postgresql':
+        return sqlalchemy.func.string_agg(column, ', ')
+    return sqlalchemy.func.group_concat(column, ', ')
+
+
+def order_summary(runid):
+    """The coffees in a run, grouped by kind, as a list of OrderLines.
+
+    This is one grouped query, and the coffees themselves are never loaded.
+    Coffees with the same description (e.g. "Large Latte") are grouped
+    together, so a coffee without a size is counted with the regular ones.
+    Coffees that could not be understood are flashed, and left out.
+    """
+    price = sqlalchemy.func.coalesce(Coffee.price, 0)
+    rows = db.session.query(
+            CoffeeSpec.description,
+            sqlalchemy.func.min(CoffeeSpec.spec),
+            sqlalchemy.func.count(Coffee.id),
+            _names(User.name),
+            sqlalchemy.func.min(price),
+            sqlalchemy.func.max(price),
+            sqlalchemy.func.sum(price)) \
+        .select_from(Coffee) \
+        .outerjoin(CoffeeSpec, Coffee.spec_id == CoffeeSpec.id) \
+        .outerjoin(User, Coffee.person == User.id) \
+        .filter(Coffee.runid == runid) \
+        .group_by(CoffeeSpec.description) \
+        .all()
 
-    return ((group_key, list(group_iter))
-            for group_key, group_iter in itertools.groupby(
-                coffees, _normalize_coffee_spec))
+    lines = []
+    for description, spec, count, names, min_price, max_price, subtotal in rows:
+        if description is None:
+            flash('Failed to parse coffee for {}.'.format(names), 'failure')
+            continue
+        lines.append((_spec_order(spec), OrderLine(description, count, names or '', min_price, max_price, subtotal)))
+    # There are only a few kinds of coffee, so they are sorted here rather
+    # than in SQL (where it would mean decoding each coffee's JSON).
+    lines.sort(key=lambda line: line[0])
+    return [line for _, line in lines]
 
 
 def _filter_coffees(coffee_list):
@@ -139,12 +225,105 @@ def _filter_coffees(coffee_list):
     return ret
 
 
+def _conditional(render, last_modified, *version):
+    """Return render(), or 304 Not Modified if the browser's copy is current.
+
+    `version` should identify everything shown on the page. It is hashed
+    (along with who is looking) into a weak ETag. `last_modified` is the time
+    of the newest change to any of it, or None.
+
+    Pages are not cached while there are flashed messages waiting, as those
+    are only shown once.
+    """
+    if session.get('_flashes'):
+        response = make_response(render())
+        response.cache_control.no_store = True
+        return response
+
+    etag = hashlib.sha1(repr((current_user.get_id(),) + version).encode('utf-8')).hexdigest()
+    if last_modified is not None:
+        # HTTP dates are in UTC.
+        last_modified = last_modified.astimezone(pytz.utc).replace(tzinfo=None)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response(render())
+    else:
+        response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Browsers may keep a copy, but must check with us before using it.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _run_version(run):
+    """(last modified, version) of a run and its coffees, for _conditional."""
+    count, max_id, max_modified = db.session.query(
+            sqlalchemy.func.count(Coffee.id),
+            sqlalchemy.func.max(Coffee.id),
+            sqlalchemy.func.max(Coffee.modified),
+    ).filter(Coffee.runid == run.id).one()
+    # The count and newest id catch coffees being deleted or moved away.
+    times = [t for t in (run.modified, max_modified) if t is not None]
+    return (max(times) if times else None), ('run', run.id, run.modified, count, max_id, max_modified, _names_version(run))
+
+
+def _names_version(run):
+    """The names shown on a run's pages, which have no modified time.
+
+    That is the cafe, and everyone fetching or ordering.
+    """
+    people = db.session.query(User.id, User.name).filter(sqlalchemy.or_(
+            User.id == run.person,
+            User.id.in_(db.session.query(Coffee.person).filter(Coffee.runid == run.id)),
+    )).order_by(User.id)
+    cafe = db.session.query(Cafe.name, Cafe.location).filter(Cafe.id == run.cafeid).first()
+    return tuple(tuple(row) for row in people), tuple(cafe) if cafe else None
+
+
+def _price_urls(runs):
+    """Map each run's id to the URL of its cafe's current price list."""
+    versions = dict(db.session.query(Cafe.id, Cafe.price_version))
+    return {
+        run.id: url_for("cafe_prices", cafeid=run.cafeid, v=versions[run.cafeid])
+        for run in runs if run.cafeid in versions
+    }
+
+
+# Rendered fragments of the home page, which is the most visited page. These
+# do not depend on who is looking at them, and are thrown away whenever a run
+# or coffee changes, or something is added to the activity log.
+home_fragments = TTLCache(ttl=app.config['HOME_FRAGMENT_CACHE_TTL'], maxsize=8)
+
+
+@events.add_listener
+def _invalidate_home_fragments(payload):
+    home_fragments.clear()
+
+
+def _cached_fragment(name, render):
+    html = home_fragments.get(name)
+    if html is None:
+        html = Markup(render())
+        home_fragments.set(name, html)
+    return html
+
+
 @app.route("/")
 @login_required
 def home():
-    run = next_run()
-    events = Event.query.order_by(Event.time.desc())[:4]
-    return render_template("index.html", run=run, events=events, current_user=current_user)
+    next_run_html = _cached_fragment(
+            'next_run',
+            lambda: render_template("includes/next_run.html", run=next_run()))
+    recent_activity_html = _cached_fragment(
+            'recent_activity',
+            lambda: render_template("includes/recent_activity.html", events=event_store.recent_events(4)))
+    return render_template(
+            "index.html",
+            next_run_html=next_run_html,
+            recent_activity_html=recent_activity_html,
+            current_user=current_user)
 
 
 @app.route('/team-auth/')
@@ -227,7 +406,9 @@ def login():
 @app.route("/logout/")
 @login_required
 def logout():
-    session.pop('slack_token', None)
+    token = session.pop('slack_token', None)
+    if token:
+        identity_provider.forget(token[0])
     logout_user()
     return redirect(url_for("login"))
 
@@ -278,7 +459,7 @@ def view_all_prices():
 @app.route("/activity/", methods=["GET"])
 @login_required
 def view_activity():
-    events = Event.query.order_by(Event.time.desc()).all()
+    events = event_store.all_events().all()
     return render_template("viewallactivity.html", events=events, current_user=current_user)
 
 
@@ -286,24 +467,96 @@ def view_activity():
 @login_required
 def view_run(runid):
     run = Run.query.filter_by(id=runid).first_or_404()
-    return render_template(
-        "viewrun.html",
-        run=run,
-        coffees=_filter_coffees(run.coffees),
-        current_user=current_user,
-    )
+    return _conditional(
+        lambda: render_template(
+            "viewrun.html",
+            run=run,
+            coffees=_filter_coffees(run.coffees),
+            current_user=current_user,
+            live_last_id=live_updates.broker.current_id(),
+        ),
+        *_run_version(run))
 
 
 @app.route("/order/<int:runid>/")
 @login_required
 def view_order(runid):
     run = Run.query.filter_by(id=runid).first_or_404()
-    return render_template(
-        "orderrun.html",
-        run=run,
-        coffees=_filter_coffees(run.coffees),
-        current_user=current_user,
-    )
+    last_modified, version = _run_version(run)
+    return _conditional(
+        lambda: render_template(
+            "orderrun.html",
+            run=run,
+            order=order_summary(run.id),
+            current_user=current_user,
+            live_last_id=live_updates.broker.current_id(),
+        ),
+        last_modified, 'order', version)
+
+
+# How long (in ms) browsers wait before reconnecting to a stream, normally
+# and when there were no streams free.
+STREAM_RETRY_MS = 1000
+STREAM_BUSY_RETRY_MS = 15000
+
+
+@app.route("/run/<int:runid>/stream/")
+@login_required
+def stream_run(runid):
+    """Stream changes to a run to the browser, as server-sent events.
+
+    Each open stream ties up a worker thread, so streams are short (they end
+    after LIVE_UPDATES_STREAM_SECONDS and the browser reconnects) and there
+    are at most LIVE_UPDATES_MAX_STREAMS open in each process. When they are
+    all in use, the browser is told to try again later.
+
+    Every response tells the browser an id to reconnect with (as its
+    Last-Event-ID), and messages published after it are replayed when it
+    does. The page gives the id to start from as `last_id`, so nothing
+    published after the page was made is missed either.
+    """
+    Run.query.filter_by(id=runid).first_or_404()
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    }
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_id', ''))
+    except ValueError:
+        last_id = None
+    if not live_updates.stream_slots.acquire(app.config['LIVE_UPDATES_MAX_STREAMS']):
+        if last_id is None:
+            last_id = live_updates.broker.current_id()
+        return Response('retry: {}\nid: {}\n\n'.format(STREAM_BUSY_RETRY_MS, last_id),
+                        mimetype='text/event-stream', headers=headers)
+
+    subscription = live_updates.broker.subscribe(live_updates.run_channel(runid), last_id)
+    stream_seconds = app.config['LIVE_UPDATES_STREAM_SECONDS']
+    keepalive_seconds = app.config['LIVE_UPDATES_KEEPALIVE_SECONDS']
+
+    def generate():
+        yield 'retry: {}\nid: {}\n\n'.format(STREAM_RETRY_MS, subscription.last_id)
+        deadline = time.monotonic() + stream_seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            message = subscription.get(timeout=min(keepalive_seconds, remaining))
+            if message is None:
+                # Comments keep proxies from closing the idle connection.
+                yield ': keepalive\n\n'
+                continue
+            yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(message['id'], message['type'], json.dumps(message))
+
+    def close():
+        subscription.close()
+        live_updates.stream_slots.release()
+
+    response = Response(generate(), mimetype='text/event-stream', headers=headers)
+    # Run when the server is done with the response, even if the browser went
+    # away before the stream started.
+    response.call_on_close(close)
+    return response
 
 
 @app.route("/run/<int:runid>/edit/", methods=["GET", "POST"])
@@ -311,10 +564,6 @@ def view_order(runid):
 def edit_run(runid):
     run = Run.query.filter_by(id=runid).first_or_404()
     form = RunForm(request.form, obj=run)
-    users = User.query.all()
-    form.person.choices = [(user.id, user.name) for user in users]
-    cafes = Cafe.query.all()
-    form.cafeid.choices = [(cafe.id, cafe.name) for cafe in cafes]
 
     if request.method == "GET":
         return render_template("runform.html", form=form, formtype="Edit", current_user=current_user)
@@ -328,8 +577,8 @@ def edit_run(runid):
         run.pickup = form.data["pickup"]
         run.time = form.data["time"]
         run.is_open = form.data["is_open"]
+        run.modified = sydney_timezone_now()
 
-        db.session.commit()
         write_to_events("updated", "run", run.id)
         db.session.commit()
         flash("Run edited", "success")
@@ -345,8 +594,10 @@ def edit_run(runid):
 def next_status_for_run(runid):
     run = Run.query.filter_by(id=runid).first_or_404()
     run.is_open = False
+    run.modified = sydney_timezone_now()
     # Create Money exchanges to pay for the purchased coffees.
     db.session.add(run)
+    write_to_events("updated", "run", run.id)
     db.session.commit()
     try:
         events.run_closed(runid)
@@ -354,7 +605,6 @@ def next_status_for_run(runid):
         logging.exception('Error while trying to send notifications.')
         flash('Error occurred while trying to send notifications. Please tell Maddy, Elmo, or Katie.\n{}'.format(
             cgi.escape(str(e), quote=True)), "failure")
-    write_to_events("updated", "run", run.id)
     flash("Run closed", "success")
     return redirect(url_for("view_run", runid=run.id))
 
@@ -380,7 +630,13 @@ def ping_addicts_for_run(runid):
 def view_coffee(coffeeid):
     coffee = Coffee.query.filter(Coffee.id == coffeeid).first_or_404()
     logging.info('Coffee: %s, %s', coffee, coffee.price)
-    return render_template("viewcoffee.html", coffee=coffee, current_user=current_user)
+    run_modified = coffee.run.modified if coffee.run else None
+    times = [t for t in (coffee.modified, run_modified) if t is not None]
+    return _conditional(
+        lambda: render_template("viewcoffee.html", coffee=coffee, current_user=current_user),
+        max(times) if times else None,
+        'coffee', coffee.id, coffee.modified, coffee.runid, run_modified,
+        coffee.addict.name if coffee.addict else None)
 
 
 @app.route("/coffee/<int:coffeeid>/edit/", methods=["GET", "POST"])
@@ -395,15 +651,14 @@ def edit_coffee(coffeeid):
     # closed. We do this by adding the existing coffee run to the dropdown.
     if coffee.run and coffee.run.id not in [r.id for r in runs]:
         form.runid.choices.append((coffee.run.id, coffee.run.prettyprint()))
+        runs.append(coffee.run)
 
     c = coffeespecs.Coffee.fromJSON(coffee.coffee)
-    users = User.query.all()
-    form.person.choices = [(user.id, user.name) for user in users]
 
     if request.method == "GET":
         form.coffee.data = str(c)
         form.runid.data = coffee.runid
-        return render_template("coffeeform.html", form=form, formtype="Edit", price=coffee.price, current_user=current_user)
+        return render_template("coffeeform.html", form=form, formtype="Edit", price=coffee.price, price_urls=_price_urls(runs), current_user=current_user)
 
     if request.method == "POST" and form.validate_on_submit():
         coffee.coffee = coffeespecs.Coffee(form.data["coffee"]).toJSON()
@@ -411,17 +666,18 @@ def edit_coffee(coffeeid):
         coffee.runid = form.data['runid']
         coffee.person = form.data['person']
         coffee.modified = sydney_timezone_now()
-        db.session.commit()
         write_to_events("updated", "coffee", coffee.id)
+        db.session.commit()
         flash("Coffee edited", "success")
         return redirect(url_for("view_coffee", coffeeid=coffee.id))
     else:
         for field, errors in form.errors.items():
             flash("Error in %s: %s" % (field, "; ".join(errors)), "danger")
-        return render_template("coffeeform.html", form=form, formtype="Edit", current_user=current_user)
+        return render_template("coffeeform.html", form=form, formtype="Edit", price_urls=_price_urls(runs), current_user=current_user)
 
 
-def _reconciliation_query():
+def reconciliation_query():
+    """Each user's balance, and how much they are owed and owe."""
     # Infomation about what each person is owed by the system (aka information
     # about run owners).
     coffee_money_owed = sqlalchemy.sql.select(
@@ -498,7 +754,7 @@ def _reconciliation_query():
 @app.route("/user/", methods=["GET"])
 @login_required
 def view_all_users():
-    money_by_person = _reconciliation_query()
+    money_by_person = reconciliation_query()
 
     user_summary = db.engine.execute(money_by_person)
     return render_template(
@@ -512,7 +768,7 @@ def download_reconcile_csv():
     file = io.StringIO()
     writer = csv.DictWriter(file, ('Name', 'Balance', 'Owed by system', 'Owed to system'))
     writer.writeheader()
-    for addict_summary in db.engine.execute(_reconciliation_query()):
+    for addict_summary in db.engine.execute(reconciliation_query()):
         row = {
             'Name': addict_summary.name,
             'Balance': numbers.format_currency(addict_summary.summary, 'AUD'),
@@ -577,8 +833,8 @@ def edit_cafe(cafeid):
 
     if request.method == "POST" and form.validate_on_submit():
         form.populate_obj(cafe)
-        db.session.commit()
         write_to_events("updated", "cafe", cafe.id)
+        db.session.commit()
         flash("Cafe edited", "success")
         return redirect(url_for("view_cafe", cafeid=cafeid))
     else:
@@ -592,13 +848,9 @@ def edit_cafe(cafeid):
 @login_required
 def add_run(cafeid=None):
     form = RunForm(request.form)
-    users = User.query.all()
-    form.person.choices = [(user.id, user.name) for user in users]
-    cafes = Cafe.query.all()
-    if not cafes:
+    if not len(directory.cafes):
         flash("There are no cafes currently configured. Please add one before creating a run", "warning")
         return redirect(url_for("home"))
-    form.cafeid.choices = [(cafe.id, cafe.name) for cafe in cafes]
 
     if request.method == "GET":
         if cafeid:
@@ -630,6 +882,8 @@ def add_run(cafeid=None):
         run.is_open = form.data["is_open"]
 
         db.session.add(run)
+        db.session.flush()  # Assigns run.id
+        write_to_events("created", "run", run.id)
         db.session.commit()
         try:
             events.run_created(run.id)
@@ -637,7 +891,6 @@ def add_run(cafeid=None):
             logging.exception('Error while trying to send notifications.')
             flash('Error occurred while trying to send notifications. Please tell Maddy, Elmo, or Katie.\n{}'.format(
                 cgi.escape(str(e), quote=True)), "failure")
-        write_to_events("created", "run", run.id)
         flash("Run added", "success")
         return redirect(url_for("view_run", runid=run.id))
     else:
@@ -651,8 +904,8 @@ def add_run(cafeid=None):
 def delete_run(runid):
     run = Run.query.filter_by(id=runid).first_or_404()
     db.session.delete(run)
-    db.session.commit()
     write_to_events("deleted", "run", run.id)
+    db.session.commit()
     flash("Run %d deleted" % runid, "success")
     return redirect(url_for("view_all_runs"))
 
@@ -667,17 +920,15 @@ def add_coffee(runid=None):
     form.runid.choices = [(-1, '')] + [(r.id, r.prettyprint()) for r in runs]
     if runid:
         run = Run.query.filter_by(id=runid).first()
-        localmodified = run.time.replace(tzinfo=pytz.timezone("Australia/Sydney"))
-        if sydney_timezone_now() > localmodified:
+        # run.time is already in Sydney time.
+        if sydney_timezone_now() > run.time:
             flash("You can't add coffees to this run", "danger")
             return redirect(url_for("view_run", runid=runid))
         form.runid.data = runid
-    users = User.query.all()
-    form.person.choices = [(user.id, user.name) for user in users]
 
     if request.method == "GET":
         form.person.data = current_user.id
-        return render_template("coffeeform.html", form=form, formtype="Add", current_user=current_user)
+        return render_template("coffeeform.html", form=form, formtype="Add", price_urls=_price_urls(runs), current_user=current_user)
 
     if form.validate_on_submit():
         logger.info('Form: %s', form.data)
@@ -693,8 +944,9 @@ def add_coffee(runid=None):
             run = Run.query.filter_by(id=form.data["runid"]).first()
         coffee.modified = sydney_timezone_now()
         db.session.add(coffee)
-        db.session.commit()
+        db.session.flush()  # Assigns coffee.id
         write_to_events("created", "coffee", coffee.id)
+        db.session.commit()
         if form.data["runid"] != -1:
             try:
                 events.coffee_added(coffee.runid, coffee.id)
@@ -707,7 +959,39 @@ def add_coffee(runid=None):
     else:
         for field, errors in form.errors.items():
             flash("Error in %s: %s" % (field, "; ".join(errors)), "danger")
-        return render_template("coffeeform.html", form=form, current_user=current_user)
+        return render_template("coffeeform.html", form=form, price_urls=_price_urls(runs), current_user=current_user)
+
+
+@app.route("/run/<int:runid>/addcoffees/", methods=["GET", "POST"])
+@login_required
+def add_coffees(runid):
+    run = Run.query.filter_by(id=runid).first_or_404()
+    if not run.is_open:
+        flash("You can't add coffees to this run", "danger")
+        return redirect(url_for("view_run", runid=runid))
+    form = BulkCoffeeForm(request.form)
+
+    if request.method == "POST" and form.validate_on_submit():
+        try:
+            orders = bulk_orders.parse_orders(form.data["orders"])
+        except bulk_orders.BulkOrderError as e:
+            for error in e.errors:
+                flash(error, "danger")
+        else:
+            coffee_ids = bulk_orders.add_orders(run, orders, current_user.id)
+            db.session.commit()
+            try:
+                events.coffees_added(run.id, coffee_ids)
+            except Exception as e:
+                logging.exception('Error while trying to send notifications.')
+                flash('Error occurred while trying to send notifications. Please tell Maddy, Elmo, or Katie.\n{}'.format(
+                    cgi.escape(str(e), quote=True)), "failure")
+            flash("%d coffees added" % len(coffee_ids), "success")
+            return redirect(url_for("view_run", runid=run.id))
+    else:
+        for field, errors in form.errors.items():
+            flash("Error in %s: %s" % (field, "; ".join(errors)), "danger")
+    return render_template("bulkcoffeeform.html", form=form, run=run, current_user=current_user)
 
 
 @app.route("/_prices_for_run/")
@@ -715,11 +999,63 @@ def add_coffee(runid=None):
 def prices_for_run():
     logger = logging.getLogger('views.prices_for_run')
     runid = request.args.get("runid", 0, type=int)
-    run = Run.query.filter_by(id=runid).first()
-    prices = run.cafe.pricelist
+    run = Run.query.filter_by(id=runid).first_or_404()
+    # Prices have no modified time, so the version is the price list itself.
+    # Only the two columns are loaded, and the JSON is only built if needed.
+    prices = db.session.query(Price.price_key, Price.amount).filter(
+            Price.cafeid == run.cafeid).order_by(Price.id).all()
     logger.info('Prices for cafe: %s', prices)
-    jprices = {p.price_key: p.amount for p in prices}
-    return jsonify(**jprices)
+    return _conditional(
+        lambda: jsonify(**{price_key: amount for price_key, amount in prices}),
+        None,
+        'prices', run.cafeid, tuple(prices))
+
+
+@app.route("/cafe/<int:cafeid>/prices.json")
+@login_required
+def cafe_prices(cafeid):
+    """A cafe's price list.
+
+    Asked for with ?v=<the cafe's current price_version>, the response can
+    never change (any change to the prices bumps the version, and so the
+    URL), so browsers are told to keep it forever. Any other version gets the
+    current prices, but uncached.
+    """
+    cafe = Cafe.query.filter_by(id=cafeid).first_or_404()
+    prices = db.session.query(Price.price_key, Price.amount).filter(Price.cafeid == cafe.id).all()
+    response = jsonify(
+        version=cafe.price_version,
+        prices={price_key: amount for price_key, amount in prices},
+    )
+    if request.args.get("v", type=int) == cafe.price_version:
+        # Private, as the price lists are only for logged in users.
+        response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _search(found):
+    """The results for a typeahead field (see forms.LookupField)."""
+    limit = min(request.args.get("limit", 10, type=int), 50)
+    response = jsonify(results=[
+        {"id": id, "name": name}
+        for id, name in found.search(request.args.get("q", ""), limit)
+    ])
+    response.headers["Cache-Control"] = "private, max-age=60"
+    return response
+
+
+@app.route("/user/search.json")
+@login_required
+def search_users():
+    return _search(directory.users)
+
+
+@app.route("/cafe/search.json")
+@login_required
+def search_cafes():
+    return _search(directory.cafes)
 
 
 @app.route("/cafe/add/", methods=["GET", "POST"])
@@ -734,8 +1070,9 @@ def add_cafe():
         cafe.name = form.data["name"]
         cafe.location = form.data["location"]
         db.session.add(cafe)
-        db.session.commit()
+        db.session.flush()  # Assigns cafe.id
         write_to_events("created", "cafe", cafe.id)
+        db.session.commit()
         flash("Cafe added", "success")
         return redirect(url_for("view_cafe", cafeid=cafe.id))
     else:
@@ -755,12 +1092,12 @@ def add_cafe_price(cafeid=None):
         form.cafeid.choices = [(cafe.id, cafe.name)]
         form.cafeid.data = cafe.id
     else:
-        cafes = Cafe.query.all()
-        if not cafes:
+        cafe = Cafe.query.order_by(Cafe.id).first()
+        if cafe is None:
             flash("There are no existing cafes. Would you like to make one instead?", "warning")
             return redirect(url_for("home"))
-        form.cafeid.choices = [(c.id, c.name) for c in cafes]
-        cafe = cafes[0]
+        if request.method == "GET":
+            form.cafeid.data = cafe.id
 
     if request.method == "GET":
         return render_template("priceform.html", cafe=cafe, form=form, formtype="Add", current_user=current_user)
@@ -807,8 +1144,8 @@ def edit_price(priceid):
         form.populate_obj(price)
         coffee = coffeespecs.Coffee(form.data["price_key"])
         price.price_key = coffee.get_price_key()
-        db.session.commit()
         write_to_events("updated", "price", price.id)
+        db.session.commit()
         flash("Price updated for cafe '%s'" % price.cafe.name, "success")
         return redirect(url_for("view_cafe", cafeid=price.cafe.id))
     else:
@@ -822,8 +1159,8 @@ def edit_price(priceid):
 def delete_price(priceid):
     price = Price.query.filter_by(id=priceid).first_or_404()
     db.session.delete(price)
-    db.session.commit()
     write_to_events("deleted", "price", price.id)
+    db.session.commit()
     flash("Price %d deleted" % priceid, "success")
     return redirect(url_for("view_all_cafes"))
 
@@ -833,8 +1170,8 @@ def delete_price(priceid):
 def delete_coffee(coffeeid):
     coffee = Coffee.query.filter_by(id=coffeeid).first_or_404()
     db.session.delete(coffee)
-    db.session.commit()
     write_to_events("deleted", "coffee", coffee.id)
+    db.session.commit()
     flash("Coffee %d deleted" % coffeeid, "success")
     return redirect(url_for("view_all_coffees"))
 
@@ -844,8 +1181,8 @@ def delete_coffee(coffeeid):
 def delete_cafe(cafeid):
     cafe = Cafe.query.filter_by(id=cafeid).first_or_404()
     db.session.delete(cafe)
-    db.session.commit()
     write_to_events("deleted", "cafe", cafe.id)
+    db.session.commit()
     flash("Cafe %d deleted" % cafeid, "success")
     return redirect(url_for("view_all_cafes"))
 
@@ -856,24 +1193,29 @@ def next_run():
 
 
 def get_person(name):
+    """Find a user by name, creating them if needed.
+
+    A new user is added to the current unit of work. It is up to the caller to
+    commit it.
+    """
     person = User.query.filter(User.name.like(name)).first()
     if not person:
         person = User(name)
         db.session.add(person)
-        db.session.commit()
+        db.session.flush()  # Assigns person.id
         write_to_events("created", "user", person.id, person)
     return person
 
 
 def write_to_events(action, objtype, objid, user=None):
-    if user:
-        event = Event(user.id, action, objtype, objid)
-    else:
-        event = Event(current_user.id, action, objtype, objid)
-    event.time = sydney_timezone_now()
-    db.session.add(event)
-    db.session.commit()
-    return event.id
+    """Record an event as part of the current unit of work.
+
+    The event is committed along with the change it describes, by the
+    caller's db.session.commit().
+    """
+    if user is None:
+        user = current_user
+    return record_event(user.id, action, objtype, objid)
 
 
 # Error handlers
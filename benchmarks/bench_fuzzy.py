@@ -0,0 +1,44 @@
+"""Micro-benchmark for correcting misspelt words in coffee orders.
+
+Compares comparing a word with every word token (the obvious approach) with
+looking it up in the symmetric deletion index (fuzzy.FuzzyIndex), which is
+what coffeespecs.correct_token uses.
+
+Usage: python benchmarks/bench_fuzzy.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import coffeespecs  # noqa: E402,I100
+
+from fuzzy import FuzzyIndex, edit_distance  # noqa: E402
+
+WORDS = ['cappucino', 'flatwhite', 'lattte', 'expresso', 'please', 'machiato', 'larg', 'xyzzy']
+
+
+def brute_force(tokens, word, max_distance=2):
+    matches = [(edit_distance(word, token), token) for token in tokens]
+    return sorted(match for match in matches if match[0] <= max_distance)
+
+
+def main():
+    tokens = coffeespecs.get_all_word_tokens()
+    index = FuzzyIndex(tokens)
+    for word in WORDS:
+        assert brute_force(tokens, word) == [(m.distance, m.word) for m in index.lookup(word)]
+
+    number = 200
+    build = timeit.timeit(lambda: FuzzyIndex(tokens), number=10) / 10
+    old = timeit.timeit(lambda: [brute_force(tokens, word) for word in WORDS], number=number)
+    new = timeit.timeit(lambda: [index.lookup(word) for word in WORDS], number=number)
+    per_word = number * len(WORDS)
+    print('{} word tokens, index built in {:.1f} ms'.format(len(tokens), build * 1000))
+    print('brute force: {:.1f} us per word'.format(old / per_word * 1e6))
+    print('index:       {:.1f} us per word'.format(new / per_word * 1e6))
+
+
+if __name__ == '__main__':
+    main()
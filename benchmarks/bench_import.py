@@ -0,0 +1,52 @@
+"""Startup time of each entry point.
+
+Each entry point is imported in a fresh interpreter (so nothing is cached
+between runs), and the best of a few runs is reported. This covers what a
+dyno pays on every restart before it can do any work.
+
+Usage: python benchmarks/bench_import.py [--repeat N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = [
+    # The models, as used by scripts like reprice_coffees.py.
+    ('models', 'import application.models'),
+    ('coffeebot', 'import coffeebot'),
+    ('manage', 'import manage'),
+    # What gunicorn loads (run-heroku.py).
+    ('web', 'import application; application.init_web()'),
+]
+
+
+def time_import(statement):
+    '''Seconds taken to run `statement` in a new interpreter.'''
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', statement], cwd=ROOT, check=True)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = min(time_import('pass') for _ in range(args.repeat))
+    print('{:<12} {:>8.1f} ms'.format('python', baseline * 1000))
+    for name, statement in ENTRY_POINTS:
+        try:
+            best = min(time_import(statement) for _ in range(args.repeat))
+        except subprocess.CalledProcessError:
+            print('{:<12} {:>11}'.format(name, 'failed'))
+            continue
+        print('{:<12} {:>8.1f} ms'.format(name, (best - baseline) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Micro-benchmark for routing chat messages to handlers.
+
+Compares trying each pattern in turn (the old approach) with the combined
+CommandRouter.
+
+Usage: python benchmarks/bench_router.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from router import CommandRouter, load_triggers  # noqa: E402,I100
+
+# Kept in sync with coffeebot.ORDER_ROUTES (importing coffeebot needs the
+# whole web app).
+ORDER_ROUTES = [
+    (r'(?:(?:open|list) )?runs', 'list_runs'),
+    (r'(?:(?:list) )?cafes', 'list_cafes'),
+    (r'create run cafe=(?P<cafeid>[0-9]+) time=(?P<time>(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2})) pickup=(?P<pickup>.*)', 'create_run'),
+    (r'group order(?: run=(?P<runid>[0-9]+))?\s*\n(?P<orders>[\s\S]+)', 'group_order'),
+    (r'order(?: an?)? ([^\=]+)(?: run=(?P<runid>[0-9]+))?', 'order_coffee'),
+    (r'([^\=]+) (?:plz|pls|please|plox|plx)(?: run=(?P<runid>[0-9]+))?', 'order_coffee'),
+    (r'close run(?: run=(?P<runid>[0-9]+))?', 'close_run'),
+    (r'announce run(?: run=(?P<runid>[0-9]+))?', 'announce_delivery'),
+]
+
+MESSAGES = [
+    'order a large soy latte',
+    'lc please run=3',
+    'runs',
+    'close run',
+    'hello',
+    'what is the meaning of life',
+    'i would like a pumpkin spice latte',
+    'create run cafe=1 time=2020-01-04 07:30 pickup=ABS Building',
+]
+
+
+def linear_scan(routes, triggers, text):
+    for pattern, target in routes:
+        match = pattern.match(text)
+        if match:
+            break
+    for pattern, responses in triggers:
+        if pattern.match(text):
+            return True
+    return False
+
+
+def main():
+    sass = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sass.txt')
+    trigger_routes = load_triggers(sass)
+
+    compiled_routes = [(re.compile(p), t) for p, t in ORDER_ROUTES]
+    compiled_triggers = [(re.compile(p), r) for p, r in trigger_routes]
+    orders_router = CommandRouter(ORDER_ROUTES)
+    trigger_router = CommandRouter(trigger_routes)
+
+    def old():
+        for text in MESSAGES:
+            linear_scan(compiled_routes, compiled_triggers, text)
+
+    def new():
+        for text in MESSAGES:
+            orders_router.route(text)
+            trigger_router.route(text)
+
+    number = 2000
+    for name, fn in [('linear scan', old), ('combined router', new)]:
+        best = min(timeit.repeat(fn, number=number, repeat=5))
+        print('{:>16}: {:.2f} us/message'.format(
+                name, best / (number * len(MESSAGES)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
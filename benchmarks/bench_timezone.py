@@ -0,0 +1,47 @@
+"""Micro-benchmark for loading UTCOnlyDateTime columns.
+
+Compares the old per-row conversion (looking up the timezone and converting
+through pytz.utc) with the current one (a module level zone and fromutc).
+Loading a list page calls this for every datetime column of every row.
+
+Usage: python benchmarks/bench_timezone.py
+"""
+import datetime
+import timeit
+
+import pytz
+
+
+SYDNEY_TZ = pytz.timezone("Australia/Sydney")
+
+
+# Kept in sync with models.UTCOnlyDateTime.process_result_value (importing
+# the models needs the whole web app).
+def old_process_result_value(value):
+    tz_ = pytz.timezone("Australia/Sydney")
+    return value.replace(tzinfo=pytz.utc).astimezone(tz_)
+
+
+def new_process_result_value(value):
+    if value is None:
+        return None
+    return SYDNEY_TZ.fromutc(value)
+
+
+def main():
+    # A spread of times across a few years, so that both sides of the
+    # daylight saving transitions are covered.
+    start = datetime.datetime(2018, 1, 1)
+    values = [start + datetime.timedelta(hours=7 * i) for i in range(10000)]
+
+    for old, new in zip(values, values):
+        assert old_process_result_value(old) == new_process_result_value(new)
+        assert old_process_result_value(old).utcoffset() == new_process_result_value(new).utcoffset()
+
+    for name, fn in [('old', old_process_result_value), ('new', new_process_result_value)]:
+        seconds = min(timeit.repeat(lambda: [fn(v) for v in values], number=10, repeat=5))
+        print('{:>4}: {:.2f} us/row'.format(name, seconds / (10 * len(values)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import logging
 import os
@@ -6,20 +7,44 @@ import random
 import re
 import threading
 import time
-import typing
 
-from application import app, db, events, models
-from application.models import Cafe, Coffee, Event, Run, User
-from application.models import add_sydney_timezone, sydney_timezone, sydney_timezone_now
+from application import app, bulk_orders, db, events, live_updates, models
+from application.models import Cafe, Coffee, Run, User
+from application.models import add_sydney_timezone, record_event, sydney_timezone, sydney_timezone_now
 
 import coffeespecs
 
-import flask_babel
+from router import CommandRouter, get_trigger_table
 
 from slackclient import SlackClient
 
+from timeformat import format_timedelta
+
 import utils
 
+from workers import KeyedWorkerPool
+
+
+# The commands we understand, tried in order. Each pattern maps to the name of
+# the WrappedSlackBot method that handles it.
+ORDER_ROUTES = [
+    (r'(?:(?:open|list) )?runs', 'list_runs'),
+    (r'(?:(?:list) )?cafes', 'list_cafes'),
+    (r'create run cafe=(?P<cafeid>[0-9]+) time=(?P<time>(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2})) pickup=(?P<pickup>.*)', 'create_run'),
+    (r'group order(?: run=(?P<runid>[0-9]+))?\s*\n(?P<orders>[\s\S]+)', 'group_order'),
+    (r'order(?: an?)? ([^\=]+)(?: run=(?P<runid>[0-9]+))?', 'order_coffee'),
+    (r'([^\=]+) (?:plz|pls|please|plox|plx)(?: run=(?P<runid>[0-9]+))?', 'order_coffee'),
+    (r'close run(?: run=(?P<runid>[0-9]+))?', 'close_run'),
+    (r'announce run(?: run=(?P<runid>[0-9]+))?', 'announce_delivery'),
+]
+
+SASS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sass.txt')
+
+# These are compiled once, and shared by all of the workspace connections.
+# Edits to the sass file are picked up without restarting the bot.
+ORDERS_ROUTER = CommandRouter(ORDER_ROUTES)
+TRIGGERS = get_trigger_table(SASS_FILE, hot_reload=True)
+
 
 class WrappedSlackBot:
     TOKEN = None
@@ -29,28 +54,28 @@ class WrappedSlackBot:
     MENTION_RE = re.compile(r'<@([A-Z0-9]+)\|?[^>]*>:?')
     EMOJI_RE = re.compile(r':[a-z]+:')
 
-    def __init__(self, token, user_id, team_id):
+    def __init__(self, token, user_id, team_id, pool=None):
         self.TOKEN = token
         self.USER_ID = user_id
         self.TEAM_ID = team_id
 
         self.DISPATCH = {}
-        self.ORDERS_DISPATCH = {}
-        self.TRIGGERS = {}
-
-        # Configure the dispatcher regular expressions
-        self.ORDERS_DISPATCH[re.compile(r'(?:(?:open|list) )?runs')] = self.list_runs
-        self.ORDERS_DISPATCH[re.compile(r'(?:(?:list) )?cafes')] = self.list_cafes
-        self.ORDERS_DISPATCH[re.compile(r'create run cafe=(?P<cafeid>[0-9]+) time=(?P<time>(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2})) pickup=(?P<pickup>.*)')] = self.create_run
-        self.ORDERS_DISPATCH[re.compile(r'order(?: an?)? ([^\=]+)(?: run=(?P<runid>[0-9]+))?')] = self.order_coffee
-        self.ORDERS_DISPATCH[re.compile(r'([^\=]+) (?:plz|pls|please|plox|plx)(?: run=(?P<runid>[0-9]+))?')] = self.order_coffee
-        self.ORDERS_DISPATCH[re.compile(r'close run(?: run=(?P<runid>[0-9]+))?')] = self.close_run
-        self.ORDERS_DISPATCH[re.compile(r'announce run(?: run=(?P<runid>[0-9]+))?')] = self.announce_delivery
-
         self.DISPATCH['message'] = [self.handle_message]
-        self.load_triggers('sass.txt')
 
         self.client = SlackClient(self.TOKEN)
+        # slackclient is not thread safe: its websocket is not created for use
+        # from several threads, and the user and channel directories are
+        # plain dicts. Anything that uses self.client from the handler
+        # threads holds this lock (see LockedChannel).
+        self.client_lock = threading.RLock()
+        self.health = ConnectionHealth(self.TEAM_ID)
+        # Messages are handled on this pool (if given) rather than on the
+        # thread reading from the connection.
+        self.pool = pool
+        # The user and channel directories downloaded by rtm.start are kept
+        # on self.client.server, which survives reconnects. Only ask Slack for
+        # them again if we have never had them.
+        self._needs_team_state = True
 
     def list_runs(self, slackclient, user, channel, match):
         """Handle the 'open runs' command.
@@ -78,7 +103,7 @@ class WrappedSlackBot:
             channel.send_message(
                     'Run {}: {} is going to {} in {} (at {})'.format(
                         run.id, person.name, run.cafe.name,
-                        flask_babel.format_timedelta(time_to_run), run.time))
+                        format_timedelta(time_to_run), run.time))
 
     def list_cafes(self, slackclient, user, channel, match):
         """Handle the 'list cafes' command.
@@ -134,7 +159,7 @@ class WrappedSlackBot:
 
         # Create the run
         run = Run(timeobj)
-        run.person = person
+        run.person = person.id
         run.fetcher = person
         run.cafeid = cafeid
         run.pickup = pickup
@@ -142,10 +167,11 @@ class WrappedSlackBot:
         run.is_open = True
 
         db.session.add(run)
-        db.session.commit()
+        db.session.flush()  # Assigns run.id
 
         # Create the event
         self.write_to_events("created", "run", run.id, run.person)
+        db.session.commit()
 
         # Notify Slack
         try:
@@ -192,11 +218,12 @@ class WrappedSlackBot:
 
         # Change run to closed
         run.is_open = False
+        run.modified = sydney_timezone_now()
         db.session.add(run)
-        db.session.commit()
 
         # Create event
         self.write_to_events("updated", "run", run.id, run.person)
+        db.session.commit()
 
         # Notify Slack
         try:
@@ -261,33 +288,28 @@ class WrappedSlackBot:
         """
         logger = logging.getLogger('order_coffee')
         logger.info('Matches: %s', pprint.pformat(match.groupdict()))
-        runid = match.groupdict().get('runid', None)
-        run = None
-        if runid and runid.isdigit():
-            run = Run.query.filter_by(id=int(runid)).first()
+        run = self.pick_run(slackclient, user, channel, match.groupdict().get('runid', None))
         if not run:
-            # Pick a run
-            runs = Run.query.filter_by(is_open=True).order_by('time').all()
-            if len(runs) > 1:
-                channel.send_message(
-                        'More than one open run, please specify by adding run=<id> on the end.')
-                self.list_runs(slackclient, user, channel, match=None)
-                return
-            if len(runs) == 0:
-                channel.send_message('No open runs')
-                return
-            run = runs[0]
+            return
 
         # Create the coffee
-        c = coffeespecs.Coffee(match.group(1))
+        c = coffeespecs.Coffee(match.group(1), fuzzy=True)
+        if c.corrections:
+            logger.info('Corrected: %s', c.corrections)
         validation_errors = list(c.validation_errors())
         if validation_errors:
-            channel.send_message(
-                'That coffee is not valid missing the following specs: {}. Got: {}'.format(
-                    ', '.join(spec.name for spec in validation_errors),
-                    c,
-                )
+            message = 'That coffee is not valid missing the following specs: {}. Got: {}'.format(
+                ', '.join(spec.name for spec in validation_errors),
+                c,
             )
+            hints = []
+            for word in c.unparsed:
+                names = coffeespecs.suggestions(word)
+                if names:
+                    hints.append('{} for "{}"'.format(' or '.join(names), word))
+            if hints:
+                message += '. Did you mean {}?'.format(', '.join(hints))
+            channel.send_message(message)
             return
         coffee = Coffee(c, 0, run.id)
 
@@ -298,11 +320,12 @@ class WrappedSlackBot:
         # Put it all together
         coffee.person = dbuser.id
         db.session.add(coffee)
-        db.session.commit()
-        events.coffee_added(run.id, coffee.id)
+        db.session.flush()  # Assigns coffee.id
 
         # Write the event
         self.write_to_events("created", "coffee", coffee.id, coffee.person)
+        db.session.commit()
+        events.coffee_added(run.id, coffee.id)
         logger.info('Parsed coffee: %s', coffee)
 
         runuser = User.query.filter_by(id=run.person).first()
@@ -310,25 +333,74 @@ class WrappedSlackBot:
             mention_runner = '<@{}>'.format(runuser.slack_user_id)
         else:
             mention_runner = runuser.name
+        message = 'That\'s a {} for {} (added to {}\'s run.)'.format(
+            coffee.pretty_print(),
+            self.mention(user),
+            mention_runner)
+        if c.corrections:
+            # Say how misspelt words were read, in case it was wrong.
+            message += ' I read {}.'.format(', '.join(
+                '"{}" as "{}"'.format(word, token) for word, token in c.corrections))
+        channel.send_message(message)
+
+    def group_order(self, slackclient, user, channel, match):
+        """Handle adding a coffee for each person in a group.
+
+        The message is "group order", followed by one "name: coffee" line per
+        person. Nothing is added unless every line is valid.
+
+        Args:
+            slackclient: the slackclient.SlackClient object for the current
+                connection to Slack.
+            user: the slackclient.User object for the user who send the
+                message to us.
+            channel: the slackclient.Channel object for the channel the
+                message was received on.
+            match: the object returned by re.match (an _sre.SRE_Match object).
+        """
+        logger = logging.getLogger('group_order')
+        run = self.pick_run(slackclient, user, channel, match.group('runid'))
+        if not run:
+            return
+
+        try:
+            orders = bulk_orders.parse_orders(match.group('orders'))
+        except bulk_orders.BulkOrderError as e:
+            channel.send_message('Nothing was added:\n{}'.format('\n'.join(e.errors)))
+            return
+
+        dbuser = utils.get_or_create_user(user.id, self.TEAM_ID, user.name)
+        coffee_ids = bulk_orders.add_orders(run, orders, dbuser.id)
+        db.session.commit()
+        events.coffees_added(run.id, coffee_ids)
+        logger.info('Added %d coffees to run %s', len(coffee_ids), run.id)
+
         channel.send_message(
-                'That\'s a {} for {} (added to {}\'s run.)'.format(
-                    coffee.pretty_print(),
-                    self.mention(user),
-                    mention_runner))
+                'Added {} coffees to {}\'s run, {}.'.format(
+                    len(coffee_ids), run.fetcher.name, self.mention(user)))
+
+    def pick_run(self, slackclient, user, channel, runid):
+        """Find the run to add coffees to.
 
-    def load_triggers(self, filename):
-        """Parse the sass file, loading them into the TRIGGERS global.
+        This is the run with the given id, or else the only open run. Returns
+        None (after telling the user why) if there is no such run.
         """
-        trigger = None
-        for line in open(filename):
-            if not line.strip():
-                continue
-            if line.startswith('@@@ '):
-                trigger = re.compile(line[4:].strip())
-                if trigger not in self.TRIGGERS:
-                    self.TRIGGERS[trigger] = []
-            elif trigger:
-                self.TRIGGERS[trigger].append(line.strip())
+        run = None
+        if runid and runid.isdigit():
+            run = Run.query.filter_by(id=int(runid)).first()
+        if not run:
+            # Pick a run
+            runs = Run.query.filter_by(is_open=True).order_by('time').all()
+            if len(runs) > 1:
+                channel.send_message(
+                        'More than one open run, please specify by adding run=<id> on the end.')
+                self.list_runs(slackclient, user, channel, match=None)
+                return None
+            if len(runs) == 0:
+                channel.send_message('No open runs')
+                return None
+            run = runs[0]
+        return run
 
     def trigger_check(self, slackclient, user, channel, text):
         """Check if we need to sass the user.
@@ -342,16 +414,14 @@ class WrappedSlackBot:
                 message was received on.
             match: the object returned by re.match (an _sre.SRE_Match object).
         """
-        text = text.lower()
-        for trigger in self.TRIGGERS:
-            if trigger.match(text):
-                msg = random.choice(self.TRIGGERS[trigger])
-                msg = self.mention(user) + ': ' + msg
-                channel.send_message(msg)
-                return True
-        else:
+        responses, _ = TRIGGERS.route(text.lower())
+        if responses is None:
             # No triggers matched. Inform our caller so they can decide what to do.
             return False
+        msg = random.choice(responses)
+        msg = self.mention(user) + ': ' + msg
+        channel.send_message(msg)
+        return True
 
     def mention(self, user):
         """Generate a mention for the given user.
@@ -383,12 +453,10 @@ class WrappedSlackBot:
         clean = self.clean_text(text)
 
         message_processed = False
-        for order_re in self.ORDERS_DISPATCH:
-            match = order_re.match(clean)
-            if match:
-                self.ORDERS_DISPATCH[order_re](slackclient, user, channel, match)
-                message_processed = True
-                break
+        handler_name, match = ORDERS_ROUTER.route(clean)
+        if handler_name is not None:
+            getattr(self, handler_name)(slackclient, user, channel, match)
+            message_processed = True
 
         if self.trigger_check(slackclient, user, channel, clean):
             message_processed = True
@@ -402,7 +470,9 @@ class WrappedSlackBot:
     def handle_message(self, slackclient, event):
         logger = logging.getLogger('handle_message')
         logger.debug('message event: %s', event)
-        channel = slackclient.server.channels.find(event['channel'])
+        channel = self.find_channel(slackclient, event['channel'])
+        if channel is not None:
+            channel = LockedChannel(channel, self.client_lock)
 
         # If the user edits their message, we treat it as if it were a new
         # message from that person.
@@ -411,8 +481,11 @@ class WrappedSlackBot:
         if 'user' not in event:
             # Ignore events from non-users (i.e. coffebot app messages)
             return
-        user = slackclient.server.users.find(event['user'])
+        user = self.find_user(slackclient, event['user'])
         text = event['text']
+        if user is None or channel is None:
+            logger.warning('Ignoring message from unknown user/channel: %s', event)
+            return
 
         mentions = self.MENTION_RE.findall(text)
         logger.info('Mentions: %s', mentions)
@@ -424,62 +497,246 @@ class WrappedSlackBot:
             msg = 'Mmmm... :coffee:' + ':coffee:' * random.randint(0, 7)
             channel.send_message(msg)
 
+    def find_user(self, slackclient, user_id):
+        """Find a user in the cached directory, asking Slack if they are new.
+
+        Users who join the workspace after we connected are not in the
+        directory downloaded by rtm.start. Rather than reconnecting to pick
+        them up, we look them up individually and add them to the cache.
+        """
+        with self.client_lock:
+            user = slackclient.server.users.find(user_id)
+        if user is None:
+            # Not holding the lock while we wait for Slack.
+            resp = slackclient.api_call('users.info', user=user_id)
+            if resp.get('ok'):
+                with self.client_lock:
+                    slackclient.server.parse_user_data([resp['user']])
+                    user = slackclient.server.users.find(user_id)
+        return user
+
+    def find_channel(self, slackclient, channel_id):
+        """Find a channel in the cached directory, asking Slack if it is new."""
+        with self.client_lock:
+            channel = slackclient.server.channels.find(channel_id)
+        if channel is None:
+            resp = slackclient.api_call('conversations.info', channel=channel_id)
+            if resp.get('ok'):
+                info = resp['channel']
+                with self.client_lock:
+                    if slackclient.server.channels.find(channel_id) is None:
+                        slackclient.server.attach_channel(
+                                info.get('name', channel_id), channel_id)
+                    channel = slackclient.server.channels.find(channel_id)
+        return channel
+
     def loop(self, client):
-        # FIXME(tsukasa-au): This is a hack... But I can't think of anything
-        # better.
-        # Add a test request context so that babel will work.
-        app.test_request_context().push()
+        """Connect to Slack and process events until the connection fails.
 
+        Returns False if we could not connect. Any exception raised while
+        reading from the connection is propagated to our caller (see
+        `supervise`) so that it can reconnect.
+        """
         logger = logging.getLogger('loop')
-        res = client.rtm_connect()
+        with self.client_lock:
+            res = client.rtm_connect(with_team_state=self._needs_team_state)
         logger.debug('Connection result: %r', res)
         if not res:
             logger.error('Connection Failed.')
-            return
+            self.health.increment('connect_failures')
+            return False
+        self.health.increment('connects')
+        self._needs_team_state = False
 
         logger.info('Users: %s', client.server.users)
         logger.info('Channels: %s', client.server.channels)
         while True:
-            for event in client.rtm_read():
+            # The socket does not block, so this is only held briefly. It keeps
+            # reads apart from a handler reconnecting after a failed send.
+            with self.client_lock:
+                events = client.rtm_read()
+            for event in events:
                 logger.debug('Event: %s', event)
+                self.health.last_event_time = time.time()
                 if 'type' in event:
                     # Call all handlers for the given event type.
                     for handler in self.DISPATCH.get(event['type'], []):
-                        handler(client, event)
+                        self.dispatch(handler, client, event)
             time.sleep(0.1)
 
-    def write_to_events(self, action, objtype, objid, user=None):
-        if user:
-            if isinstance(user, int):
-                event = Event(user, action, objtype, objid)
-            else:
-                event = Event(user.id, action, objtype, objid) 
-        else:
-            event = Event(current_user.id, action, objtype, objid)
-        event.time = sydney_timezone_now()
-        db.session.add(event)
-        db.session.commit()
-        return event.id
+    def dispatch(self, handler, client, event):
+        """Hand an event to the worker pool, keeping each user's messages in order."""
+        if self.pool is None:
+            self.run_handler(handler, client, event)
+            return
+
+        def _on_timeout():
+            logging.warning('Slow handler for event: %s', event)
+            self.health.increment('handler_timeouts')
+
+        self.pool.submit(
+                (self.TEAM_ID, ordering_key(event)),
+                self.run_handler, handler, client, event,
+                on_timeout=_on_timeout)
+
+    def run_handler(self, handler, client, event):
+        """Run a single event handler, containing any error it raises.
+
+        A bug triggered by one message should not drop the connection for the
+        whole workspace, so errors are logged and counted instead.
+        """
+        try:
+            with message_session():
+                handler(client, event)
+            self.health.increment('events_handled')
+        except Exception as e:
+            logging.exception('Error while handling event: %s', event)
+            self.health.increment('handler_errors', last_error=repr(e))
+
+    def write_to_events(self, action, objtype, objid, user):
+        """Record an event as part of the current unit of work.
+
+        The caller commits it along with the change it describes.
+        """
+        userid = user if isinstance(user, int) else user.id
+        return record_event(userid, action, objtype, objid)
+
 
+class LockedChannel:
+    """A slackclient.Channel that sends messages while holding a lock.
 
-def _die_on_exception_wrapper(f: typing.Callable):
-    '''Wrapper that kills the current process if an exception is thrown.
+    Handlers for the same workspace run on several worker threads, and
+    slackclient's websocket does not stop their messages being interleaved.
+    Everything other than send_message is passed through to the channel.
+    """
 
-    This function is used to make sure that we restart the chatbot on any
-    errors. This is a temporary hack.
+    def __init__(self, channel, lock):
+        self._channel = channel
+        self._lock = lock
+
+    def send_message(self, message, thread=None, reply_broadcast=False):
+        with self._lock:
+            self._channel.send_message(message, thread=thread, reply_broadcast=reply_broadcast)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    def __str__(self):
+        return str(self._channel)
+
+
+class ConnectionHealth:
+    """Counters describing the health of a single workspace connection.
+
+    These are updated from the connection's thread and the handler threads,
+    so counters are only changed through increment().
+    """
+
+    def __init__(self, team_id):
+        self._lock = threading.Lock()
+        self.team_id = team_id
+        self.connects = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.events_handled = 0
+        self.handler_errors = 0
+        self.handler_timeouts = 0
+        self.last_event_time = None
+        self.last_error = None
+
+    def increment(self, counter, last_error=None):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            if last_error is not None:
+                self.last_error = last_error
+
+    def as_dict(self):
+        with self._lock:
+            return {k: v for k, v in vars(self).items() if not k.startswith('_')}
+
+    def __repr__(self):
+        return '<ConnectionHealth({})>'.format(
+                ', '.join('{}={!r}'.format(k, v) for k, v in self.as_dict().items()))
+
+
+def ordering_key(event):
+    """The key used to order the handling of an event.
+
+    Messages from the same user are handled in order. Events without a user
+    fall back to per-channel ordering.
+    """
+    if event.get('subtype') == 'message_changed':
+        event = event.get('message', event)
+    return event.get('user') or event.get('channel')
+
+
+@contextlib.contextmanager
+def message_session():
+    '''The database session for handling a single message.
+
+    Whatever the handler leaves uncommitted (e.g. because it raised) is rolled
+    back, and the session is thrown away afterwards, so each message starts
+    from fresh data and nothing is held between messages.
+    '''
+    try:
+        yield db.session
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.remove()
+
+
+# Messages taking longer than this (in seconds) are logged as being slow.
+HANDLER_TIMEOUT = 30
+NUM_HANDLER_THREADS = 8
+
+
+# Reconnect delays, in seconds.
+INITIAL_BACKOFF = 1
+MAX_BACKOFF = 300
+# A connection that stayed up for this long is considered healthy, and resets
+# the backoff.
+STABLE_CONNECTION_SECONDS = 600
+
+
+def supervise(sb: WrappedSlackBot):
+    '''Keep a single workspace connected, reconnecting with exponential backoff.
+
+    Each workspace gets its own supervisor thread, so a flaky connection to one
+    workspace does not affect any of the others.
     '''
-    def _wrapper(*args, **kwargs):
+    logger = logging.getLogger('supervise')
+
+    backoff = INITIAL_BACKOFF
+    while True:
+        started = time.monotonic()
         try:
-            return f(*args, **kwargs)
-        except Exception:
-            logging.exception(
-                'One of the connections had an error, killing the entire '
-                'process to allow heroku to restart it.')
-            os.kill(os.getpid(), 9)
-    return _wrapper
+            sb.loop(sb.client)
+        except Exception as e:
+            logger.exception('Connection to workspace %s failed.', sb.TEAM_ID)
+            sb.health.increment('disconnects', last_error=repr(e))
+        db.session.remove()
+
+        if time.monotonic() - started > STABLE_CONNECTION_SECONDS:
+            backoff = INITIAL_BACKOFF
+        delay = backoff * random.uniform(0.5, 1.5)
+        logger.info('Reconnecting to workspace %s in %.1fs: %r', sb.TEAM_ID, delay, sb.health)
+        time.sleep(delay)
+        backoff = min(backoff * 2, MAX_BACKOFF)
 
 
 def main():
+    # The bot does not load the web views, so start publishing live updates
+    # here.
+    live_updates.init_broker(app.config)
+
+    # Each message is handled in its own database session (see
+    # message_session).
+    pool = KeyedWorkerPool(
+            num_workers=NUM_HANDLER_THREADS,
+            timeout=HANDLER_TIMEOUT,
+            name='handler')
     threads = []
     for slack_workspace in models.SlackTeamAccessToken.query.filter(
             models.SlackTeamAccessToken.coffee_bot_slack_access_token != None,  # noqa: E711. `!= None` is needed for SQLAlchemy operator binding magic. `is not None` does not work.
@@ -488,10 +745,11 @@ def main():
                 slack_workspace.coffee_bot_slack_access_token,
                 slack_workspace.coffee_bot_slack_user_id,
                 slack_workspace.team_id,
+                pool=pool,
         )
         threads.append(
                 threading.Thread(
-                    target=_die_on_exception_wrapper(sb.loop), args=(sb.client,)))
+                    target=supervise, args=(sb,), name=slack_workspace.team_id))
     # Start all threads
     for thread in threads:
         thread.start()
@@ -502,9 +760,4 @@ def main():
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-
-    # FIXME: This is a hack... But I can't think of anything better.
-    # Add a test request context so that babel will work.
-    app.test_request_context().push()
-
     main()
@@ -1,6 +1,9 @@
+import functools
 import json
 import re
 
+import fuzzy
+
 COFFEE_SPECS = {}
 _PRECEDENCE = ['type', 'size', 'milk', 'strength', 'iced', 'decaf', 'sugar']
 
@@ -23,13 +26,33 @@ _CAPPUCCINO_EQUIV = {
     'Short Black',
 }
 
+# Milks that cost the same as (and are priced as) Soy.
+_SOY_MILKS = {'Soy', 'Lactose Free'}
+
+# How alike (see fuzzy.similarity) a misspelt word has to be to a word token
+# to be read as it, and to be suggested as it.
+FUZZY_MIN_SIMILARITY = 0.75
+SUGGEST_MIN_SIMILARITY = 0.7
+
 
 class JavaException(Exception):
     pass
 
 
 class Coffee(object):
-    def __init__(self, request):
+    __slots__ = ('spec', 'unparsed', 'corrections')
+
+    def __init__(self, request, fuzzy=False):
+        """Parse a coffee order, e.g. 'Large soy latte'.
+
+        With `fuzzy`, an order that is not valid as written has the words
+        that were not understood read as the word token they are most likely
+        a misspelling of (if one is close enough, see correct_token). Valid
+        orders are left alone, so that a stray word can not change them. The
+        words read this way are kept in `corrections`, as (word, token)
+        pairs, and the words that still could not be understood in
+        `unparsed`.
+        """
         request = request.lower().strip()
         # Strip punctuation except for '-' which is used in some tokens.
         # Most get replaced with space but apostrophes are just removed.
@@ -39,11 +62,14 @@ class Coffee(object):
         request_tokens = request.split()
         request_bigrams = [' '.join(x) for x in zip(request_tokens, request_tokens[1:])]
 
-        tokens = get_all_word_tokens()
+        tokens = _word_token_set()
 
         # Start of coffee spec gathering
-        self.specs = {}
+        self.spec = _NO_SPEC
 
+        # Tokens are always tried in the order they were written (rather than
+        # in set order), so that a request always parses the same way.
+        ordered_tokens = list(dict.fromkeys(request_tokens))
         unparsed_tokens = set(request_tokens)
         for bigram in request_bigrams:
             if bigram in tokens:
@@ -52,53 +78,68 @@ class Coffee(object):
                 unparsed_tokens.remove(word1)
                 unparsed_tokens.remove(word2)
 
-        for request_token in set(unparsed_tokens):
+        for request_token in [t for t in ordered_tokens if t in unparsed_tokens]:
             if request_token in tokens:
                 self.add_token(request_token)
                 unparsed_tokens.remove(request_token)
 
-        all_abbreviation_tokens_by_spec = get_all_abbreviation_tokens_by_spec()
-        for token in set(unparsed_tokens):
-            result = parse_abbreviation(all_abbreviation_tokens_by_spec, token, tuple(_PRECEDENCE))
+        for token in [t for t in ordered_tokens if t in unparsed_tokens]:
+            result = parse_abbreviation(token, tuple(_PRECEDENCE))
             if result:
                 for spec, matched_token in result:
                     self.add_spec(spec, matched_token)
                 unparsed_tokens.remove(token)
 
+        self.corrections = []
+        if fuzzy and not self.validate():
+            # Two words first, for misspellings like 'flat whtie'.
+            for bigram in zip(request_tokens, request_tokens[1:]):
+                if all(word in unparsed_tokens for word in bigram):
+                    token = correct_token(' '.join(bigram))
+                    if token is not None and self.add_token(token):
+                        self.corrections.append((' '.join(bigram), token))
+                        unparsed_tokens.difference_update(bigram)
+            for word in [t for t in ordered_tokens if t in unparsed_tokens]:
+                token = correct_token(word)
+                if token is not None and self.add_token(token):
+                    self.corrections.append((word, token))
+                    unparsed_tokens.remove(word)
+        self.unparsed = [t for t in ordered_tokens if t in unparsed_tokens]
+
     def get_price_key(self, fuzzy_fields=None):
         if fuzzy_fields is None:
             fuzzy_fields = {}
         tokens = []
         for spec in _OUT_ORDER:
             if spec == 'type' and spec in fuzzy_fields:
-                if self.specs[spec] in _CAPPUCCINO_EQUIV:
+                if self.spec[spec] in _CAPPUCCINO_EQUIV:
                     tokens.append('Cappuccino')
                     continue
             if spec == 'size':
                 # Default to regular size if not specified.
-                size = self.specs.get(spec, 'Regular')
+                size = self.spec.get(spec, 'Regular')
                 # If fuzzy matching, consider small and regular to be the same.
                 if spec in fuzzy_fields and size == 'Small':
                     size = 'Regular'
                 tokens.append(size)
                 continue
             if spec == 'strength':
-                strength = self.specs.get(spec, 'Normal')
+                strength = self.spec.get(spec, 'Normal')
                 if spec in fuzzy_fields and strength == 'Weak':
                     strength = 'Normal'
                 if strength != 'Normal':
                     tokens.append(strength)
                 continue
-            if spec in self.specs:
+            if spec in self.spec:
                 if spec == 'sugar':
                     # Assume no one charges for sugar
                     continue
                 if spec == 'milk':
                     # Only output the milk if it's soy
-                    if self.specs[spec] in {'Soy', 'Lactose Free'}:
+                    if self.spec[spec] in _SOY_MILKS:
                         tokens.append('Soy')
                     continue
-                tokens.append(self.specs[spec])
+                tokens.append(self.spec[spec])
         return ' '.join(tokens)
 
     def get_ordered_price_keys(self):
@@ -107,32 +148,27 @@ class Coffee(object):
         The first thing in the list is the list is the most specific, then
         later items are less specific.
         """
-        return [
-                self.get_price_key(),
-                self.get_price_key(fuzzy_fields={'type'}),
-                self.get_price_key(fuzzy_fields={'type', 'size'}),
-                self.get_price_key(fuzzy_fields={'type', 'size', 'strength'}),
-        ]
+        return list(_price_keys(self.spec))
 
     def add_token(self, token):
         for spec in _PRECEDENCE:
-            if COFFEE_SPECS[spec].validate(token) and spec not in self.specs:
-                self.add_spec(spec, token)
-                return
+            if COFFEE_SPECS[spec].validate(token) and spec not in self.spec:
+                return self.add_spec(spec, token)
+        return False
 
     def add_spec(self, spec, value):
         if spec not in COFFEE_SPECS:
             raise JavaException('Unexpected spec: {}'.format(spec))
         if not COFFEE_SPECS[spec].validate(value):
             return False
-        self.specs[spec] = COFFEE_SPECS[spec].get_option_value(value)
+        self.spec = self.spec.replace(spec, COFFEE_SPECS[spec].get_option_value(value))
         return True
 
     def validation_errors(self):
         for spec in COFFEE_SPECS:
             spec = COFFEE_SPECS[spec]
             if spec.required:
-                if spec.name not in self.specs:
+                if spec.name not in self.spec:
                     yield spec
 
     def validate(self):
@@ -141,47 +177,212 @@ class Coffee(object):
         return True
 
     def __str__(self):
-        tokens = []
-        for spec in _OUT_ORDER:
-            if spec == 'size' and spec not in self.specs:
-                tokens.append('Regular')
-            if spec in self.specs:
-                if spec == 'sugar':
-                    tokens.append('with')
-                tokens.append(self.specs[spec])
-        return ' '.join(tokens)
+        return str(self.spec)
+
+    @property
+    def specs(self):
+        """The specs as a {spec name: option name} dict."""
+        return self.spec.to_dict()
 
     def toJSON(self):
-        # We sort the keys to give a stable ordering in our database.
-        return json.dumps(self.specs, sort_keys=True)
+        return self.spec.toJSON()
+
+    @staticmethod
+    def from_spec(spec):
+        coffee = Coffee.__new__(Coffee)
+        coffee.spec = spec
+        coffee.unparsed = []
+        coffee.corrections = []
+        return coffee
 
     @staticmethod
     def fromJSON(coffee_json):
-        coffee = Coffee('C')
-        coffee.specs = json.loads(coffee_json)
+        coffee = Coffee.from_spec(Spec.fromJSON(coffee_json))
         if not coffee.validate():
             raise JavaException('Invalid coffee')
         return coffee
 
 
-def parse_abbreviation(all_abbreviation_tokens_by_spec, token_input, remaining_specs):
+def _describe(specs):
+    tokens = []
+    for spec in _OUT_ORDER:
+        if spec == 'size' and spec not in specs:
+            tokens.append('Regular')
+        if spec in specs:
+            if spec == 'sugar':
+                tokens.append('with')
+            tokens.append(specs[spec])
+    return ' '.join(tokens)
+
+
+@functools.total_ordering
+class Spec(object):
+    """A coffee's specs, as a small immutable value.
+
+    Each spec is kept as the code of its option (see CoffeeSpec.codes), in
+    _PRECEDENCE order, with 0 for a spec that is not set. Stored coffees may
+    name options that have since been removed or renamed; those are kept as
+    their name instead of a code. Specs are hashable, so can be used as dict
+    keys, and there are few distinct ones, so the conversions to and from
+    JSON and display strings are cached.
+    """
+    __slots__ = ('codes', '_hash')
+
+    def __init__(self, codes):
+        codes = tuple(codes)
+        if len(codes) != len(_PRECEDENCE):
+            raise JavaException('Expected {} spec codes, got {}'.format(len(_PRECEDENCE), len(codes)))
+        object.__setattr__(self, 'codes', codes)
+        object.__setattr__(self, '_hash', hash(codes))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Spec is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Spec is immutable')
+
+    def __reduce__(self):
+        # Codes depend on the order options were added in, which can differ
+        # between processes (some are added from sets), so pickle the names.
+        return (_spec_from_json, (self.toJSON(),))
+
+    @staticmethod
+    def from_dict(specs):
+        """The Spec for a {spec name: option name} dict, like Coffee.specs."""
+        if not isinstance(specs, dict):
+            raise JavaException('Expected a dict of specs, got {!r}'.format(specs))
+        unknown = set(specs) - set(_PRECEDENCE)
+        if unknown:
+            raise JavaException('Unexpected spec: {}'.format(', '.join(sorted(map(str, unknown)))))
+        return Spec(_option_code(name, specs.get(name)) for name in _PRECEDENCE)
+
+    def replace(self, name, value):
+        """A copy of this Spec with spec `name` set to the option named `value`."""
+        if name not in _PRECEDENCE:
+            raise JavaException('Unexpected spec: {}'.format(name))
+        codes = list(self.codes)
+        codes[_PRECEDENCE.index(name)] = _option_code(name, value)
+        return Spec(codes)
+
+    def to_dict(self):
+        return {
+            name: _option_name(name, code)
+            for name, code in zip(_PRECEDENCE, self.codes) if code
+        }
+
+    @staticmethod
+    def fromJSON(spec_json):
+        return _spec_from_json(spec_json)
+
+    def toJSON(self):
+        return _spec_to_json(self)
+
+    def __str__(self):
+        return _spec_to_str(self)
+
+    def __repr__(self):
+        return 'Spec({!r})'.format(self.to_dict())
+
+    def __getitem__(self, name):
+        code = self.codes[_PRECEDENCE.index(name)] if name in _PRECEDENCE else 0
+        if not code:
+            raise KeyError(name)
+        return _option_name(name, code)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Spec):
+            return NotImplemented
+        return self.codes == other.codes
+
+    def __lt__(self, other):
+        if not isinstance(other, Spec):
+            return NotImplemented
+        return self._sort_key() < other._sort_key()
+
+    def _sort_key(self):
+        # Codes before the names of unknown options, which do not compare
+        # with them.
+        return tuple((isinstance(code, str), code) for code in self.codes)
+
+
+def _option_code(name, value):
+    if value is None:
+        return 0
+    if not isinstance(value, str) or not value:
+        raise JavaException('Not a valid value {!r} for spec {}'.format(value, name))
+    return COFFEE_SPECS[name].codes.get(value, value)
+
+
+def _option_name(name, code):
+    if isinstance(code, str):
+        return code
+    return COFFEE_SPECS[name].names[code]
+
+
+@functools.lru_cache(maxsize=1024)
+def _spec_from_json(spec_json):
+    return Spec.from_dict(json.loads(spec_json))
+
+
+@functools.lru_cache(maxsize=1024)
+def _spec_to_json(spec):
+    return json.dumps(spec.to_dict(), sort_keys=True)
+
+
+@functools.lru_cache(maxsize=1024)
+def _spec_to_str(spec):
+    return _describe(spec.to_dict())
+
+
+@functools.lru_cache(maxsize=1024)
+def _price_keys(spec):
+    coffee = Coffee.from_spec(spec)
+    return (
+            coffee.get_price_key(),
+            coffee.get_price_key(fuzzy_fields={'type'}),
+            coffee.get_price_key(fuzzy_fields={'type', 'size'}),
+            coffee.get_price_key(fuzzy_fields={'type', 'size', 'strength'}),
+    )
+
+
+# Nothing set, which parsing starts from.
+_NO_SPEC = Spec((0,) * len(_PRECEDENCE))
+
+
+def parse_abbreviation(token_input, remaining_specs):
+    token_sets_by_spec = _abbreviation_token_sets_by_spec()
     for spec in remaining_specs:
-        if token_input in all_abbreviation_tokens_by_spec[spec]:
+        if token_input in token_sets_by_spec[spec]:
             return ((spec, token_input), )
 
+    tokens_by_spec = _abbreviation_tokens_by_spec()
     for spec in remaining_specs:
-        for token in all_abbreviation_tokens_by_spec[spec]:
+        for token in tokens_by_spec[spec]:
             if token_input.startswith(token):
                 copy_of_remaining_specs = list(remaining_specs)
                 copy_of_remaining_specs.remove(spec)
                 remainder = token_input[len(token):]
-                remainder_result = parse_abbreviation(all_abbreviation_tokens_by_spec, remainder, copy_of_remaining_specs)
+                remainder_result = parse_abbreviation(remainder, copy_of_remaining_specs)
                 if remainder_result is not None:
                     return ((spec, token),) + remainder_result
     return None
 
 
 class CoffeeSpecOption(object):
+    __slots__ = ('specname', 'name', 'abbreviations', 'word_tokens')
+
     def __init__(self, specname, name, abbreviations, word_tokens):
         self.specname = specname
         self.name = name
@@ -191,9 +392,11 @@ class CoffeeSpecOption(object):
             self.word_tokens.append(self.name.lower())
 
     def __hash__(self):
-        return hash(self.specname + ':' + self.name)
+        return hash((self.specname, self.name))
 
-    def ___eq___(self, other):
+    def __eq__(self, other):
+        if not isinstance(other, CoffeeSpecOption):
+            return NotImplemented
         return self.specname == other.specname and self.name == other.name
 
 
@@ -206,6 +409,9 @@ class CoffeeSpec(object):
         self.word_tokens = {}
         self.abbreviation_tokens = {}
         self.options = set()
+        # Options are numbered from 1 in the order they were added, for Spec.
+        self.codes = {}
+        self.names = [None]
         if options is None:
             options = []
         for option in options:
@@ -218,6 +424,9 @@ class CoffeeSpec(object):
 
     def add_option(self, option):
         self.options.add(option)
+        if option.name not in self.codes:
+            self.codes[option.name] = len(self.names)
+            self.names.append(option.name)
         self.add_word_tokens(option)
         self.add_abbreviations(option)
 
@@ -268,19 +477,110 @@ class CoffeeSpec(object):
 
 
 def get_all_word_tokens():
-    tokens = set()
-    for spec in COFFEE_SPECS:
-        tokens.update(COFFEE_SPECS[spec].get_word_tokens())
-    tokens = list(tokens)
-    tokens.sort(key=(lambda x: (len(x), x)), reverse=True)
-    return tokens
+    return list(_word_tokens())
 
 
 def get_all_abbreviation_tokens_by_spec():
-    abbreviation_tokens_by_spec = {}
-    for spec in _PRECEDENCE:
-        abbreviation_tokens_by_spec[spec] = set(COFFEE_SPECS[spec].get_abbreviation_tokens())
-    return abbreviation_tokens_by_spec
+    return {spec: list(tokens) for spec, tokens in _abbreviation_tokens_by_spec().items()}
+
+
+# Options are only added when this module is loaded, so the token tables
+# below are only ever built once. They are kept as tuples and frozensets, so
+# that no caller can change the cached copy.
+
+
+@functools.lru_cache(maxsize=1)
+def _word_tokens():
+    tokens = set()
+    for spec in COFFEE_SPECS:
+        tokens.update(COFFEE_SPECS[spec].get_word_tokens())
+    return tuple(sorted(tokens, key=(lambda x: (len(x), x)), reverse=True))
+
+
+@functools.lru_cache(maxsize=1)
+def _word_token_set():
+    return frozenset(_word_tokens())
+
+
+@functools.lru_cache(maxsize=1)
+def _abbreviation_tokens_by_spec():
+    # Longest first (like the word tokens), so that abbreviations are always
+    # tried in the same order.
+    return {
+        spec: tuple(sorted(
+                COFFEE_SPECS[spec].get_abbreviation_tokens(),
+                key=(lambda x: (len(x), x)), reverse=True))
+        for spec in _PRECEDENCE
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def _abbreviation_token_sets_by_spec():
+    return {spec: frozenset(tokens) for spec, tokens in _abbreviation_tokens_by_spec().items()}
+
+
+@functools.lru_cache(maxsize=1)
+def _fuzzy_index():
+    return fuzzy.FuzzyIndex(_word_tokens(), max_distance=2)
+
+
+def _token_options(token):
+    return {
+        (spec, COFFEE_SPECS[spec].get_option_value(token))
+        for spec in _PRECEDENCE if COFFEE_SPECS[spec].validate(token)
+    }
+
+
+def correct_token(word, min_similarity=FUZZY_MIN_SIMILARITY):
+    """The word token that `word` is most likely a misspelling of, or None.
+
+    A token is only returned if it is at least `min_similarity` alike to the
+    word, and every other token as close as it means the same option (e.g.
+    'lattte' is as close to 'latte' as to 'lattee', which are both Latte).
+    """
+    matches = [m for m in _fuzzy_index().lookup(word) if m.similarity >= min_similarity]
+    if not matches:
+        return None
+    closest = [m.word for m in matches if m.distance == matches[0].distance]
+    if len({frozenset(_token_options(token)) for token in closest}) > 1:
+        return None
+    return closest[0]
+
+
+def suggestions(word, limit=3):
+    """The names of up to `limit` options that `word` might be, closest first."""
+    names = []
+    for match in _fuzzy_index().lookup(word):
+        if match.similarity < SUGGEST_MIN_SIMILARITY:
+            continue
+        for spec, name in sorted(_token_options(match.word)):
+            if name not in names:
+                names.append(name)
+    return names[:limit]
+
+
+def export_tables():
+    """Everything the parser knows, as JSON serialisable data.
+
+    This is used to build the browser's copy of the parser (see
+    export_coffeespecs.py and static/js/coffeeparser.js).
+    """
+    return {
+        'precedence': _PRECEDENCE,
+        'out_order': _OUT_ORDER,
+        'cappuccino_equiv': sorted(_CAPPUCCINO_EQUIV),
+        'soy_milks': sorted(_SOY_MILKS),
+        'word_tokens': get_all_word_tokens(),
+        'abbreviation_tokens': get_all_abbreviation_tokens_by_spec(),
+        'specs': {
+            name: {
+                'required': spec.required,
+                'words': {token: option.name for token, option in spec.word_tokens.items()},
+                'abbreviations': {token: option.name for token, option in spec.abbreviation_tokens.items()},
+            }
+            for name, spec in COFFEE_SPECS.items()
+        },
+    }
 
 
 COFFEE_SPECS['type'] = CoffeeSpec('type', 'What type of coffee?', required=True)
@@ -24,6 +24,42 @@ class Config(object):
     SLACK_OAUTH_CLIENT_ID = os.environ.get('SLACK_OAUTH_CLIENT_ID')
     SLACK_OAUTH_CLIENT_SECRET = os.environ.get('SLACK_OAUTH_CLIENT_SECRET')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Where to look up who is logging in ('slack', or 'stub' for tests), and
+    # how long (in seconds) to remember the answer for.
+    SLACK_IDENTITY_PROVIDER = 'slack'
+    SLACK_IDENTITY_CACHE_TTL = 300
+    # Seconds the chat bot remembers the user behind a Slack id for.
+    SLACK_USER_CACHE_TTL = 300
+    # How many months of activity to keep in the database (None keeps
+    # everything). Older events are moved to gzipped files in
+    # EVENT_ARCHIVE_DIR by `python manage.py archive_events`.
+    EVENT_RETENTION_MONTHS = None
+    EVENT_ARCHIVE_DIR = os.environ.get('EVENT_ARCHIVE_DIR', os.path.join(CURRENT_DIR, 'archive'))
+    # Seconds to keep rendered parts of the home page for. They are also
+    # thrown away whenever something changes in this process; this bounds
+    # how stale they can be after changes made by other processes (e.g. the
+    # chat bot, or other web workers).
+    HOME_FRAGMENT_CACHE_TTL = 60
+    # How run updates get to the browsers watching them: 'local' (this
+    # process only) or 'postgres' (LISTEN/NOTIFY, across processes).
+    LIVE_UPDATES_BROKER = 'local'
+    # Each open stream holds a web worker thread (see the Procfile's
+    # --threads), so streams are short, and at most half of the threads are
+    # streams.
+    LIVE_UPDATES_STREAM_SECONDS = 10
+    LIVE_UPDATES_KEEPALIVE_SECONDS = 5
+    LIVE_UPDATES_MAX_STREAMS = 4
+    # Logins are kept in 'sqlalchemy' (the database, read through a cache)
+    # or 'cookie' (a signed cookie) sessions, see application/sessions.py.
+    # Database sessions are cached for SESSION_CACHE_TTL seconds, their
+    # expiry is pushed back at most every SESSION_REFRESH_SECONDS, and
+    # expired ones are deleted every SESSION_SWEEP_SECONDS.
+    SESSION_CACHE_TTL = 300
+    SESSION_REFRESH_SECONDS = 3600
+    SESSION_SWEEP_SECONDS = 3600
+    # Seconds to remember a logged in user for, rather than loading them on
+    # every request.
+    USER_CACHE_TTL = 300
 
 
 class DevConfig(Config):
@@ -36,6 +72,7 @@ class DevConfig(Config):
 class TestConfig(Config):
     CSRF_ENABLED = False
     TESTING = True
+    SLACK_IDENTITY_PROVIDER = 'stub'
     SQLALCHEMY_DATABASE_URI = 'sqlite:////' + os.path.join(CURRENT_DIR, 'application', 'coffeerun-test.db')
 
 
@@ -44,3 +81,4 @@ class ProdConfig(Config):
     DEBUG = True
     SESSION_TYPE = 'sqlalchemy'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    LIVE_UPDATES_BROKER = 'postgres'
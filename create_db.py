@@ -1,4 +1,4 @@
-from application import app, db
+from application import app, create_session_table, db
 from application.models import Cafe
 
 
@@ -6,6 +6,7 @@ def main():
     db.drop_all()
     db.init_app(app)
     db.create_all()
+    create_session_table()
 
     db.session.add(Cafe('ABS', 'Sydney Uni: Business School'))
     db.session.add(Cafe('Cafe Ella', '274 Abercrombie St, Darlington'))
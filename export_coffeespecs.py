@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Build the browser's copy of the coffee parser's vocabulary.
+
+Writes application/static/js/coffeespecs-data.js from the tables in
+coffeespecs.py. Run this after changing COFFEE_SPECS, and commit the result.
+
+Usage:
+    python export_coffeespecs.py          # Rewrite the file.
+    python export_coffeespecs.py --check  # Fail if the file is out of date.
+"""
+import argparse
+import json
+import os
+import sys
+
+import coffeespecs
+
+
+OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'application', 'static', 'js', 'coffeespecs-data.js')
+
+
+def render():
+    tables = json.dumps(coffeespecs.export_tables(), sort_keys=True, separators=(',', ':'))
+    return (
+        '// Generated from coffeespecs.py by export_coffeespecs.py. Do not edit.\n'
+        'var COFFEE_SPECS_DATA = {};\n'.format(tables))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', action='store_true', help='fail if the file is out of date, rather than writing it')
+    args = parser.parse_args()
+
+    content = render()
+    if args.check:
+        try:
+            with open(OUTPUT) as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if current != content:
+            print('{} is out of date. Run python export_coffeespecs.py'.format(OUTPUT), file=sys.stderr)
+            return 1
+        return 0
+
+    with open(OUTPUT, 'w') as f:
+        f.write(content)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Looking up words by edit distance, for misspelt coffee orders.
+
+This uses symmetric deletion (as in SymSpell): each word in the vocabulary
+is indexed under every string made by deleting up to `max_distance` of its
+characters. A misspelling within `max_distance` edits of a word always
+shares one of those deletions with it, so a lookup is a few dict lookups
+plus checking the handful of candidates found, rather than comparing the
+misspelling with every word.
+"""
+import collections
+
+
+Match = collections.namedtuple('Match', ['word', 'distance', 'similarity'])
+
+
+def edit_distance(a, b, limit=None):
+    """The number of edits to turn `a` into `b`.
+
+    An edit is inserting, deleting or changing a character, or swapping two
+    adjacent ones (the optimal string alignment distance). If `limit` is
+    given, any distance over it may be returned as `limit + 1`.
+    """
+    if a == b:
+        return 0
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def similarity(a, b, distance=None):
+    """How alike two words are, from 0 (nothing alike) to 1 (the same)."""
+    if distance is None:
+        distance = edit_distance(a, b)
+    longest = max(len(a), len(b))
+    if not longest:
+        return 1.0
+    return 1.0 - distance / longest
+
+
+def deletions(word, max_distance):
+    """Every string made by deleting up to `max_distance` characters from `word`."""
+    found = {word}
+    current = {word}
+    for _ in range(max_distance):
+        current = {w[:i] + w[i + 1:] for w in current for i in range(len(w))}
+        found.update(current)
+    return found
+
+
+class FuzzyIndex:
+    """A vocabulary that can be searched for the words closest to a misspelling."""
+
+    def __init__(self, words, max_distance=2):
+        self.max_distance = max_distance
+        self.words = set(words)
+        self._index = collections.defaultdict(set)
+        for word in self.words:
+            for deletion in deletions(word, max_distance):
+                self._index[deletion].add(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def lookup(self, term, max_distance=None):
+        """The words within `max_distance` edits of `term`, closest first.
+
+        Returns a list of Match, ordered by distance, then by word.
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        candidates = set()
+        for deletion in deletions(term, max_distance):
+            candidates.update(self._index.get(deletion, ()))
+        matches = []
+        for word in candidates:
+            distance = edit_distance(term, word, limit=max_distance)
+            if distance <= max_distance:
+                matches.append(Match(word, distance, similarity(term, word, distance)))
+        matches.sort(key=lambda match: (match.distance, match.word))
+        return matches
@@ -1,7 +1,48 @@
 __author__ = 'maddy'
 
-from application import manager
+import sys
+
+import application
+from application import app, event_store, init_web, manager
+
+
+@manager.command
+def create_session_table():
+    """Create the table for server side sessions (once per database)."""
+    application.create_session_table()
+
+
+@manager.command
+def sweep_sessions():
+    """Delete expired server side sessions."""
+    init_web()
+    if not hasattr(app.session_interface, 'sweep_expired'):
+        print('Sessions are not stored in the database, nothing to sweep.')
+        return
+    count = app.session_interface.sweep_expired()
+    print('Deleted {} expired sessions'.format(count))
+
+
+@manager.option('--months', type=int, default=None, help='Months of activity to keep (default: EVENT_RETENTION_MONTHS).')
+@manager.option('--archive-dir', dest='archive_dir', default=None, help='Where to write archived events (default: EVENT_ARCHIVE_DIR).')
+def archive_events(months=None, archive_dir=None):
+    """Move old activity events out of the database into compressed files."""
+    if months is None:
+        months = app.config['EVENT_RETENTION_MONTHS']
+    if months is None:
+        print('No retention period configured, nothing to archive.')
+        return
+    archive_dir = archive_dir or app.config['EVENT_ARCHIVE_DIR']
+    try:
+        count = event_store.archive_old_events(months, archive_dir)
+    except ValueError as e:
+        sys.exit(str(e))
+    print('Archived {} events to {}'.format(count, archive_dir))
 
 
 if __name__ == "__main__":
+    # Only the development server and shell need the views (and the rest of
+    # the web stack).
+    if sys.argv[1:2] in (['runserver'], ['shell']):
+        init_web()
     manager.run()
@@ -0,0 +1,25 @@
+"""Version each cafe's price list.
+
+Revision ID: 3f6a9c1e7b42
+Revises: 8e4b0a6d2c17
+Create Date: 2026-10-19 13:41:27.306518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a9c1e7b42'
+down_revision = '8e4b0a6d2c17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Cafes', sa.Column('price_version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('Cafes') as batch_op:
+        batch_op.drop_column('price_version')
@@ -0,0 +1,25 @@
+"""Only allow one user per slack identity.
+
+Revision ID: 5c1d7e2f9a3b
+Revises: 22986cd55d4c
+Create Date: 2026-10-19 09:12:40.118273
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1d7e2f9a3b'
+down_revision = '22986cd55d4c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+            'ix_Users_slack_identity', 'Users',
+            ['slack_team_id', 'slack_user_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_Users_slack_identity', table_name='Users')
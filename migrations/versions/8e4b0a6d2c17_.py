@@ -0,0 +1,34 @@
+"""Partition the activity log into monthly buckets.
+
+Revision ID: 8e4b0a6d2c17
+Revises: 5c1d7e2f9a3b
+Create Date: 2026-10-19 10:03:12.551902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4b0a6d2c17'
+down_revision = '5c1d7e2f9a3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Events', sa.Column('bucket', sa.Integer(), nullable=True))
+
+    # Times are stored as nieve UTC, and buckets are UTC months (YYYYMM).
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute("UPDATE \"Events\" SET bucket = CAST(strftime('%Y%m', time) AS INTEGER)")
+    else:
+        op.execute("UPDATE \"Events\" SET bucket = CAST(to_char(time, 'YYYYMM') AS INTEGER)")
+
+    op.create_index('ix_Events_bucket_id', 'Events', ['bucket', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_Events_bucket_id', table_name='Events')
+    with op.batch_alter_table('Events') as batch_op:
+        batch_op.drop_column('bucket')
@@ -0,0 +1,83 @@
+"""Keep each distinct coffee spec once, in CoffeeSpecs.
+
+Revision ID: b71d4e3a9c05
+Revises: 3f6a9c1e7b42
+Create Date: 2026-10-19 15:20:44.803117
+
+"""
+from alembic import op
+import coffeespecs
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71d4e3a9c05'
+down_revision = '3f6a9c1e7b42'
+branch_labels = None
+depends_on = None
+
+# How many distinct specs to add, and coffees to update, per statement.
+BATCH_SIZE = 500
+
+PRICE_KEY_COLUMNS = ['price_key', 'price_key_fuzzy_type', 'price_key_fuzzy_size', 'price_key_fuzzy_strength']
+
+
+def spec_values(spec):
+    """The CoffeeSpecs row for a coffee's JSON, as models.coffee_spec_values makes it.
+
+    This is a copy, so that this migration keeps working however the models
+    change later.
+    """
+    try:
+        c = coffeespecs.Coffee.fromJSON(spec)
+    except (coffeespecs.JavaException, ValueError, TypeError, AttributeError):
+        return dict({'spec': spec, 'description': None}, **dict.fromkeys(PRICE_KEY_COLUMNS))
+    return dict({'spec': spec, 'description': str(c)}, **dict(zip(PRICE_KEY_COLUMNS, c.get_ordered_price_keys())))
+
+
+def upgrade():
+    op.create_table(
+        'CoffeeSpecs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('spec', sa.String(), nullable=False),
+        sa.Column('description', sa.String(), nullable=True),
+        sa.Column('price_key', sa.String(), nullable=True),
+        sa.Column('price_key_fuzzy_type', sa.String(), nullable=True),
+        sa.Column('price_key_fuzzy_size', sa.String(), nullable=True),
+        sa.Column('price_key_fuzzy_strength', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('spec'),
+    )
+    with op.batch_alter_table('Coffees') as batch_op:
+        batch_op.add_column(sa.Column('spec_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_Coffees_spec_id', 'CoffeeSpecs', ['spec_id'], ['id'])
+    op.create_index('ix_Coffees_spec_id', 'Coffees', ['spec_id'])
+
+    # There are only a few distinct specs, so add them all, then point each
+    # coffee at its spec with one UPDATE per batch of specs.
+    connection = op.get_bind()
+    coffees = sa.table('Coffees', sa.column('coffee'), sa.column('spec_id'))
+    coffee_specs = sa.table(
+        'CoffeeSpecs', sa.column('id'), sa.column('spec'), sa.column('description'),
+        *[sa.column(name) for name in PRICE_KEY_COLUMNS])
+    specs = sorted(spec for spec, in connection.execute(
+        sa.select([coffees.c.coffee]).where(coffees.c.coffee != None).distinct()))  # noqa: E711
+    for start in range(0, len(specs), BATCH_SIZE):
+        batch = specs[start:start + BATCH_SIZE]
+        connection.execute(coffee_specs.insert(), [spec_values(spec) for spec in batch])
+        spec_ids = {spec: spec_id for spec, spec_id in connection.execute(
+            sa.select([coffee_specs.c.spec, coffee_specs.c.id]).where(coffee_specs.c.spec.in_(batch)))}
+        connection.execute(
+            coffees.update().where(coffees.c.coffee == sa.bindparam('spec')).values(spec_id=sa.bindparam('new_spec_id')),
+            [{'spec': spec, 'new_spec_id': spec_ids[spec]} for spec in batch])
+
+
+def downgrade():
+    op.drop_index('ix_Coffees_spec_id', table_name='Coffees')
+    # sqlite does not keep the foreign key's name, so batch mode has to be
+    # told what it is called.
+    naming_convention = {'fk': 'fk_%(table_name)s_%(column_0_name)s'}
+    with op.batch_alter_table('Coffees', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('fk_Coffees_spec_id', type_='foreignkey')
+        batch_op.drop_column('spec_id')
+    op.drop_table('CoffeeSpecs')
@@ -6,8 +6,6 @@ from absl import app, flags, logging
 
 from application import db, models
 
-import coffeespecs
-
 
 FLAGS = flags.FLAGS
 
@@ -36,23 +34,30 @@ def main(argv):
     if FLAGS.run_id:
         filters.append(models.Run.id == FLAGS.run_id)
 
-    query = models.Coffee.query.filter(*filters).join(models.Run).join(models.Cafe)
+    # Each coffee's price is looked up in the same query, by joining its spec
+    # to the cafe's prices.
+    query = db.session.query(models.Coffee, models.Cafe.name, models.CoffeeSpec, models.spec_price(models.Run.cafeid)) \
+        .filter(*filters) \
+        .join(models.Run) \
+        .join(models.Cafe) \
+        .join(models.CoffeeSpec, models.Coffee.spec_id == models.CoffeeSpec.id)
     logging.info('About to execute the query: %s', query)
 
-    for coffee in query:
+    for coffee, cafe_name, spec, new_price in query:
         logging.info('Processing %s, current price: $%s', coffee, coffee.price)
-        new_price = coffee.lookup_price(default_price=None)
         if new_price is not None:
             if coffee.price == new_price:
                 continue
             logging.info('Updating price for coffee %s from %s to %s', coffee.id, coffee.price, new_price)
             delta += new_price - coffee.price
             coffee.price = new_price
+            # So that pages showing the coffee are not answered from the
+            # browser's cache (see views._conditional).
+            coffee.modified = models.sydney_timezone_now()
             changed += 1
         else:
             logging.warn('No price for: %s', coffee)
-            spec = coffeespecs.Coffee.fromJSON(coffee.coffee)
-            unknown_coffees[coffee.run.cafe.name][spec.get_price_key(fuzzy_fields={'type', 'size', 'strength'})].add(spec.get_price_key())
+            unknown_coffees[cafe_name][spec.price_key_fuzzy_strength].add(spec.price_key)
             unknown += 1
     if FLAGS.dry_run:
         db.session.rollback()
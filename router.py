@@ -0,0 +1,161 @@
+"""Single pass routing of chat messages to handlers.
+
+Rather than trying each regular expression in turn, all of the patterns are
+combined into one compiled alternation, so a message is matched against all
+of them in a single call into the regex engine.
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+
+_NAMED_GROUP_RE = re.compile(r'\(\?P<[A-Za-z_][A-Za-z0-9_]*>')
+# An escaped backslash, or a numbered backreference (group 1).
+_ESCAPE_RE = re.compile(r'\\(?:\\|([1-9]))')
+
+
+class CommandRouter:
+    """Find the first of an ordered list of patterns that matches some text.
+
+    This behaves the same as calling `re.match` with each pattern in order and
+    stopping at the first match, but only runs one (combined) regex over text
+    that does not match, and one more for the pattern that matched.
+
+    Args:
+        routes: an iterable of (pattern, target) pairs. Patterns are tried in
+            order. The target can be anything (e.g. a handler name).
+    """
+
+    def __init__(self, routes):
+        self._routes = []
+        alternatives = []
+        for i, (pattern, target) in enumerate(routes):
+            # Backreferences would refer to the wrong groups once the patterns
+            # are combined.
+            if '(?P=' in pattern:
+                raise ValueError('Named backreferences are not supported: {}'.format(pattern))
+            if any(m.group(1) for m in _ESCAPE_RE.finditer(pattern)):
+                raise ValueError('Numbered backreferences are not supported: {}'.format(pattern))
+            self._routes.append((re.compile(pattern), target))
+            # Group names must be unique across the combined pattern, so
+            # demote them to plain groups. Handlers get a match from the
+            # original pattern, so they still see their named groups.
+            alternatives.append('(?P<_route{}>{})'.format(
+                    i, _NAMED_GROUP_RE.sub('(', pattern)))
+        self._combined = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def __len__(self):
+        return len(self._routes)
+
+    def route(self, text):
+        """Return (target, match) for the first matching pattern.
+
+        The match object comes from the original pattern. Returns (None, None)
+        if nothing matched.
+        """
+        if self._combined is None:
+            return None, None
+        match = self._combined.match(text)
+        if match is None:
+            return None, None
+        # The wrapping group closes after any groups nested inside it, so it
+        # is always the last group matched.
+        pattern, target = self._routes[int(match.lastgroup[len('_route'):])]
+        return target, pattern.match(text)
+
+
+def load_triggers(filename):
+    """Parse a sass file into an ordered list of (pattern, responses) pairs.
+
+    The file is made up of blocks: a trigger line starting with '@@@ '
+    followed by the responses for that trigger, one per line.
+    """
+    triggers = {}
+    trigger = None
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if line.startswith('@@@ '):
+                trigger = line[4:].strip()
+                triggers.setdefault(trigger, [])
+            elif trigger:
+                triggers[trigger].append(line.strip())
+    return [(trigger, tuple(responses)) for trigger, responses in triggers.items()]
+
+
+class TriggerTable:
+    """A process wide, read only table of sass triggers.
+
+    The file is parsed and compiled once. If `hot_reload` is set, the file's
+    modification time is checked (at most every `check_interval` seconds) and
+    the table is rebuilt when it changes, so new sass can be added without a
+    restart. Each rebuild swaps in a whole new router, so readers on other
+    threads never see a half loaded table.
+
+    Use `get_trigger_table` rather than creating these directly, so that
+    there is only one table per file.
+    """
+
+    def __init__(self, filename, hot_reload=False, check_interval=5):
+        self.filename = filename
+        self.hot_reload = hot_reload
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(filename).st_mtime
+        self._router = CommandRouter(load_triggers(filename))
+        self._next_check = time.monotonic() + check_interval
+
+    def __len__(self):
+        return len(self._router)
+
+    def route(self, text):
+        """Return (responses, match) for the first trigger matching `text`."""
+        if self.hot_reload and time.monotonic() >= self._next_check:
+            self._maybe_reload()
+        return self._router.route(text)
+
+    def _maybe_reload(self):
+        # Only one thread needs to check. Everyone else carries on with the
+        # current table.
+        if not self._lock.acquire(blocking=False):
+            return
+        logger = logging.getLogger('router')
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                mtime = os.stat(self.filename).st_mtime
+            except OSError:
+                logger.exception('Failed to check %s for changes', self.filename)
+                return
+            if mtime == self._mtime:
+                return
+            # Whatever happens, do not try this version of the file again.
+            self._mtime = mtime
+            try:
+                router = CommandRouter(load_triggers(self.filename))
+            except (OSError, ValueError, re.error):
+                logger.exception('Failed to reload triggers from %s, keeping the old ones', self.filename)
+                return
+            self._router = router
+            logger.info('Reloaded %d triggers from %s', len(router), self.filename)
+        finally:
+            self._lock.release()
+
+
+_trigger_tables = {}
+_trigger_tables_lock = threading.Lock()
+
+
+def get_trigger_table(filename, hot_reload=False):
+    """Get the shared TriggerTable for `filename`, loading it the first time."""
+    key = os.path.abspath(filename)
+    with _trigger_tables_lock:
+        table = _trigger_tables.get(key)
+        if table is None:
+            table = _trigger_tables[key] = TriggerTable(key, hot_reload=hot_reload)
+        elif hot_reload:
+            table.hot_reload = True
+        return table
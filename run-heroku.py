@@ -1 +1,3 @@
-from application import app  # noqa: F401
+from application import init_web
+
+app = init_web()
@@ -1,7 +1,8 @@
 import logging
 
-from application import app
+from application import init_web
 
 
 logging.basicConfig(level=logging.DEBUG)
+app = init_web()
 app.run(port=8000, host='0.0.0.0')
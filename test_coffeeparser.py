@@ -0,0 +1,117 @@
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import unittest
+
+import coffeespecs
+
+import export_coffeespecs
+
+
+JS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'application', 'static', 'js')
+
+# Loads the browser parser into node, and parses each request read from stdin.
+NODE_SCRIPT = '''
+const fs = require('fs');
+const path = require('path');
+const vm = require('vm');
+const context = {};
+vm.createContext(context);
+for (const name of ['coffeespecs-data.js', 'coffeeparser.js']) {
+    vm.runInContext(fs.readFileSync(path.join(process.argv[1], name), 'utf8'), context);
+}
+const requests = JSON.parse(fs.readFileSync(0, 'utf8'));
+const results = requests.map(function(request) {
+    let coffee;
+    try {
+        coffee = context.CoffeeParser.parse(request);
+    } catch (e) {
+        return {error: true};
+    }
+    const valid = coffee.validate();
+    return {
+        specs: coffee.specs,
+        valid: valid,
+        str: coffee.toString(),
+        price_keys: valid ? coffee.getOrderedPriceKeys() : null,
+    };
+});
+process.stdout.write(JSON.stringify(results));
+'''
+
+
+def parse_with_python(request):
+    try:
+        coffee = coffeespecs.Coffee(request)
+    except Exception:
+        return {'error': True}
+    valid = coffee.validate()
+    return {
+        'specs': coffee.specs,
+        'valid': valid,
+        'str': str(coffee),
+        # Only complete coffees have a price.
+        'price_keys': coffee.get_ordered_price_keys() if valid else None,
+    }
+
+
+def parse_with_node(requests):
+    output = subprocess.run(
+            ['node', '-e', NODE_SCRIPT, JS_DIR],
+            input=json.dumps(requests), stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def example_requests():
+    """The requests used in test_coffeespecs.py, plus lots of random ones."""
+    test_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_coffeespecs.py')
+    with open(test_file) as f:
+        requests = re.findall(r"Coffee\('([^']*)'\)", f.read())
+
+    tables = coffeespecs.export_tables()
+    words = tables['word_tokens']
+    abbreviations = sorted({a for tokens in tables['abbreviation_tokens'].values() for a in tokens})
+    noise = ['please', 'with', 'a', 'the', 'EXTRA', 'milk', '!', "'", 'and,', '(soy)']
+
+    rng = random.Random(1234)
+    for _ in range(3000):
+        parts = []
+        for _ in range(rng.randint(1, 5)):
+            kind = rng.random()
+            if kind < 0.5:
+                parts.append(rng.choice(words))
+            elif kind < 0.8:
+                # Runs of abbreviations, like 'lcx'.
+                parts.append(''.join(rng.choice(abbreviations) for _ in range(rng.randint(1, 3))))
+            else:
+                parts.append(rng.choice(noise))
+        request = ' '.join(parts)
+        if rng.random() < 0.3:
+            request = request.upper()
+        requests.append(request)
+    return requests
+
+
+class TestExport(unittest.TestCase):
+    def test_generated_file_is_current(self):
+        with open(export_coffeespecs.OUTPUT) as f:
+            self.assertEqual(
+                    f.read(), export_coffeespecs.render(),
+                    'Run python export_coffeespecs.py to regenerate it.')
+
+
+@unittest.skipUnless(shutil.which('node'), 'node is not installed')
+class TestBrowserParser(unittest.TestCase):
+    def test_matches_python_parser(self):
+        requests = example_requests()
+        results = parse_with_node(requests)
+        self.assertEqual(len(results), len(requests))
+        for request, result in zip(requests, results):
+            self.assertEqual(result, parse_with_python(request), request)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
+import pickle
 import unittest
 
-from coffeespecs import Coffee, get_all_word_tokens
+from coffeespecs import COFFEE_SPECS, Coffee, CoffeeSpecOption, JavaException, Spec, correct_token, get_all_abbreviation_tokens_by_spec, get_all_word_tokens, suggestions
 
 
 class TestCoffeeValidation(unittest.TestCase):
@@ -25,6 +26,12 @@ class TestParser(unittest.TestCase):
         # All tokens should be lowercase
         self.assertTrue(all([x.islower() for x in tokens]))
 
+    def test_token_tables_are_copies(self):
+        get_all_word_tokens().clear()
+        get_all_abbreviation_tokens_by_spec()['size'].clear()
+        self.assertIn('chocolate', get_all_word_tokens())
+        self.assertEqual(Coffee('LC').specs, {'type': 'Cappuccino', 'size': 'Large'})
+
     def test_parse(self):
         c = Coffee('Large Cap')
         self.assertTrue(c.validate())
@@ -335,5 +342,131 @@ class TestPrettyPrint(unittest.TestCase):
         self.assertEqual('Regular Soy Decaf Latte with 2 Sugars', str(c))
 
 
+class TestSpec(unittest.TestCase):
+    def test_round_trip(self):
+        c = Coffee('Soy decaf latte with 2 sugars')
+        spec = c.spec
+        self.assertEqual(spec.to_dict(), c.specs)
+        self.assertEqual(spec.toJSON(), c.toJSON())
+        self.assertEqual(Spec.fromJSON(c.toJSON()), spec)
+        self.assertEqual(str(spec), str(c))
+        self.assertEqual(Coffee.from_spec(spec).specs, c.specs)
+
+    def test_codes(self):
+        spec = Coffee('Large Cap').spec
+        self.assertEqual(len(spec.codes), 7)
+        # type, size, then nothing else set.
+        self.assertEqual(spec.codes[2:], (0, 0, 0, 0, 0))
+        self.assertEqual(spec['type'], 'Cappuccino')
+        self.assertEqual(spec.get('milk', 'Full Cream'), 'Full Cream')
+        self.assertIn('size', spec)
+        self.assertNotIn('milk', spec)
+        with self.assertRaises(KeyError):
+            spec['milk']
+
+    def test_hashable(self):
+        a = Coffee('Large Cap').spec
+        b = Coffee('LC').spec
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(len({a, b, Coffee('SC').spec}), 2)
+        self.assertEqual(sorted([a, b]), [a, b])
+
+    def test_immutable(self):
+        spec = Coffee('Large Cap').spec
+        with self.assertRaises(AttributeError):
+            spec.codes = (0,) * 7
+        with self.assertRaises(AttributeError):
+            spec.other = 1
+        self.assertEqual(pickle.loads(pickle.dumps(spec)), spec)
+
+    def test_invalid(self):
+        with self.assertRaises(JavaException):
+            Spec.from_dict({'type': 3})
+        with self.assertRaises(JavaException):
+            Spec.from_dict({'flavour': 'Vanilla'})
+        with self.assertRaises(JavaException):
+            Spec.fromJSON('[]')
+        with self.assertRaises(JavaException):
+            Coffee.fromJSON('{"size": "Large"}')
+
+    def test_unknown_options(self):
+        # Stored coffees may name options that no longer exist.
+        c = Coffee.fromJSON('{"size": "Large", "type": "Frappuccino"}')
+        self.assertEqual(str(c), 'Large Frappuccino')
+        self.assertEqual(c.spec['type'], 'Frappuccino')
+        self.assertEqual(c.toJSON(), '{"size": "Large", "type": "Frappuccino"}')
+        self.assertEqual(c.get_ordered_price_keys()[0], 'Large Frappuccino')
+        self.assertEqual(pickle.loads(pickle.dumps(c.spec)), c.spec)
+        specs = [c.spec, Coffee('Large Cap').spec, Spec.from_dict({'type': 'Affogatino'})]
+        self.assertEqual(len(set(specs)), 3)
+        self.assertEqual(sorted(specs), sorted(reversed(specs)))
+
+    def test_parsed_coffees_share_nothing_mutable(self):
+        c = Coffee('Large Cap')
+        spec = c.spec
+        c.add_spec('milk', 'soy')
+        self.assertNotIn('milk', spec)
+        self.assertEqual(c.specs, {'type': 'Cappuccino', 'size': 'Large', 'milk': 'Soy'})
+        c.specs['size'] = 'Small'
+        self.assertEqual(c.spec['size'], 'Large')
+
+    def test_option_equality(self):
+        option = CoffeeSpecOption('type', 'Latte', [], [])
+        self.assertIn(option, COFFEE_SPECS['type'].options)
+        self.assertNotEqual(option, CoffeeSpecOption('size', 'Latte', [], []))
+
+
+class TestFuzzy(unittest.TestCase):
+    def test_exact_by_default(self):
+        c = Coffee('cappucino')
+        self.assertFalse(c.validate())
+        self.assertEqual(c.unparsed, ['cappucino'])
+
+    def test_misspellings(self):
+        for request, specs in [
+                ('cappucino', {'type': 'Cappuccino'}),
+                ('flatwhite', {'type': 'Flat White'}),
+                ('lattte', {'type': 'Latte'}),
+                ('larg flat whtie', {'size': 'Large', 'type': 'Flat White'}),
+                ('soy expresso', {'milk': 'Soy', 'type': 'Espresso'}),
+        ]:
+            c = Coffee(request, fuzzy=True)
+            self.assertTrue(c.validate(), request)
+            self.assertEqual(c.specs, specs, request)
+
+    def test_corrections(self):
+        c = Coffee('Large cappucino please', fuzzy=True)
+        self.assertEqual(c.corrections, [('cappucino', 'cappuccino')])
+        self.assertEqual(c.unparsed, ['please'])
+
+    def test_exact_first(self):
+        # Words that are understood are never corrected.
+        c = Coffee('Large Cap', fuzzy=True)
+        self.assertEqual(c.corrections, [])
+        self.assertEqual(c.specs, {'type': 'Cappuccino', 'size': 'Large'})
+
+    def test_valid_orders_are_not_corrected(self):
+        # 'sugars' is close to 'sugar', but the order is fine without it.
+        for request in ['latte two sugars', 'Large Cap please', 'lb']:
+            exact = Coffee(request)
+            c = Coffee(request, fuzzy=True)
+            self.assertEqual(c.specs, exact.specs, request)
+            self.assertEqual(c.corrections, [], request)
+        self.assertEqual(str(Coffee('latte two sugars', fuzzy=True)), 'Regular Latte')
+
+    def test_threshold(self):
+        self.assertEqual(correct_token('cappucino'), 'cappuccino')
+        # Short words are too easily something else.
+        self.assertIsNone(correct_token('tee'))
+        self.assertIsNone(correct_token('with'))
+        self.assertIsNone(correct_token('lattte', min_similarity=0.9))
+
+    def test_suggestions(self):
+        self.assertEqual(suggestions('machiato'), ['Macchiato'])
+        self.assertEqual(suggestions('please'), [])
+        self.assertLessEqual(len(suggestions('lat', limit=2)), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
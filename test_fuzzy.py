@@ -0,0 +1,59 @@
+import itertools
+import unittest
+
+from fuzzy import FuzzyIndex, deletions, edit_distance, similarity
+
+
+class TestEditDistance(unittest.TestCase):
+    def test_edits(self):
+        self.assertEqual(edit_distance('latte', 'latte'), 0)
+        self.assertEqual(edit_distance('latte', 'lattte'), 1)
+        self.assertEqual(edit_distance('latte', 'late'), 1)
+        self.assertEqual(edit_distance('latte', 'lette'), 1)
+        self.assertEqual(edit_distance('', 'mocha'), 5)
+
+    def test_transposition(self):
+        self.assertEqual(edit_distance('white', 'whtie'), 1)
+        self.assertEqual(edit_distance('latte', 'ltate'), 1)
+
+    def test_limit(self):
+        self.assertEqual(edit_distance('espresso', 'tea', limit=2), 3)
+        self.assertEqual(edit_distance('cappuccino', 'cappucino', limit=2), 1)
+
+    def test_similarity(self):
+        self.assertEqual(similarity('mocha', 'mocha'), 1.0)
+        self.assertAlmostEqual(similarity('cappucino', 'cappuccino'), 0.9)
+        self.assertEqual(similarity('', ''), 1.0)
+
+
+class TestFuzzyIndex(unittest.TestCase):
+    WORDS = ['cappuccino', 'latte', 'lattee', 'mocha', 'flat white', 'tea', 'large']
+
+    def test_deletions(self):
+        self.assertEqual(deletions('tea', 1), {'tea', 'ea', 'ta', 'te'})
+
+    def test_lookup(self):
+        index = FuzzyIndex(self.WORDS)
+        self.assertEqual(index.lookup('latte')[0].word, 'latte')
+        self.assertEqual(index.lookup('cappucino')[0].word, 'cappuccino')
+        self.assertEqual(index.lookup('flatwhite')[0].word, 'flat white')
+        self.assertEqual([m.word for m in index.lookup('lattte')], ['latte', 'lattee'])
+        self.assertEqual(index.lookup('espresso'), [])
+
+    def test_max_distance(self):
+        index = FuzzyIndex(self.WORDS, max_distance=1)
+        self.assertEqual(index.lookup('capucino'), [])
+        self.assertEqual(index.lookup('lattte', max_distance=0), [])
+
+    def test_same_as_brute_force(self):
+        index = FuzzyIndex(self.WORDS)
+        for length in range(1, 4):
+            for chars in itertools.product('aelt ', repeat=length):
+                term = 'la' + ''.join(chars)
+                expected = sorted((edit_distance(term, word), word) for word in self.WORDS
+                                  if edit_distance(term, word) <= 2)
+                self.assertEqual([(m.distance, m.word) for m in index.lookup(term)], expected, term)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import re
+import tempfile
+import time
+import unittest
+
+from router import CommandRouter, TriggerTable, get_trigger_table, load_triggers
+
+
+class TestCommandRouter(unittest.TestCase):
+    ROUTES = [
+        (r'(?:(?:open|list) )?runs', 'list_runs'),
+        (r'order(?: an?)? ([^\=]+)(?: run=(?P<runid>[0-9]+))?', 'order'),
+        (r'([^\=]+) (?:plz|pls|please)(?: run=(?P<runid>[0-9]+))?', 'order_polite'),
+        (r'close run(?: run=(?P<runid>[0-9]+))?', 'close_run'),
+    ]
+
+    def setUp(self):
+        self.router = CommandRouter(self.ROUTES)
+
+    def assertSameAsLinearScan(self, text):
+        expected = (None, None)
+        for pattern, target in self.ROUTES:
+            match = re.match(pattern, text)
+            if match:
+                expected = (target, match)
+                break
+        target, match = self.router.route(text)
+        self.assertEqual(target, expected[0], text)
+        if match is not None:
+            self.assertEqual(match.groups(), expected[1].groups())
+            self.assertEqual(match.groupdict(), expected[1].groupdict())
+
+    def test_route(self):
+        target, match = self.router.route('order a large cap')
+        self.assertEqual(target, 'order')
+        self.assertEqual(match.group(1), 'large cap')
+
+        target, match = self.router.route('close run run=3')
+        self.assertEqual(target, 'close_run')
+        self.assertEqual(match.group('runid'), '3')
+
+    def test_no_match(self):
+        self.assertEqual(self.router.route('hello there'), (None, None))
+        self.assertEqual(CommandRouter([]).route('runs'), (None, None))
+
+    def test_first_match_wins(self):
+        # Matches both 'order' and 'order_polite', but 'order' comes first.
+        self.assertEqual(self.router.route('order a latte please')[0], 'order')
+
+    def test_matches_linear_scan(self):
+        for text in [
+                'runs', 'open runs', 'list runs', 'order latte', 'order an lc run=12',
+                'lc please', 'large soy latte plz run=4', 'close run', 'close run run=7',
+                'nothing to see here', '', 'order']:
+            self.assertSameAsLinearScan(text)
+
+    def test_rejects_backreferences(self):
+        with self.assertRaises(ValueError):
+            CommandRouter([(r'(?P<a>x)(?P=a)', 'a')])
+        with self.assertRaises(ValueError):
+            CommandRouter([(r'(x)\1', 'a')])
+        # An escaped backslash followed by a digit is not a backreference.
+        router = CommandRouter([(r'x\\1', 'a')])
+        self.assertEqual(router.route('x\\1')[0], 'a')
+
+
+class TestLoadTriggers(unittest.TestCase):
+    def test_sass_file(self):
+        triggers = load_triggers('sass.txt')
+        self.assertTrue(triggers)
+        for pattern, responses in triggers:
+            re.compile(pattern)
+            self.assertTrue(responses, pattern)
+        router = CommandRouter(triggers)
+        responses, _ = router.route('i want a pumpkin spice latte')
+        self.assertIn('The spice must flow!', responses)
+
+
+class TestTriggerTable(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        self.write('@@@ .*coffee\nYum\n')
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def write(self, contents):
+        with open(self.filename, 'w') as f:
+            f.write(contents)
+
+    def test_shared_per_file(self):
+        self.assertIs(get_trigger_table(self.filename), get_trigger_table(self.filename))
+
+    def test_route(self):
+        table = TriggerTable(self.filename)
+        self.assertEqual(table.route('more coffee')[0], ('Yum',))
+        self.assertEqual(table.route('tea'), (None, None))
+
+    def test_hot_reload(self):
+        table = TriggerTable(self.filename, hot_reload=True, check_interval=0)
+        self.write('@@@ .*tea\nEarl grey\n')
+        # Make sure the modification time changes, however coarse it is.
+        mtime = os.stat(self.filename).st_mtime + 10
+        os.utime(self.filename, (mtime, mtime))
+        self.assertEqual(table.route('tea')[0], ('Earl grey',))
+
+    def test_bad_reload_keeps_old_table(self):
+        table = TriggerTable(self.filename, hot_reload=True, check_interval=0)
+        self.write('@@@ (unbalanced\nOops\n')
+        mtime = time.time() + 10
+        os.utime(self.filename, (mtime, mtime))
+        self.assertEqual(table.route('coffee')[0], ('Yum',))
+
+    def test_without_hot_reload(self):
+        table = TriggerTable(self.filename, check_interval=0)
+        self.write('@@@ .*tea\nEarl grey\n')
+        mtime = time.time() + 10
+        os.utime(self.filename, (mtime, mtime))
+        self.assertEqual(table.route('tea'), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
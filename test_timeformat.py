@@ -0,0 +1,41 @@
+import datetime
+import unittest
+
+from timeformat import format_timedelta
+
+
+class TestFormatTimedelta(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(format_timedelta(datetime.timedelta(seconds=1)), '1 second')
+        self.assertEqual(format_timedelta(datetime.timedelta(seconds=30)), '30 seconds')
+        self.assertEqual(format_timedelta(datetime.timedelta(minutes=25)), '25 minutes')
+        self.assertEqual(format_timedelta(datetime.timedelta(hours=3)), '3 hours')
+        self.assertEqual(format_timedelta(datetime.timedelta(days=2)), '2 days')
+        self.assertEqual(format_timedelta(datetime.timedelta(weeks=12)), '3 months')
+        self.assertEqual(format_timedelta(datetime.timedelta(days=400)), '1 year')
+
+    def test_threshold(self):
+        # 52 minutes is more than 0.85 of an hour.
+        self.assertEqual(format_timedelta(datetime.timedelta(minutes=52)), '1 hour')
+        self.assertEqual(format_timedelta(datetime.timedelta(minutes=50)), '50 minutes')
+        self.assertEqual(format_timedelta(datetime.timedelta(hours=23), threshold=1.1), '23 hours')
+
+    def test_rounding(self):
+        self.assertEqual(format_timedelta(datetime.timedelta(hours=1, minutes=40)), '2 hours')
+        self.assertEqual(format_timedelta(datetime.timedelta(hours=1, minutes=20)), '1 hour')
+
+    def test_past(self):
+        self.assertEqual(format_timedelta(datetime.timedelta(minutes=-10)), '10 minutes')
+        self.assertEqual(format_timedelta(datetime.timedelta(seconds=-1)), '1 second')
+
+    def test_granularity(self):
+        self.assertEqual(format_timedelta(datetime.timedelta(seconds=0)), '0 seconds')
+        self.assertEqual(format_timedelta(datetime.timedelta(seconds=20), granularity='minute'), '1 minute')
+        self.assertEqual(format_timedelta(datetime.timedelta(hours=3), granularity='day'), '1 day')
+
+    def test_seconds(self):
+        self.assertEqual(format_timedelta(90), '2 minutes')
+
+
+if __name__ == '__main__':
+    unittest.main()
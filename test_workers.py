@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+from workers import KeyedWorkerPool
+
+
+class TestKeyedWorkerPool(unittest.TestCase):
+    def test_results(self):
+        pool = KeyedWorkerPool(num_workers=2)
+        futures = [pool.submit(i % 3, lambda x: x * 2, i) for i in range(10)]
+        self.assertEqual([f.result(timeout=5) for f in futures], [i * 2 for i in range(10)])
+        pool.shutdown()
+
+    def test_exceptions_are_reported(self):
+        pool = KeyedWorkerPool(num_workers=1)
+        future = pool.submit('a', lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            future.result(timeout=5)
+        # The pool keeps working after an error.
+        self.assertEqual(pool.submit('a', lambda: 'ok').result(timeout=5), 'ok')
+        pool.shutdown()
+
+    def test_same_key_runs_in_order(self):
+        pool = KeyedWorkerPool(num_workers=4)
+        seen = []
+
+        def record(i):
+            # Later tasks are quicker, so they would overtake if allowed to.
+            time.sleep((10 - i) / 1000)
+            seen.append(i)
+
+        for i in range(10):
+            pool.submit('user', record, i)
+        pool.shutdown()
+        self.assertEqual(seen, list(range(10)))
+
+    def test_different_keys_run_concurrently(self):
+        pool = KeyedWorkerPool(num_workers=2)
+        release = threading.Event()
+        slow = pool.submit('slow', release.wait, 5)
+        # This must not wait for the slow task to finish.
+        self.assertEqual(pool.submit('fast', lambda: 'done').result(timeout=1), 'done')
+        self.assertFalse(slow.done())
+        release.set()
+        self.assertTrue(slow.result(timeout=5))
+        pool.shutdown()
+
+    def test_timeout_callback(self):
+        pool = KeyedWorkerPool(num_workers=1, timeout=0.05)
+        timed_out = threading.Event()
+        pool.submit('a', time.sleep, 0.3, on_timeout=timed_out.set)
+        self.assertTrue(timed_out.wait(2))
+        pool.shutdown()
+
+    def test_initializer_and_after_task(self):
+        local = threading.local()
+        cleanups = []
+
+        def init():
+            local.value = 'initialized'
+
+        pool = KeyedWorkerPool(num_workers=1, initializer=init, after_task=lambda: cleanups.append(1))
+        self.assertEqual(pool.submit('a', lambda: local.value).result(timeout=5), 'initialized')
+        pool.shutdown()
+        self.assertEqual(cleanups, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,14 +2,27 @@
 Unittesting module for the NCSS Coffeerun web app
 Maddy Reid 2014"""
 
+import re
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-from application import app, db
-from application.models import Cafe, Coffee, Price, Run, User
+from application import app, bulk_orders, create_session_table, db, directory, event_store, events, forms, init_web, live_updates, sessions, slack_identity, views
+from application.models import Cafe, Coffee, CoffeeSpec, Event, Price, Run, SYDNEY_TZ, UTCOnlyDateTime, User, add_sydney_timezone, record_event, record_events, spec_price, sydney_timezone_now
+
+import coffeebot
+
+import coffeespecs
 
 from flask_testing import TestCase
 
+import sqlalchemy
+
+import utils
+
+
+init_web()
+
 
 class UserModelTest(TestCase):
     def create_app(self):
@@ -297,6 +310,876 @@ def CafeTestModel(TestCase):
         assert cafe not in db.session
 
 
+class SlackLoginTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        # The server side session table (see application/__init__.py).
+        create_session_table()
+        self.identities = slack_identity.StubIdentityProvider()
+        self._real_provider = views.identity_provider
+        views.identity_provider = self.identities
+
+    def tearDown(self):
+        views.identity_provider = self._real_provider
+        db.session.remove()
+        db.drop_all()
+
+    def test_login_with_known_token(self):
+        self.identities.add('token', slack_identity.SlackIdentity('U1', 'maddy', 'T1'))
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('token', '')
+        response = self.client.get('/slacklogin/')
+        self.assertRedirects(response, '/')
+        user = User.query.filter_by(slack_user_id='U1', slack_team_id='T1').one()
+        self.assertEqual(user.name, 'maddy')
+
+    def test_login_with_unknown_token(self):
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('bad-token', '')
+        self.client.get('/slacklogin/')
+        self.assertEqual(User.query.count(), 0)
+
+
+class BulkOrderTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_parse_orders(self):
+        orders = bulk_orders.parse_orders('Maddy: large cap\n\nElmo: lb\n')
+        self.assertEqual([(order.line, order.name) for order in orders], [(1, 'Maddy'), (3, 'Elmo')])
+        self.assertEqual(str(orders[0].coffee), 'Large Cappuccino')
+
+    def test_parse_orders_reports_every_bad_line(self):
+        with self.assertRaises(bulk_orders.BulkOrderError) as cm:
+            bulk_orders.parse_orders('Maddy: large cap\nno colon\nElmo: large')
+        self.assertEqual(len(cm.exception.errors), 2)
+
+    def test_add_orders(self):
+        cafe = Cafe('Cafe')
+        maddy = User('Maddy')
+        db.session.add_all([cafe, maddy])
+        db.session.flush()
+        price = Price(cafe.id, coffeespecs.Coffee('large cap'))
+        price.amount = 4.5
+        run = Run(sydney_timezone_now())
+        run.cafeid = cafe.id
+        run.person = maddy.id
+        db.session.add_all([price, run])
+        db.session.commit()
+
+        orders = bulk_orders.parse_orders('maddy: large cap\nElmo: large cap\nKatie: lb')
+        coffee_ids = bulk_orders.add_orders(run, orders, maddy.id)
+        db.session.commit()
+
+        coffees = Coffee.query.filter(Coffee.id.in_(coffee_ids)).order_by(Coffee.id).all()
+        self.assertEqual([coffee.addict.name for coffee in coffees], ['Maddy', 'Elmo', 'Katie'])
+        self.assertEqual([coffee.price for coffee in coffees], [4.5, 4.5, 4.0])
+        # Elmo and Katie were created, and every new coffee was logged.
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Event.query.filter_by(objtype='coffee').count(), 3)
+        # Both large caps share a spec.
+        self.assertEqual(len({coffee.spec_id for coffee in coffees}), 2)
+        self.assertEqual(coffees[0].spec_id, coffees[1].spec_id)
+
+    def test_add_orders_only_returns_its_coffees(self):
+        cafe = Cafe('Cafe')
+        maddy = User('Maddy')
+        db.session.add_all([cafe, maddy])
+        db.session.flush()
+        run = Run(sydney_timezone_now())
+        run.cafeid = cafe.id
+        run.person = maddy.id
+        db.session.add(run)
+        db.session.commit()
+
+        # Another coffee in the same run, with the same modified time.
+        time = sydney_timezone_now()
+        other = Coffee('lb', 4.0, run.id)
+        other.person = maddy.id
+        other.modified = time
+        db.session.add(other)
+        db.session.commit()
+        with mock.patch.object(bulk_orders, 'sydney_timezone_now', return_value=time):
+            coffee_ids = bulk_orders.add_orders(run, bulk_orders.parse_orders('Elmo: large cap'), maddy.id)
+        db.session.commit()
+        self.assertEqual(len(coffee_ids), 1)
+        self.assertNotIn(other.id, coffee_ids)
+
+
+class CoffeeSpecTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.cafe = Cafe('Cafe')
+        self.user = User('Maddy')
+        db.session.add_all([self.cafe, self.user])
+        db.session.flush()
+        self.run = Run(sydney_timezone_now())
+        self.run.cafeid = self.cafe.id
+        self.run.person = self.user.id
+        db.session.add(self.run)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def add_coffee(self, request):
+        coffee = Coffee(request, 4.0, self.run.id)
+        coffee.person = self.user.id
+        db.session.add(coffee)
+        db.session.commit()
+        return coffee
+
+    def test_coffees_share_specs(self):
+        first = self.add_coffee('large cap')
+        second = self.add_coffee('Large Cappuccino')
+        third = self.add_coffee('flat white')
+        self.assertEqual(first.spec_id, second.spec_id)
+        self.assertNotEqual(first.spec_id, third.spec_id)
+        self.assertEqual(first.spec.description, 'Large Cappuccino')
+        self.assertEqual(first.spec.price_key, 'Large Cappuccino')
+        self.assertEqual(CoffeeSpec.query.count(), 2)
+
+    def test_editing_a_coffee_changes_its_spec(self):
+        coffee = self.add_coffee('large cap')
+        coffee.coffee = coffeespecs.Coffee('small latte').toJSON()
+        db.session.commit()
+        self.assertEqual(coffee.spec.description, 'Small Latte')
+
+    def test_rolled_back_specs_are_not_remembered(self):
+        coffee = Coffee('large mocha', 4.0, self.run.id)
+        db.session.add(coffee)
+        db.session.flush()
+        db.session.rollback()
+        coffee = self.add_coffee('large mocha')
+        self.assertEqual(coffee.spec.description, 'Large Mocha')
+
+    def test_order_summary(self):
+        elmo = User('Elmo')
+        db.session.add(elmo)
+        db.session.commit()
+        self.add_coffee('large cap')
+        self.add_coffee('flat white')
+        self.add_coffee('regular flat white').person = elmo.id
+        self.add_coffee('small flat white')
+        db.session.commit()
+        with app.test_request_context():
+            lines = views.order_summary(self.run.id)
+        self.assertEqual(
+                [(line.description, line.count, sorted(line.names.split(', ')), line.subtotal) for line in lines],
+                [('Large Cappuccino', 1, ['Maddy'], 4.0),
+                 ('Regular Flat White', 2, ['Elmo', 'Maddy'], 8.0),
+                 ('Small Flat White', 1, ['Maddy'], 4.0)])
+
+    def test_spec_price(self):
+        price = Price(self.cafe.id, coffeespecs.Coffee('large cap'))
+        price.amount = 4.5
+        db.session.add(price)
+        db.session.commit()
+        cap = self.add_coffee('large cap')
+        latte = self.add_coffee('large latte')
+        tea = self.add_coffee('tea')
+        query = db.session.query(Coffee.id, spec_price(Run.cafeid)) \
+            .join(Run) \
+            .join(CoffeeSpec, Coffee.spec_id == CoffeeSpec.id)
+        # A large latte is priced like a large cappuccino.
+        self.assertEqual(dict(query), {cap.id: 4.5, latte.id: 4.5, tea.id: None})
+
+
+class ApiTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        create_session_table()
+        self.user = User('Maddy')
+        self.cafe = Cafe('Cafe')
+        db.session.add_all([self.user, self.cafe])
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def add_run(self):
+        run = Run(sydney_timezone_now())
+        run.person = self.user.id
+        run.cafeid = self.cafe.id
+        db.session.add(run)
+        db.session.commit()
+        return run
+
+    def test_list_runs_is_paginated(self):
+        runs = [self.add_run() for _ in range(3)]
+        response = self.client.get('/api/runs/?limit=2&fields=id&include=runner')
+        self.assertEqual(response.json['runs'], [
+            {'id': runs[2].id, 'runner': {'id': self.user.id, 'name': 'Maddy'}},
+            {'id': runs[1].id, 'runner': {'id': self.user.id, 'name': 'Maddy'}},
+        ])
+        response = self.client.get('/api/runs/?limit=2&fields=id&cursor=' + response.json['next_cursor'])
+        self.assertEqual(response.json, {'runs': [{'id': runs[0].id}], 'next_cursor': None})
+
+    def test_unknown_field(self):
+        response = self.client.get('/api/runs/?fields=nope')
+        self.assertEqual(response.status_code, 400)
+
+    def test_add_coffee(self):
+        run = self.add_run()
+        response = self.client.post('/api/coffees/', json={'run_id': run.id, 'coffee': 'large cap'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['description'], 'Large Cappuccino')
+        self.assertEqual(response.json['addict_id'], self.user.id)
+        self.assertEqual(Coffee.query.count(), 1)
+
+    def test_bad_input_is_400(self):
+        run = self.add_run()
+        for body in [
+                {'run_id': 'one', 'coffee': 'large cap'},
+                {'run_id': [run.id], 'coffee': 'large cap'},
+                {'run_id': run.id, 'addict_id': True, 'coffee': 'large cap'},
+                {'run_id': run.id, 'coffee': ['large cap']},
+                {'run_id': run.id, 'coffee': 'flat white flat white'},
+        ]:
+            response = self.client.post('/api/coffees/', json=body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn('error', response.json)
+        response = self.client.post('/api/runs/', json={'cafe_id': {}, 'time': '2020-01-01T10:00:00+11:00'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Coffee.query.count(), 0)
+
+
+class LoadUserTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        create_session_table()
+        views.logged_in_users.clear()
+        self.user = User('Maddy')
+        db.session.add(self.user)
+        db.session.commit()
+        self.queries = 0
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', self.count_query)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', self.count_query)
+        db.session.remove()
+        db.drop_all()
+
+    def count_query(self, *args):
+        self.queries += 1
+
+    def test_user_is_cached(self):
+        user = views.load_user(str(self.user.id))
+        self.assertEqual(user.name, 'Maddy')
+        self.assertEqual(user, self.user)
+        queries = self.queries
+        self.assertIs(views.load_user(str(self.user.id)), user)
+        self.assertEqual(self.queries, queries)
+
+    def test_unknown_user(self):
+        self.assertIsNone(views.load_user('1000'))
+
+    def test_edited_user_is_reloaded(self):
+        views.load_user(str(self.user.id))
+        self.user.name = 'Maddy Reid'
+        db.session.commit()
+        self.assertEqual(views.load_user(str(self.user.id)).name, 'Maddy Reid')
+
+    def test_logged_in_user_can_view_pages(self):
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+        response = self.client.get('/user/{}/'.format(self.user.id))
+        self.assert200(response)
+        self.assertIn(b'View Debts', response.data)
+
+
+class ActivityEventTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.user = User()
+        self.user.name = 'Test User'
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_events_commit_with_the_change(self):
+        with mock.patch.object(events, 'activity_recorded') as activity_recorded:
+            record_event(self.user.id, 'updated', 'user', self.user.id)
+            record_events(self.user.id, 'created', 'coffee', [1, 2])
+            self.assertEqual(activity_recorded.call_count, 0)
+            db.session.commit()
+        self.assertEqual(Event.query.count(), 3)
+        activity_recorded.assert_called_once_with()
+
+    def test_events_roll_back_with_the_change(self):
+        with mock.patch.object(events, 'activity_recorded') as activity_recorded:
+            self.user.name = 'Renamed'
+            record_event(self.user.id, 'updated', 'user', self.user.id)
+            record_events(self.user.id, 'created', 'coffee', [1, 2])
+            db.session.rollback()
+            self.assertEqual(Event.query.count(), 0)
+            self.assertEqual(User.query.get(self.user.id).name, 'Test User')
+            # A later commit with no events of its own must not announce the discarded ones.
+            db.session.commit()
+        activity_recorded.assert_not_called()
+
+
+class EventBucketTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_bucket_is_utc_month(self):
+        # 1 March in Sydney, but still February in UTC.
+        event = Event(0, 'created', 'run', 1)
+        event.time = add_sydney_timezone(datetime(2020, 3, 1, 5, 0))
+        db.session.add(event)
+        db.session.commit()
+        self.assertEqual(event.bucket, 202002)
+
+    def test_retention_cutoff(self):
+        now = add_sydney_timezone(datetime(2020, 3, 15, 12, 0))
+        self.assertEqual(event_store.retention_cutoff(1, now), 202003)
+        self.assertEqual(event_store.retention_cutoff(3, now), 202001)
+        self.assertEqual(event_store.retention_cutoff(15, now), 201901)
+
+    def test_retention_must_keep_the_current_month(self):
+        event = Event(0, 'created', 'run', 1)
+        event.time = add_sydney_timezone(datetime(2020, 3, 15, 12, 0))
+        db.session.add(event)
+        db.session.commit()
+        for months in (0, -1):
+            with self.assertRaises(ValueError):
+                event_store.retention_cutoff(months)
+            with self.assertRaises(ValueError):
+                event_store.archive_old_events(months, '/nonexistent')
+        self.assertEqual(Event.query.count(), 1)
+
+
+class SydneyTimeTest(TestCase):
+    # Daylight saving ended at 3am on 5 April 2020 (16:00 UTC the day
+    # before), and started at 2am on 4 October 2020 (16:00 UTC the day
+    # before).
+    DST_CHANGES = [datetime(2020, 4, 4, 16, 0), datetime(2020, 10, 3, 16, 0)]
+
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def around_dst_changes(self):
+        """Naive UTC times every quarter hour, for 3 hours either side of each change."""
+        for change in self.DST_CHANGES:
+            for quarter in range(-12, 13):
+                yield change + timedelta(minutes=15 * quarter)
+
+    def test_fromutc_matches_astimezone(self):
+        for utc in self.around_dst_changes():
+            expected = utc.replace(tzinfo=timezone.utc).astimezone(SYDNEY_TZ)
+            actual = UTCOnlyDateTime().process_result_value(utc, None)
+            self.assertEqual(actual, expected)
+            self.assertEqual(actual.utcoffset(), expected.utcoffset())
+            self.assertEqual(actual.tzname(), expected.tzname())
+
+    def test_offsets_change_at_the_right_time(self):
+        result = UTCOnlyDateTime().process_result_value
+        for change, before, after in zip(self.DST_CHANGES, [11, 10], [10, 11]):
+            self.assertEqual(result(change - timedelta(seconds=1), None).utcoffset(), timedelta(hours=before))
+            self.assertEqual(result(change, None).utcoffset(), timedelta(hours=after))
+
+    def test_round_trip(self):
+        runs = []
+        for utc in self.around_dst_changes():
+            run = Run(utc.replace(tzinfo=timezone.utc).astimezone(SYDNEY_TZ))
+            runs.append((utc, run))
+            db.session.add(run)
+        db.session.commit()
+        db.session.expire_all()
+        for utc, run in runs:
+            # Including the repeated hour on 5 April, which must come back
+            # with the offset it went in with.
+            expected = utc.replace(tzinfo=timezone.utc).astimezone(SYDNEY_TZ)
+            self.assertEqual(run.time, expected)
+            self.assertEqual(run.time.utcoffset(), expected.utcoffset())
+
+
+class BotUserCacheTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        utils.clear_user_cache()
+
+    def tearDown(self):
+        utils.clear_user_cache()
+        db.session.remove()
+        db.drop_all()
+
+    def rename_elsewhere(self, user, name):
+        # Like an edit made by another process: no mapper events here.
+        db.session.execute(User.__table__.update().where(User.id == user.id).values(name=name))
+        db.session.commit()
+
+    def test_user_is_cached(self):
+        user = utils.get_or_create_user('U1', 'T1', 'Maddy')
+        self.rename_elsewhere(user, 'Maddy Reid')
+        self.assertEqual(utils.get_or_create_user('U1', 'T1', 'Maddy').name, 'Maddy')
+
+    def test_cached_user_expires(self):
+        with mock.patch.object(utils._user_cache, 'ttl', 0):
+            user = utils.get_or_create_user('U1', 'T1', 'Maddy')
+            self.rename_elsewhere(user, 'Maddy Reid')
+            self.assertEqual(utils.get_or_create_user('U1', 'T1', 'Maddy').name, 'Maddy Reid')
+
+
+class SuperviseTest(TestCase):
+    class Stop(Exception):
+        pass
+
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.bot = coffeebot.WrappedSlackBot('token', 'U1', 'T1')
+        self.bot.loop = mock.Mock(side_effect=ConnectionError('gone'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def supervise(self, reconnects):
+        """The delays before each of the first `reconnects` reconnects."""
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) == reconnects:
+                raise self.Stop()
+
+        with mock.patch.object(coffeebot.time, 'sleep', sleep), \
+                mock.patch.object(coffeebot.random, 'uniform', return_value=1.0):
+            with self.assertRaises(self.Stop):
+                coffeebot.supervise(self.bot)
+        return delays
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        self.assertEqual(self.supervise(11), [1, 2, 4, 8, 16, 32, 64, 128, 256, 300, 300])
+        self.assertEqual(self.bot.loop.call_count, 11)
+        self.assertEqual(self.bot.health.disconnects, 11)
+        self.assertEqual(self.bot.health.last_error, "ConnectionError('gone')")
+
+    def test_backoff_is_jittered(self):
+        with mock.patch.object(coffeebot.random, 'uniform', return_value=1.5) as uniform:
+            delays = []
+
+            def sleep(delay):
+                delays.append(delay)
+                raise self.Stop()
+
+            with mock.patch.object(coffeebot.time, 'sleep', sleep):
+                with self.assertRaises(self.Stop):
+                    coffeebot.supervise(self.bot)
+        uniform.assert_called_with(0.5, 1.5)
+        self.assertEqual(delays, [1.5])
+
+    def test_stable_connection_resets_backoff(self):
+        with mock.patch.object(coffeebot, 'STABLE_CONNECTION_SECONDS', -1):
+            self.assertEqual(self.supervise(4), [1, 1, 1, 1])
+
+
+class DirectoryTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        create_session_table()
+        directory.users.invalidate()
+        self.maddy = User('Maddy Reid')
+        self.elmo = User('elmo')
+        self.mark = User('Mark')
+        db.session.add_all([self.maddy, self.elmo, self.mark])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_search(self):
+        self.assertEqual(directory.users.search('ma'), [(self.maddy.id, 'Maddy Reid'), (self.mark.id, 'Mark')])
+        self.assertEqual(directory.users.search('REI'), [(self.maddy.id, 'Maddy Reid')])
+        self.assertEqual(directory.users.search('ma', limit=1), [(self.maddy.id, 'Maddy Reid')])
+        self.assertEqual(directory.users.search('x'), [])
+
+    def test_new_users_are_found(self):
+        directory.users.search('e')
+        user = User('Edward')
+        db.session.add(user)
+        db.session.commit()
+        self.assertEqual(directory.users.search('e'), [(user.id, 'Edward'), (self.elmo.id, 'elmo')])
+
+    def test_name(self):
+        self.assertEqual(directory.users.name(self.elmo.id), 'elmo')
+        self.assertIsNone(directory.users.name(1000))
+
+    def test_search_endpoint(self):
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.elmo.id)
+            sess['_fresh'] = True
+        response = self.client.get('/user/search.json?q=mad')
+        self.assertEqual(response.json, {'results': [{'id': self.maddy.id, 'name': 'Maddy Reid'}]})
+
+    def test_lookup_field_checks_the_id(self):
+        with app.test_request_context(method='POST', data={'person': str(self.mark.id), 'coffee': 'flat white'}):
+            form = forms.CoffeeForm(meta={'csrf': False})
+            form.runid.choices = [(-1, '')]
+            form.runid.data = -1
+            self.assertTrue(form.validate())
+            self.assertIn('Mark', form.person())
+        with app.test_request_context(method='POST', data={'person': '1000', 'coffee': 'flat white'}):
+            form = forms.CoffeeForm(meta={'csrf': False})
+            form.runid.choices = [(-1, '')]
+            form.runid.data = -1
+            self.assertFalse(form.validate())
+            self.assertIn('person', form.errors)
+
+
+class HomeFragmentTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        create_session_table()
+        views.home_fragments.clear()
+        self.user = User('Maddy')
+        self.cafe = Cafe('Cafe')
+        db.session.add_all([self.user, self.cafe])
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+
+    def tearDown(self):
+        views.home_fragments.clear()
+        db.session.remove()
+        db.drop_all()
+
+    def add_run(self):
+        # Added behind the views' backs: nothing is dispatched for it.
+        run = Run(sydney_timezone_now() + timedelta(hours=1))
+        run.person = self.user.id
+        run.cafeid = self.cafe.id
+        db.session.add(run)
+        db.session.commit()
+        return run
+
+    def test_fragments_are_cached(self):
+        self.assertIn(b'There are no upcoming runs', self.client.get('/').data)
+        self.assertIn('next_run', views.home_fragments)
+        self.assertIn('recent_activity', views.home_fragments)
+        self.add_run()
+        self.assertIn(b'There are no upcoming runs', self.client.get('/').data)
+
+    def test_run_events_clear_the_cache(self):
+        self.client.get('/')
+        run = self.add_run()
+        events.run_created(run.id)
+        self.assertEqual(len(views.home_fragments), 0)
+        self.assertIn(b'Next run:', self.client.get('/').data)
+
+    def test_activity_clears_the_cache(self):
+        self.client.get('/')
+        run = self.add_run()
+        record_event(self.user.id, 'created', 'run', run.id)
+        db.session.commit()
+        self.assertEqual(len(views.home_fragments), 0)
+        html = self.client.get('/').data
+        self.assertIn(b'Next run:', html)
+        self.assertIn('created a <a href="/run/{}/">'.format(run.id).encode(), html)
+
+
+class LiveUpdatesTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        app.config['LIVE_UPDATES_STREAM_SECONDS'] = 0.2
+        app.config['LIVE_UPDATES_KEEPALIVE_SECONDS'] = 0.1
+        return app
+
+    def setUp(self):
+        db.create_all()
+        create_session_table()
+        self.user = User('Maddy')
+        self.cafe = Cafe('Cafe')
+        db.session.add_all([self.user, self.cafe])
+        db.session.commit()
+        self.run = Run(sydney_timezone_now())
+        self.run.person = self.user.id
+        self.run.cafeid = self.cafe.id
+        db.session.add(self.run)
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def stream(self, **headers):
+        response = self.client.get('/run/{}/stream/'.format(self.run.id), headers=headers)
+        data = response.get_data(as_text=True)
+        response.close()
+        return data
+
+    def test_replays_missed_messages(self):
+        broker = live_updates.LocalBroker()
+        broker.publish('run:1', {'type': 'a'})
+        broker.publish('run:1', {'type': 'b'})
+        first, second = [message for _, message in broker._recent['run:1']]
+        subscription = broker.subscribe('run:1', last_id=first['id'])
+        self.assertEqual(subscription.get(timeout=0), second)
+        self.assertIsNone(subscription.get(timeout=0))
+        self.assertIsNone(broker.subscribe('run:1').get(timeout=0))
+
+    def test_stream_ends_and_replays(self):
+        channel = live_updates.run_channel(self.run.id)
+        live_updates.broker.publish(channel, {'type': 'run_closed'})
+        self.assertNotIn('run_closed', self.stream())
+        data = self.stream(**{'Last-Event-ID': '0'})
+        self.assertIn('retry: {}'.format(views.STREAM_RETRY_MS), data)
+        self.assertIn('event: run_closed', data)
+        self.assertIn('id: ', data)
+        self.assertEqual(live_updates.stream_slots.open, 0)
+
+    def test_idle_stream_catches_up_on_reconnect(self):
+        # A stream that sends no messages still gives the browser an id to
+        # reconnect with, so nothing published in between is lost.
+        data = self.stream()
+        self.assertNotIn('event:', data)
+        last_id = re.search(r'^id: (\d+)$', data, re.M).group(1)
+        live_updates.broker.publish(live_updates.run_channel(self.run.id), {'type': 'run_closed'})
+        self.assertIn('event: run_closed', self.stream(**{'Last-Event-ID': last_id}))
+
+    def test_stream_catches_up_from_the_page(self):
+        response = self.client.get('/run/{}/'.format(self.run.id))
+        last_id = re.search(r'data-live-last-id="(\d+)"', response.get_data(as_text=True)).group(1)
+        live_updates.broker.publish(live_updates.run_channel(self.run.id), {'type': 'run_closed'})
+        response = self.client.get('/run/{}/stream/?last_id={}'.format(self.run.id, last_id))
+        data = response.get_data(as_text=True)
+        response.close()
+        self.assertIn('event: run_closed', data)
+
+    def test_streams_are_limited(self):
+        app.config['LIVE_UPDATES_MAX_STREAMS'] = 0
+        self.assertEqual(self.stream(**{'Last-Event-ID': '5'}),
+                         'retry: {}\nid: 5\n\n'.format(views.STREAM_BUSY_RETRY_MS))
+        self.assertRegex(self.stream(), r'^retry: \d+\nid: \d+\n\n$')
+        self.assertEqual(live_updates.stream_slots.open, 0)
+
+
+class ConditionalGetTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        create_session_table()
+        self.user = User('Maddy')
+        self.cafe = Cafe('Cafe')
+        db.session.add_all([self.user, self.cafe])
+        db.session.commit()
+        self.run = Run(sydney_timezone_now())
+        self.run.person = self.user.id
+        self.run.cafeid = self.cafe.id
+        db.session.add(self.run)
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_unchanged_run_is_not_modified(self):
+        url = '/run/{}/'.format(self.run.id)
+        etag = self.client.get(url).headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+    def test_renames_change_the_run_page(self):
+        for url in ['/run/{}/'.format(self.run.id), '/order/{}/'.format(self.run.id)]:
+            for obj in [self.user, self.cafe]:
+                etag = self.client.get(url).headers['ETag']
+                obj.name += ' Reid'
+                db.session.commit()
+                self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_prices_for_unknown_run(self):
+        self.assertEqual(self.client.get('/_prices_for_run/?runid={}'.format(self.run.id + 1)).status_code, 404)
+
+    def price_url(self):
+        with app.test_request_context():
+            return views._price_urls([self.run])[self.run.id]
+
+    def test_versioned_prices_are_immutable(self):
+        response = self.client.get(self.price_url())
+        self.assertEqual(response.json, {'version': 1, 'prices': {}})
+        self.assertEqual(response.headers['Cache-Control'], 'private, max-age=31536000, immutable')
+
+    def test_other_prices_are_not_cached(self):
+        for url in ['/cafe/{}/prices.json', '/cafe/{}/prices.json?v=0']:
+            response = self.client.get(url.format(self.cafe.id))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+    def test_price_changes_change_the_url(self):
+        old_url = self.price_url()
+        price = Price(self.cafe.id, coffeespecs.Coffee('latte'))
+        price.amount = 4.0
+        db.session.add(price)
+        db.session.commit()
+        new_url = self.price_url()
+        self.assertNotEqual(new_url, old_url)
+        self.assertEqual(self.client.get(old_url).headers['Cache-Control'], 'no-cache')
+        response = self.client.get(new_url)
+        self.assertEqual(response.json['prices'], {price.price_key: 4.0})
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+
+class SessionTest(TestCase):
+    def create_app(self):
+        app.config.from_object('config.TestConfig')
+        return app
+
+    def setUp(self):
+        db.create_all()
+        create_session_table()
+        self.sessions = app.session_interface
+        self.sessions.cache.clear()
+        self.statements = []
+        sqlalchemy.event.listen(self.sessions.db.engine, 'before_cursor_execute', self.count_statement)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(self.sessions.db.engine, 'before_cursor_execute', self.count_statement)
+        self.sessions.db.drop_all()
+        db.session.remove()
+        db.drop_all()
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement.split()[0].upper())
+
+    def session_cookie(self):
+        return next(cookie for cookie in self.client.cookie_jar if cookie.name == app.session_cookie_name)
+
+    def test_unchanged_session_is_cached(self):
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('token', '')
+        self.assertEqual(self.statements.count('INSERT'), 1)
+        del self.statements[:]
+
+        self.client.get('/static/js/runlive.js')
+        self.client.get('/static/js/runlive.js')
+        self.assertEqual(self.statements, [])
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess['slack_token'], ('token', ''))
+
+    def test_changed_session_is_written(self):
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('token', '')
+        version = self.session_cookie().value.partition('.')[2]
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('other', '')
+        self.assertIn('UPDATE', self.statements)
+        self.assertNotEqual(self.session_cookie().value.partition('.')[2], version)
+
+    def test_session_changed_by_another_process_is_reloaded(self):
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('token', '')
+        # Another web worker has a different cache.
+        self.sessions.cache.clear()
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('other', '')
+        self.sessions.cache.set(
+                self.sessions.key_prefix + self.session_cookie().value.partition('.')[0],
+                sessions.StoredSession(b'stale', None, 'stale'))
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess['slack_token'], ('other', ''))
+
+    def test_logout_deletes_session(self):
+        with self.client.session_transaction() as sess:
+            sess['slack_token'] = ('token', '')
+        with self.client.session_transaction() as sess:
+            sess.clear()
+        table = self.sessions.sql_session_model.__table__
+        self.assertEqual(self.sessions.db.session.query(table).count(), 0)
+
+    def test_sweep_expired(self):
+        table = self.sessions.sql_session_model.__table__
+        now = datetime.utcnow()
+        with self.sessions.db.engine.begin() as conn:
+            conn.execute(table.insert(), [
+                {'session_id': 'session:old', 'data': b'', 'expiry': now - timedelta(days=1)},
+                {'session_id': 'session:new', 'data': b'', 'expiry': now + timedelta(days=1)},
+            ])
+        self.assertEqual(self.sessions.sweep_expired(), 1)
+        with self.sessions.db.engine.connect() as conn:
+            remaining = [row.session_id for row in conn.execute(sqlalchemy.select([table.c.session_id]))]
+        self.assertEqual(remaining, ['session:new'])
+
+
 if __name__ == "__main__":
 
     unittest.main()
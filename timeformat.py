@@ -0,0 +1,41 @@
+"""Formatting times for chat messages, without Babel.
+
+The chat bot only ever needs English durations ("in 25 minutes"), so this
+does the same as flask_babel.format_timedelta for the en_AU locale, without
+needing a Flask request context or loading the CLDR locale data.
+"""
+import datetime
+
+
+# The same units (and lengths) as babel.dates.TIMEDELTA_UNITS.
+TIMEDELTA_UNITS = (
+    ('year', 3600 * 24 * 365),
+    ('month', 3600 * 24 * 30),
+    ('week', 3600 * 24 * 7),
+    ('day', 3600 * 24),
+    ('hour', 3600),
+    ('minute', 60),
+    ('second', 1),
+)
+
+
+def format_timedelta(delta, granularity='second', threshold=0.85):
+    """Describe a duration in the largest unit that fits, e.g. '3 hours'.
+
+    Like Babel, a unit is used once the duration is at least `threshold` of
+    it (so 52 minutes is '1 hour'), the value is rounded, and the sign of the
+    duration is ignored.
+    """
+    if isinstance(delta, datetime.timedelta):
+        seconds = int(delta.days * 86400 + delta.seconds)
+    else:
+        seconds = delta
+
+    for unit, secs_per_unit in TIMEDELTA_UNITS:
+        value = abs(seconds) / secs_per_unit
+        if value >= threshold or unit == granularity:
+            if unit == granularity and value > 0:
+                value = max(1, value)
+            value = int(round(value))
+            return '{} {}{}'.format(value, unit, '' if value == 1 else 's')
+    return ''
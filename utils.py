@@ -1,21 +1,64 @@
 from application import app, db
+from application.cache import TTLCache
 from application.models import User
 
+import sqlalchemy
+
+
+# Users we have already looked up, so that the chat bot (which looks up the
+# sender of every command) does not need to query for them each time.
+# Maps (team_id, slack_user_id) to a detached copy of the User. Changes made
+# in this process are dropped straight away; the expiry bounds how long
+# changes made elsewhere (e.g. editing a user on the web) take to show up.
+_user_cache = TTLCache(ttl=app.config.get('SLACK_USER_CACHE_TTL', 300), maxsize=4096)
+
+
+def _detached_copy(user):
+    copy = User()
+    for column in sqlalchemy.inspect(User).column_attrs:
+        setattr(copy, column.key, getattr(user, column.key))
+    sqlalchemy.orm.make_transient_to_detached(copy)
+    return copy
+
+
+def _cache_user(user):
+    _user_cache.set((user.slack_team_id, user.slack_user_id), _detached_copy(user))
+
+
+@sqlalchemy.event.listens_for(User, 'after_update')
+@sqlalchemy.event.listens_for(User, 'after_delete')
+def _invalidate_cached_user(mapper, connection, user):
+    _user_cache.pop((user.slack_team_id, user.slack_user_id))
+
+
+def clear_user_cache():
+    _user_cache.clear()
+
 
 def get_or_create_user(user_id, team_id, name):
-    print(team_id)
+    cached = _user_cache.get((team_id, user_id))
+    if cached is not None:
+        # Attach the cached copy to the current session without going to the
+        # database.
+        return db.session.merge(cached, load=False)
+
     q = User.query.filter_by(slack_user_id=user_id, slack_team_id=team_id)
-    users = q.all()
-    if len(users) == 1:
-        return users[0]
-    if len(users) == 0:
+    user = q.one_or_none()
+    if user is None:
         user = User(name)
         user.slack_user_id = user_id
         user.slack_team_id = team_id
         user.tutor = team_id == app.config['SLACK_TEAM_ID']
         user.teacher = not user.tutor
         db.session.add(user)
-        db.session.commit()
-        return user
+        try:
+            db.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # Someone else (another worker, or the web app) created this user
+            # at the same time as us. The unique index on the slack identity
+            # means there is only one, so use theirs.
+            db.session.rollback()
+            user = q.one()
 
-    assert False, 'More than one user with the same slack ID - Something is very wrong'
+    _cache_user(user)
+    return user
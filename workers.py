@@ -0,0 +1,169 @@
+"""A small thread pool that keeps tasks for the same key in order.
+
+The chat bot uses this to handle messages concurrently, while making sure
+that two messages from the same person are still handled in the order they
+were sent.
+"""
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('workers')
+
+
+class _Task:
+    def __init__(self, key, fn, args, kwargs, on_timeout):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.on_timeout = on_timeout
+        self.future = concurrent.futures.Future()
+        self.started = None
+        self.timed_out = False
+
+    def __repr__(self):
+        return '<_Task(key={!r}, fn={})>'.format(
+                self.key, getattr(self.fn, '__name__', self.fn))
+
+
+class KeyedWorkerPool:
+    """A bounded pool of worker threads with per-key ordering.
+
+    Tasks submitted with the same key are run one at a time, in submission
+    order. Tasks with different keys run concurrently on up to `num_workers`
+    threads.
+
+    Python threads cannot be interrupted, so `timeout` does not stop a slow
+    task. Instead, a task running for longer than `timeout` seconds has its
+    `on_timeout` callback called (once), so that the slow task can be
+    reported while it carries on.
+
+    Args:
+        num_workers: the number of worker threads.
+        max_pending: the maximum number of queued tasks. `submit` blocks when
+            the queue is full.
+        timeout: seconds a task may run before it is reported as slow.
+        initializer: called once at the start of each worker thread.
+        after_task: called in the worker thread after every task (e.g. to
+            clean up thread local state).
+        name: prefix for the worker thread names.
+    """
+
+    def __init__(self, num_workers=4, max_pending=1000, timeout=None,
+                 initializer=None, after_task=None, name='worker'):
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._ready = collections.deque()
+        self._running = {}
+        self._num_pending = 0
+        self._max_pending = max_pending
+        self._timeout = timeout
+        self._initializer = initializer
+        self._after_task = after_task
+        self._shutdown = False
+
+        self._threads = [
+                threading.Thread(target=self._work, name='{}-{}'.format(name, i), daemon=True)
+                for i in range(num_workers)]
+        if timeout is not None:
+            self._threads.append(threading.Thread(
+                    target=self._watch, name='{}-watchdog'.format(name), daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, fn, *args, on_timeout=None, **kwargs):
+        """Queue `fn(*args, **kwargs)` to run after earlier tasks for `key`.
+
+        Returns a concurrent.futures.Future for the result.
+        """
+        task = _Task(key, fn, args, kwargs, on_timeout)
+        with self._cond:
+            while self._num_pending >= self._max_pending and not self._shutdown:
+                self._cond.wait()
+            if self._shutdown:
+                raise RuntimeError('Cannot submit to a pool that has been shut down.')
+            queue = self._pending.setdefault(key, collections.deque())
+            queue.append(task)
+            self._num_pending += 1
+            # A key that is already running is re-queued when it finishes.
+            if len(queue) == 1 and key not in self._running:
+                self._ready.append(key)
+            self._cond.notify_all()
+        return task.future
+
+    def shutdown(self, wait=True):
+        """Stop the workers once all of the queued tasks have been run."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _next_task(self):
+        with self._cond:
+            while not self._ready:
+                if self._shutdown and not self._num_pending:
+                    return None
+                self._cond.wait()
+            key = self._ready.popleft()
+            task = self._pending[key].popleft()
+            self._num_pending -= 1
+            task.started = time.monotonic()
+            self._running[key] = task
+            self._cond.notify_all()
+            return task
+
+    def _finish_task(self, task):
+        with self._cond:
+            del self._running[task.key]
+            if self._pending[task.key]:
+                self._ready.append(task.key)
+            else:
+                del self._pending[task.key]
+            self._cond.notify_all()
+
+    def _work(self):
+        if self._initializer is not None:
+            self._initializer()
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    result = task.fn(*task.args, **task.kwargs)
+                except BaseException as e:
+                    task.future.set_exception(e)
+                else:
+                    task.future.set_result(result)
+            if self._after_task is not None:
+                try:
+                    self._after_task()
+                except Exception:
+                    logger.exception('Error while cleaning up after %s', task)
+            self._finish_task(task)
+
+    def _watch(self):
+        while True:
+            with self._cond:
+                if self._shutdown and not self._num_pending and not self._running:
+                    return
+                now = time.monotonic()
+                overdue = [
+                        task for task in self._running.values()
+                        if not task.timed_out and now - task.started > self._timeout]
+                for task in overdue:
+                    task.timed_out = True
+            for task in overdue:
+                logger.warning('%s has been running for more than %ss', task, self._timeout)
+                if task.on_timeout is not None:
+                    try:
+                        task.on_timeout()
+                    except Exception:
+                        logger.exception('Error in timeout callback for %s', task)
+            time.sleep(min(self._timeout / 4, 1))